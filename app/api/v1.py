@@ -0,0 +1,202 @@
+from codecs import getreader
+from datetime import date
+from json import dumps
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+
+from app.conditional import conditional
+from app.database.ChangeFeed import change_feed
+from app.database.DatabaseManipulator import DatabaseManipulator
+from app.database.Pagination import clamp_limit, date_args, page_args
+from app.database.PartsCsv import export_parts_csv, import_parts_csv
+from app.decorators.flask_decorators import login_required, admin_login_required, admin_or_token_required
+
+# Version 1 of the JSON API, mounted under /api/v1
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+dbm = DatabaseManipulator()
+
+
+# Convert result rows into a list of dictionaries keyed by column name,
+# datetimes as 'YYYY-MM-DD HH:MM:SS' and dates as 'YYYY-MM-DD'
+def to_dicts(rows) -> list:
+    return [{key: str(value) if isinstance(value, date) else value for key, value in row._mapping.items()}
+            for row in rows or []]
+
+
+# Build a JSON page response from (rows, next_cursor)
+def page_response(page: tuple or None) -> Response:
+    rows, next_cursor = page or ([], None)
+    return jsonify(items=to_dicts(rows), next_cursor=next_cursor)
+
+
+# Stream rows as newline delimited JSON, one object per line
+def ndjson_response(rows) -> Response:
+    def generate():
+        for row in rows:
+            yield dumps(dict(row._mapping), default=str) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# One page of parts, filtered by store, type and name prefix
+@api.route('/parts', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store', 'part_type'))
+def parts():
+    return page_response(dbm.get_parts_page(part_store_name=request.args.get('store'),
+                                            part_type=request.args.get('type'),
+                                            name=request.args.get('name'), **page_args(request.args)))
+
+
+# Up to limit (default 20) parts matching every word of q in their name, part number, store or type name,
+# best matches first. Backs the typeahead on the parts page
+@api.route('/parts/search', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store', 'part_type'))
+def search_parts():
+    return jsonify(items=to_dicts(dbm.search_parts(request.args.get('q', ''),
+                                                   clamp_limit(request.args.get('limit', 20)))))
+
+
+# Every part, streamed as NDJSON
+@api.route('/parts/export', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store', 'part_type'))
+def export_parts():
+    return ndjson_response(dbm.stream_parts())
+
+
+# Every part, streamed as CSV in the import format
+@api.route('/parts/export.csv', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store', 'part_type'))
+def export_parts_as_csv():
+    return Response(stream_with_context(export_parts_csv()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=parts.csv'})
+
+
+# Bulk import parts from CSV, sent as a 'file' upload or as a text/csv body. Scripts authenticate with
+# 'Authorization: Bearer <api_token>', browsers with an admin session and a CSRF token
+@api.route('/parts/import', methods=['POST'])
+@admin_or_token_required
+def import_parts():
+    # Decoded by a stream reader, the spooled temporary files large uploads are kept in aren't io objects
+    # TextIOWrapper can wrap before Python 3.11
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    report = import_parts_csv(getreader('utf-8-sig')(stream))
+
+    return jsonify(report), 200 if not report['errors'] else 422
+
+
+# Parts below their low stock threshold
+@api.route('/parts/low', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store'))
+def low_parts():
+    return jsonify(items=to_dicts(dbm.get_low_parts()))
+
+
+# Number of low parts in each part store
+@api.route('/parts/low/counts', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store'))
+def low_part_counts():
+    return jsonify(dbm.get_low_part_counts() or {})
+
+
+# Parts whose amount was changed outside of jobs since their latest ledger line
+@api.route('/parts/audit', methods=['GET'])
+@admin_login_required
+@conditional(('parts', 'jobs'))
+def audit_parts():
+    return jsonify(items=to_dicts(dbm.audit_stock()))
+
+
+# One page of a part's ledger lines, newest first, with the units consumed and added within since/until
+@api.route('/parts/<int:part_id>/ledger', methods=['GET'])
+@login_required
+@conditional(('parts', 'jobs'))
+def part_ledger(part_id):
+    dates = date_args(request.args)
+    rows, next_cursor = dbm.get_part_ledger_page(part_id, **dates, **page_args(request.args, default_descending=True)) \
+        or ([], None)
+
+    return jsonify(items=to_dicts(rows), next_cursor=next_cursor, **(dbm.get_part_consumption(part_id, **dates) or {}))
+
+
+# A single part by id
+@api.route('/parts/<int:part_id>', methods=['GET'])
+@login_required
+@conditional(('parts', 'part_store', 'part_type'))
+def part(part_id):
+    results = to_dicts(dbm.get_part_information(part_id))
+
+    if not results:
+        return jsonify(error='404: Not Found'), 404
+    return jsonify(results[0])
+
+
+# Dashboard statistics over the last ?days= days (default 30), with the ?top= most used parts (default 10)
+@api.route('/stats', methods=['GET'])
+@login_required
+@conditional(('jobs', 'parts', 'part_store', 'part_type'), key=date.today)
+def stats():
+    days = max(1, min(request.args.get('days', 30, type=int), 366))
+    top = max(1, min(request.args.get('top', 10, type=int), 100))
+    results = dbm.get_dashboard_stats(days=days, top=top) or {}
+
+    return jsonify(days=days, **{key: to_dicts(rows) for key, rows in results.items()})
+
+
+# Every part store
+@api.route('/part_stores', methods=['GET'])
+@login_required
+@conditional(('part_store',))
+def part_stores():
+    return jsonify(items=to_dicts(dbm.get_part_store_names()))
+
+
+# Every part type
+@api.route('/part_types', methods=['GET'])
+@login_required
+@conditional(('part_type',))
+def part_types():
+    return jsonify(items=to_dicts(dbm.get_part_types()))
+
+
+# One page of jobs, newest first, filtered by store, user and since/until, from the archive with ?archived=true
+@api.route('/jobs', methods=['GET'])
+@login_required
+@conditional(('jobs', 'part_store'))
+def jobs():
+    return page_response(dbm.get_jobs_page(part_store_name=request.args.get('store'),
+                                           username=request.args.get('user'),
+                                           archived=request.args.get('archived') == 'true',
+                                           **date_args(request.args),
+                                           **page_args(request.args, default_descending=True)))
+
+
+# Every job, streamed as NDJSON
+@api.route('/jobs/export', methods=['GET'])
+@login_required
+@conditional(('jobs', 'part_store'))
+def export_jobs():
+    return ndjson_response(dbm.stream_jobs())
+
+
+# Server-Sent Events of the rows changed by every write from now on (or after the Last-Event-ID a browser
+# reconnects with): change events of {table, inserted, updated, deleted} or {table, reload}, and a reload
+# event when changes were missed. Streams end after change_feed_stream_seconds and browsers reconnect
+@api.route('/changes', methods=['GET'])
+@login_required
+def changes():
+    if not change_feed.subscribe():
+        return jsonify(error='503: Too many open change streams'), 503
+
+    response = Response(change_feed.events(request.headers.get('Last-Event-ID', type=int)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(change_feed.unsubscribe)
+    return response
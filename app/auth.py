@@ -0,0 +1,61 @@
+from os import environ
+from time import time
+
+from flask import session
+
+from app.database.TableVersions import table_versions
+
+# Seconds the admin/confirmed flags cached in the signed session are trusted before they are re-read
+auth_ttl = int(environ.get('auth_cache_ttl', 300))
+
+
+# Version of the accounts table every process shares, bumped by the commit of every change to an account,
+# or None when it can't be read
+def accounts_version() -> int or None:
+    versions = table_versions.get()
+    return versions.get('accounts', (0, None))[0] if versions is not None else None
+
+
+# Cache the account's flags and auth version in the signed session. version is the accounts version read before
+# the account was, so a change committed in between makes the flags stale
+def store_auth(account, version: int or None) -> None:
+    session['user_id'] = account.id
+    session['is_admin'] = bool(account.is_admin)
+    session['is_confirmed'] = bool(account.is_confirmed)
+    session['auth_version'] = account.auth_version or 0
+    session['accounts_version'] = version
+    session['auth_checked'] = time()
+
+
+# Drop the cached flags (and the login) from the session
+def clear_auth() -> None:
+    for key in ('logged_in', 'username', 'user_id', 'is_admin', 'is_confirmed', 'auth_version', 'accounts_version',
+                'auth_checked'):
+        session.pop(key, None)
+
+
+# The cached flags are stale once an account changed in any process since they were read (the accounts version
+# moved), or once the ttl has passed
+def auth_is_stale(version: int or None) -> bool:
+    return version is None or version != session.get('accounts_version') \
+        or time() - session.get('auth_checked', 0) > auth_ttl
+
+
+# Re-read the flags of the logged in account when they are stale, logging it out if it was removed or unconfirmed
+def refresh_auth(dbm) -> None:
+    if 'logged_in' not in session:
+        return
+
+    version = accounts_version()
+    if not auth_is_stale(version):
+        return
+
+    account = dbm.get_credentials(session['username'])
+
+    if account is None or not account.is_confirmed:
+        clear_auth()
+    elif account.auth_version != session.get('auth_version') or account.id != session.get('user_id'):
+        store_auth(account, version)
+    else:
+        session['accounts_version'] = version
+        session['auth_checked'] = time()
@@ -0,0 +1,78 @@
+from time import perf_counter
+
+import click
+
+from app import decorators
+from app.database.JobArchive import archive_jobs, retention_days
+from app.database.PartsCsv import export_parts_csv, import_parts_csv
+from app.database.migrations import current_version, is_empty, migrate, migration_modules, pending_migrations
+
+
+# Bulk import parts from a CSV file
+@click.command('import-parts')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per multi-row INSERT.')
+def import_parts_command(csv_file, batch_size):
+    report = import_parts_csv(csv_file, batch_size=batch_size)
+
+    for error in report['errors']:
+        click.echo(f'Line {error["line"]}: {error["error"]}', err=True)
+    click.echo(f'Inserted {report["inserted"]} of {report["rows"]} rows in {report["seconds"]}s '
+               f'({report["rows_per_second"]} rows/s)')
+
+
+# Export every part to a CSV file (or stdout)
+@click.command('export-parts')
+@click.argument('csv_file', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows fetched per server side cursor batch.')
+def export_parts_command(csv_file, batch_size):
+    start = perf_counter()
+    rows = -1
+
+    for chunk in export_parts_csv(batch_size=batch_size):
+        rows += chunk.count('\n')
+        csv_file.write(chunk)
+
+    seconds = perf_counter() - start
+    click.echo(f'Exported {rows} rows in {seconds:.3f}s ({round(rows / seconds) if seconds else rows} rows/s)', err=True)
+
+
+# Apply the pending schema migrations, converting existing rows in batches. An empty database gets the schema
+@click.command('migrate')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows converted per transaction.')
+@click.option('--target', type=int, help='Stop after this migration version.')
+@click.option('--status', is_flag=True, help='Only show the current version and the pending migrations.')
+def migrate_command(batch_size, target, status):
+    try:
+        if status:
+            click.echo(f'Current version: {current_version(decorators.engine)}')
+            if is_empty(decorators.engine):
+                click.echo(f'Empty database, migrating creates the schema at version {len(migration_modules)}')
+            for version, module in pending_migrations(decorators.engine):
+                click.echo(f'Pending: {version:04d} {module.name}')
+            return
+
+        start = perf_counter()
+        applied = migrate(decorators.engine, target=target, batch_size=batch_size, log=click.echo)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f'Applied {len(applied)} migrations in {perf_counter() - start:.3f}s, '
+               f'now at version {current_version(decorators.engine)}')
+
+
+# Move jobs older than the retention window into the compressed jobs_archive table
+@click.command('archive-jobs')
+@click.option('--days', default=retention_days, show_default=True, help='Keep jobs newer than this many days.')
+@click.option('--batch-size', default=1000, show_default=True, help='Jobs moved per transaction.')
+def archive_jobs_command(days, batch_size):
+    report = archive_jobs(days=days, batch_size=batch_size, log=click.echo)
+    click.echo(f'Archived {report["archived"]} jobs from before {report["cutoff"]} in {report["seconds"]}s')
+
+
+# Register the command line commands on the Flask app
+def init_app(app) -> None:
+    app.cli.add_command(import_parts_command)
+    app.cli.add_command(export_parts_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(archive_jobs_command)
@@ -0,0 +1,87 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import wraps
+from hashlib import sha1
+from pathlib import Path
+from threading import Lock
+
+from flask import Response, make_response, request, session
+
+from app.database.TableVersions import table_versions
+
+# Responses of conditional views by result
+counts = defaultdict(int)
+counts_lock = Lock()
+
+
+# Hash of the app's code and templates, part of every ETag so a deploy never answers 304 with old markup
+def release_hash() -> str:
+    digest = sha1()
+
+    for source in sorted(Path(__file__).parent.rglob('*')):
+        if source.suffix in ('.py', '.html'):
+            digest.update(source.read_bytes())
+    return digest.hexdigest()
+
+
+release = release_hash()
+
+
+# Whether the client's copy is current. If-None-Match wins when both are sent, If-Modified-Since
+# alone can't tell apart the logged in users, only the Vary: Cookie header of the response does
+def is_not_modified(etag: str, last_modified: datetime or None) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    return last_modified is not None and request.if_modified_since is not None \
+        and last_modified.replace(tzinfo=timezone.utc) <= request.if_modified_since
+
+
+# Answer GET requests with 304 Not Modified while the tables a view reads are unchanged, without calling it.
+# tables is a tuple of table names, or a function of the view's arguments returning one (None for views
+# that are never cached). The ETag is made of their versions, the URL with its query string, the logged in
+# user and their role, and key() when a view also depends on something else, like the current date
+def conditional(tables, key=None):
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            names = tables(**kwargs) if callable(tables) else tables
+            versions = table_versions.get() if names and request.method == 'GET' else None
+
+            if versions is None:
+                return func(*args, **kwargs)
+
+            current = [versions.get(name, (0, None)) for name in names]
+            etag = sha1(repr((release, request.full_path, session.get('username'), session.get('is_admin'),
+                              [version for version, _ in current], key() if key else None)).encode()).hexdigest()
+
+            # Changes within the same second share a Last-Modified, it is only sent once that second passed
+            last_modified = max((changed_at for _, changed_at in current if changed_at), default=None)
+            if last_modified is not None and last_modified >= datetime.utcnow().replace(microsecond=0):
+                last_modified = None
+
+            if is_not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            with counts_lock:
+                counts['not_modified' if response.status_code == 304 else 'modified'] += 1
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+# Conditional responses by result
+def stats() -> dict:
+    with counts_lock:
+        return dict(counts)
@@ -0,0 +1,100 @@
+from asyncio import gather, new_event_loop, run_coroutine_threadsafe
+from contextvars import copy_context
+from os import environ
+from threading import Lock, Thread
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app.database.DatabaseManipulator import DatabaseManipulator
+from app.decorators import current_session, database_url, pool_settings, set_sqlite_pragmas
+
+
+# URL of the database on an asyncio driver: async_database_url, or database_url on aiosqlite or async_driver
+def async_database_url() -> str:
+    url = environ.get('async_database_url') or database_url()
+    drivers = {'sqlite:': 'sqlite+aiosqlite:', 'mysql+pymysql:': f'mysql+{environ.get("async_driver", "aiomysql")}:'}
+
+    for sync, driver in drivers.items():
+        if url.startswith(sync):
+            return driver + url[len(sync):]
+    return url
+
+
+# DatabaseManipulator on an asyncio driver. Every method of dbm is available as a coroutine that runs the same
+# code on a session of its own, its queries awaited on the async driver through SQLAlchemy's greenlet bridge,
+# so independent reads run concurrently. The coroutines run on one event loop per process, in a background
+# thread that owns the connection pool, and gather() runs a batch of them from the synchronous views
+class AsyncDatabaseManipulator:
+    def __init__(self, dbm: DatabaseManipulator, url: str = None, enabled: bool = False):
+        self.dbm = dbm
+        self.url = url
+        self.enabled = enabled
+        self._engine = None
+        self._loop = None
+        self._lock = Lock()
+
+    # The async engine, created on first use. SQLite doesn't pool connections, each gets the pragmas
+    @property
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                url = self.url or async_database_url()
+                self._engine = create_async_engine(url, **({} if url.startswith('sqlite') else pool_settings))
+                if url.startswith('sqlite'):
+                    event.listen(self._engine.sync_engine, 'connect', set_sqlite_pragmas)
+            return self._engine
+
+    # The event loop the coroutines run on, started on first use
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = new_event_loop()
+                Thread(target=self._loop.run_forever, name='async-database', daemon=True).start()
+            return self._loop
+
+    # Point the layer at another database, like the benchmarks' throwaway one
+    def configure(self, url: str) -> None:
+        with self._lock:
+            self.url, self._engine = url, None
+
+    # Runs inside the greenlet of a session, every database call of func uses that session
+    @staticmethod
+    def _call(session, context, func, args, kwargs):
+        def call():
+            current_session.set(session)
+            return func(*args, **kwargs)
+
+        return context.run(call)
+
+    # Run func(*args, **kwargs) on a session of its own and commit it. context is the copy of the caller's
+    # context (like the Flask request) func runs in, defaults to the one running the coroutine
+    async def run(self, func, *args, context=None, **kwargs):
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            result = await session.run_sync(self._call, context or copy_context(), func, args, kwargs)
+            if not session.sync_session.info.get('failed'):
+                await session.commit()
+            return result
+
+    # dbm's methods as coroutines, awaited on the loop()
+    def __getattr__(self, name: str):
+        method = getattr(self.dbm, name)
+
+        async def coroutine(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        return coroutine
+
+    # Run calls (functions without arguments reading through dbm) at the same time, each on a session of its
+    # own, and return their results in order. They don't see the uncommitted writes of the request's session
+    def gather(self, *calls) -> list:
+        contexts = [copy_context() for _ in calls]
+
+        async def run_all():
+            return await gather(*(self.run(call, context=context) for call, context in zip(calls, contexts)))
+
+        return run_coroutine_threadsafe(run_all(), self.loop()).result()
+
+
+async_dbm = AsyncDatabaseManipulator(DatabaseManipulator(),
+                                     enabled=environ.get('async_database', 'false').lower() == 'true')
@@ -0,0 +1,317 @@
+from collections import deque
+from datetime import datetime, timedelta
+from json import dumps
+from os import environ
+from threading import Condition, Event, Thread
+from time import monotonic
+
+from sqlalchemy import delete, event, func, insert, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.database.DatabaseTables import ChangeEvent, Job, Part, PartStore, PartType, TableVersion
+from app.database.TableVersions import table_versions
+from app.decorators import new_session
+
+# Writes changing more rows than this publish one event for the whole table
+MAX_ROW_EVENTS = 500
+
+# Change events read per poll
+READ_LIMIT = 1000
+
+# Seconds a skipped event id is looked for again, its transaction may not have committed yet
+GAP_TIMEOUT = 10
+
+# Seconds between keep-alive comments on an idle stream, and before browsers reconnect a closed one
+KEEPALIVE = 15
+RETRY_MS = 3000
+
+# Seconds between the listen events a polling process writes, writers record row events while one is
+# younger than LISTEN_TIMEOUT. Writers look for one at most every LISTEN_CHECK seconds
+HEARTBEAT = 10
+LISTEN_TIMEOUT = 3 * HEARTBEAT
+LISTEN_CHECK = 5
+
+
+# The changed rows of the tables whose rows are streamed, by id
+def load_rows(connection, table_name: str, ids: list) -> dict:
+    if table_name == 'parts':
+        stmt = (select(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name,
+                       PartType.type_name.label('type'), PartType.type_unit.label('unit'), Part.low_thresh)
+                .select_from(Part).outerjoin(PartStore, Part.part_store_id == PartStore.id)
+                .outerjoin(PartType, Part.part_type_id == PartType.id).where(Part.id.in_(ids)))
+    else:
+        stmt = (select(Job.job_id.label('id'), Job.username, Job.time, PartStore.part_store_name, Job.parts_used)
+                .select_from(Job).outerjoin(PartStore, Job.part_store_id == PartStore.id).where(Job.job_id.in_(ids)))
+    return {row.id: dict(row._mapping) for row in connection.execute(stmt)}
+
+
+# One Server-Sent Event
+def sse(name: str, data: dict, event_id: int = None) -> str:
+    return (f'id: {event_id}\n' if event_id is not None else '') + f'event: {name}\ndata: {dumps(data, default=str)}\n\n'
+
+
+# Row level change feed. Writers publish the rows they change into change_events in their own transaction.
+# While a page in this process listens, one background thread polls the log every poll_interval seconds (and
+# right after writes in this process commit), loads the changed parts and jobs once and appends the rendered
+# events to a shared buffer that every open stream reads from. Tables without row events (part stores, part
+# types, accounts) and bulk writes are sent as a reload of the whole table.
+# Polling processes write a listen event every HEARTBEAT seconds, while no process polls writers only bump
+# the table versions. The poller sends a reload for a table whose version moved without any events, so
+# writes that skipped their events while a stream was opening still reach it
+class ChangeFeed:
+    def __init__(self, poll_interval: float = 1, retention_minutes: float = 10, max_clients: int = 16,
+                 stream_seconds: float = 300, buffer_size: int = 256):
+        self.poll_interval = poll_interval
+        self.retention = timedelta(minutes=retention_minutes)
+        self.max_clients = max_clients
+        self.stream_seconds = stream_seconds
+        self.batches = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._sequence = 0
+        self._cursor = None
+        self._gaps = {}
+        self._clients = 0
+        self._polling = False
+        self._versions = None
+        self._listening = False
+        self._next_listen_check = 0
+        self._next_prune = 0
+        self._wake = Event()
+        self._condition = Condition()
+
+    # Record a change to rows of a table in the session's transaction, action is insert, update or delete.
+    # row_ids=None (or too many rows) records a change to the whole table. The table's version is bumped too,
+    # the events are only recorded while a process polls them
+    def publish(self, session, table_name: str, action: str = 'update', row_ids=None) -> None:
+        table_versions.bump_on_commit(session, table_name)
+
+        if not self.listening(session):
+            return
+
+        ids = None if row_ids is None else sorted({int(i) for i in row_ids})
+        now = datetime.now().replace(microsecond=0)
+
+        if ids is None or len(ids) > MAX_ROW_EVENTS:
+            rows = [{'table_name': table_name, 'row_id': None, 'action': 'reload', 'time': now}]
+        else:
+            rows = [{'table_name': table_name, 'row_id': i, 'action': action, 'time': now} for i in ids]
+
+        if rows:
+            session.execute(insert(ChangeEvent), rows)
+            event.listen(session, 'after_commit', self._committed, once=True)
+
+    # Whether a stream is open in this process or a process polled in the last LISTEN_TIMEOUT seconds
+    def listening(self, session) -> bool:
+        if self._clients:
+            return True
+
+        if monotonic() > self._next_listen_check:
+            stmt = (select(ChangeEvent.id).where(ChangeEvent.time > datetime.now() - timedelta(seconds=LISTEN_TIMEOUT),
+                                                 ChangeEvent.action == 'listen').limit(1))
+            self._listening = session.execute(stmt).first() is not None
+            self._next_listen_check = monotonic() + LISTEN_CHECK
+        return self._listening
+
+    # Tell writers in every process that a process polls the change events
+    def _heartbeat(self) -> None:
+        connection = new_session()
+
+        try:
+            connection.execute(insert(ChangeEvent).values(table_name='change_feed', action='listen',
+                                                          time=datetime.now().replace(microsecond=0)))
+            connection.commit()
+        except SQLAlchemyError as e:
+            print(str(e))
+            connection.rollback()
+        finally:
+            connection.close()
+
+    # Poll right away for the change that just committed, and prune old events now and then
+    def _committed(self, session) -> None:
+        self._wake.set()
+
+        if monotonic() > self._next_prune:
+            self._next_prune = monotonic() + 60
+            Thread(target=self.prune, daemon=True).start()
+
+    # Delete the events older than the retention window
+    def prune(self) -> None:
+        connection = new_session()
+
+        try:
+            connection.execute(delete(ChangeEvent).where(ChangeEvent.time < datetime.now() - self.retention))
+            connection.commit()
+        except SQLAlchemyError as e:
+            print(str(e))
+            connection.rollback()
+        finally:
+            connection.close()
+
+    # Open a stream, starting the poller for the first one. False when max_clients streams are already open
+    def subscribe(self) -> bool:
+        with self._condition:
+            if self._clients >= self.max_clients:
+                return False
+
+            self._clients += 1
+            if not self._polling:
+                self._polling = True
+                Thread(target=self._poll, daemon=True).start()
+            return True
+
+    # Close a stream, the poller stops once none are left
+    def unsubscribe(self) -> None:
+        with self._condition:
+            self._clients -= 1
+
+    # Poll the change log while streams are open
+    def _poll(self) -> None:
+        next_heartbeat = 0
+
+        while True:
+            with self._condition:
+                if not self._clients:
+                    self._polling = False
+                    self._cursor = None
+                    self._versions = None
+                    return
+
+            if monotonic() > next_heartbeat:
+                next_heartbeat = monotonic() + HEARTBEAT
+                self._heartbeat()
+
+            try:
+                more = self._read()
+            except SQLAlchemyError as e:
+                print(str(e))
+                more = False
+
+            if not more:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    # Read the events after the cursor and the ones skipped over recently, and buffer them rendered as
+    # Server-Sent Events. The first read only finds the cursor. Returns whether more events are waiting
+    def _read(self) -> bool:
+        connection = new_session()
+
+        try:
+            # Versions first, the events committed with them are read after
+            versions = {row.table_name: row.version
+                        for row in connection.execute(select(TableVersion.table_name, TableVersion.version))}
+            moved = [name for name, version in versions.items()
+                     if self._versions is not None and version != self._versions.get(name)]
+
+            if self._cursor is None:
+                self._cursor = connection.execute(select(func.max(ChangeEvent.id))).scalar() or 0
+                self._versions = versions
+                return False
+
+            now = monotonic()
+            self._gaps = {i: expires for i, expires in self._gaps.items() if expires > now}
+            stmt = (select(ChangeEvent.id, ChangeEvent.table_name, ChangeEvent.row_id, ChangeEvent.action)
+                    .where(or_(ChangeEvent.id > self._cursor, ChangeEvent.id.in_(list(self._gaps))))
+                    .order_by(ChangeEvent.id).limit(READ_LIMIT))
+            rows = connection.execute(stmt).fetchall()
+
+            # The events of versions that moved may be past a full read, compare them once all are read
+            if len(rows) == READ_LIMIT:
+                moved = []
+            else:
+                self._versions = versions
+
+            if not rows and not moved:
+                return False
+
+            # Ids are handed out when a write inserts its events, a later id can commit first
+            cursor = self._cursor
+            for row in rows:
+                self._gaps.pop(row.id, None)
+                if row.id > cursor:
+                    if row.id - cursor <= READ_LIMIT:
+                        self._gaps.update({i: now + GAP_TIMEOUT for i in range(cursor + 1, row.id)})
+                    cursor = row.id
+            published = {row.table_name for row in rows}
+            text = self._render(connection, rows, cursor, [name for name in moved if name not in published])
+        finally:
+            connection.close()
+
+        # Listen events alone have nothing to send
+        with self._condition:
+            self._cursor = cursor
+            if text:
+                self._sequence += 1
+                self.batches += 1
+                self._buffer.append((self._sequence, cursor, text))
+                self._condition.notify_all()
+        return len(rows) == READ_LIMIT
+
+    # One change event per table: {table, reload} when the whole table changed (or it changed without
+    # events, reloads), otherwise the rows inserted and updated since the last read as they are now, and
+    # the ids of the deleted rows
+    def _render(self, connection, rows: list, cursor: int, reloads: list) -> str:
+        changed = {}
+
+        for row in rows:
+            if row.action == 'listen':
+                continue
+            elif row.row_id is None:
+                reloads.append(row.table_name)
+            else:
+                changed.setdefault(row.table_name, {}).setdefault(row.row_id, set()).add(row.action)
+
+        text = [sse('change', {'table': table_name, 'reload': True}, cursor) for table_name in dict.fromkeys(reloads)]
+
+        for table_name, actions in changed.items():
+            if table_name in reloads:
+                continue
+
+            current = load_rows(connection, table_name, list(actions)) if table_name in ('parts', 'jobs') else {}
+            text.append(sse('change', {
+                'table': table_name,
+                'inserted': [current[i] for i in sorted(current) if 'insert' in actions[i]],
+                'updated': [current[i] for i in sorted(current) if 'insert' not in actions[i]],
+                'deleted': sorted(i for i in actions if i not in current)}, cursor))
+        return ''.join(text)
+
+    # Server-Sent Events of every change after last_event_id, or from now on when it's None, for
+    # stream_seconds. Browsers reconnect with the last id they got, a client that missed changes (its id
+    # isn't buffered any more, or it fell behind the buffer) gets a reload event
+    def events(self, last_event_id: int = None):
+        deadline = monotonic() + self.stream_seconds
+
+        with self._condition:
+            sequence, missed = self._sequence, False
+            if last_event_id is not None and last_event_id != self._cursor:
+                positions = [position for position, cursor, _ in self._buffer if cursor == last_event_id]
+                sequence, missed = (positions[-1], False) if positions else (sequence, True)
+
+        yield f'retry: {RETRY_MS}\n\n'
+        if missed:
+            yield sse('reload', {})
+
+        while monotonic() < deadline:
+            with self._condition:
+                self._condition.wait_for(lambda: self._sequence > sequence, timeout=KEEPALIVE)
+                batches = [batch for batch in self._buffer if batch[0] > sequence]
+                behind = bool(batches) and batches[0][0] > sequence + 1
+                sequence = self._sequence
+
+            if behind:
+                yield sse('reload', {}, batches[-1][1])
+            elif batches:
+                yield ''.join(batch[2] for batch in batches)
+            else:
+                yield ': keep-alive\n\n'
+
+    # Open streams and buffered batches
+    def stats(self) -> dict:
+        with self._condition:
+            return {'clients': self._clients, 'batches': self.batches, 'cursor': self._cursor,
+                    'max_clients': self.max_clients}
+
+
+change_feed = ChangeFeed(poll_interval=float(environ.get('change_feed_poll', 1)),
+                         retention_minutes=float(environ.get('change_feed_retention', 10)),
+                         max_clients=int(environ.get('change_feed_clients', 16)),
+                         stream_seconds=float(environ.get('change_feed_stream_seconds', 300)))
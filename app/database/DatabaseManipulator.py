@@ -1,13 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import date, datetime, timedelta
+from functools import partial
 from os import environ, listdir
 from re import compile, IGNORECASE
 
 from bcrypt import gensalt, hashpw, checkpw
 from phonenumbers import is_valid_number, parse
-from requests import post
-from sqlalchemy import insert, select, update, delete, func, distinct, cast, Integer
-
-from app.database.DatabaseTables import Account, PartStore, Job, Part, PartType
-from app.decorators.flask_decorators import db_connector
+from sqlalchemy import insert, select, update, delete, func, cast, case, exists, literal, Integer
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from app.database.ChangeFeed import change_feed
+from app.database.DatabaseTables import (Account, ArchivedJob, PartStore, Job, JobLine, Part, PartType, PartTypeUsage,
+                                         PartUsage, StoreDailyUsage)
+from app.database.Pagination import keyset_page
+from app.database.PartSearch import part_search
+from app.database.ReferenceCache import reference_cache
+from app.database.Rollups import record_usage
+from app.database.TableVersions import table_versions
+from app.decorators import (current_session, new_session, pool_settings, release_request_connections, replica_session,
+                            replicas)
+from app.notifications.SmsDispatcher import sms_dispatcher
+from app.decorators.flask_decorators import db_connector, db_reader
+
+
+# Part type name and unit under the column names parts rows have always used
+part_type_name = PartType.type_name.label('type')
+part_type_unit = PartType.type_unit.label('unit')
+
+# Columns the parts and jobs pages can be sorted by
+part_sort_columns = {'id': Part.id, 'name': Part.name, 'amount': Part.amount, 'part_number': Part.part_number,
+                     'part_store_name': PartStore.part_store_name, 'type': part_type_name}
+job_sort_columns = {'job_id': Job.job_id, 'time': Job.time, 'username': Job.username,
+                    'part_store_name': PartStore.part_store_name, 'parts_used': Job.parts_used}
+archived_job_sort_columns = {'job_id': ArchivedJob.job_id, 'time': ArchivedJob.time, 'username': ArchivedJob.username,
+                             'part_store_name': ArchivedJob.part_store_name, 'parts_used': ArchivedJob.parts_used}
+
+
+# bcrypt runs on a small bounded pool instead of the request thread, so a burst of logins
+# can only keep bcrypt_workers cores busy per process
+password_pool = ThreadPoolExecutor(max_workers=int(environ.get('bcrypt_workers', 2)), thread_name_prefix='bcrypt')
+
+# Reads gathered by DatabaseManipulator.gather run on this pool, read_workers at a time per process.
+# Each holds a pooled connection while it runs, so there are always fewer than db_pool_size + db_max_overflow
+read_workers = max(1, min(int(environ.get('read_workers', 8)),
+                          pool_settings['pool_size'] + pool_settings['max_overflow'] - 1))
+read_pool = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='reads')
 
 
 # Prevent inputs that only contain spaces from being entered into the database
@@ -17,12 +55,9 @@ def check_input(test_input: str) -> bool:
     return False
 
 
-# Create MD5 hash of password to insert into database
+# Create bcrypt hash of password to insert into database
 def create_password_hash(password: bytes) -> bytes:
-    salt = gensalt()
-    hashed = hashpw(password, salt)
-    if check_password_hash(password, hashed):
-        return hashed
+    return password_pool.submit(hashpw, password, gensalt()).result()
 
 
 # Check if the password is equal to each other
@@ -32,9 +67,9 @@ def check_password(password: str, conf_password: str) -> bool:
     return False
 
 
-# Check if MD5 hash matches the password given
+# Check if bcrypt hash matches the password given
 def check_password_hash(password: bytes, my_hash: bytes) -> bool:
-    if checkpw(password, my_hash):
+    if password_pool.submit(checkpw, password, my_hash).result():
         return True
     return False
 
@@ -61,6 +96,7 @@ def check_phone_num(phone_num: str) -> bool:
 
 
 # Get the part store icon file names in the /assets/stores/ directory
+@reference_cache.cached
 def get_store_icon_names() -> list:
     items = listdir('app/static/assets/stores')
     return [i.rstrip('.svg') for i in items]
@@ -75,7 +111,84 @@ def check_if_icon_exists(icon: str) -> bool:
     return False
 
 
-@db_connector
+# Build bulk UPDATE statements adding {part_id: delta, ...} to each part's current amount with one CASE
+# expression per chunk of rows, so concurrent changes to the same parts add up instead of overwriting each other
+def bulk_delta_updates(deltas: dict, part_store_name: str, chunk_size: int = 500) -> list:
+    ids = list(deltas)
+    stmts = []
+
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        stmts.append(update(Part)
+                     .values(amount=Part.amount + case({i: deltas[i] for i in chunk}, value=Part.id, else_=0))
+                     .where(Part.id.in_(chunk), Part.part_store_id == store_id_subquery(part_store_name))
+                     .execution_options(synchronize_session=False))
+    return stmts
+
+
+# Scalar subquery resolving a part store name to its id inside the statement that uses it
+def store_id_subquery(part_store_name: str):
+    return select(PartStore.id).where(PartStore.part_store_name == part_store_name).limit(1).scalar_subquery()
+
+
+# Scalar subquery resolving a part type name to its id inside the statement that uses it
+def type_id_subquery(part_type: str):
+    return select(PartType.id).where(PartType.type_name == part_type).limit(1).scalar_subquery()
+
+
+# SELECT of part columns with the store and type joined in by id, so the names and unit can be selected
+def select_parts(*columns):
+    return (select(*columns).select_from(Part)
+            .outerjoin(PartStore, Part.part_store_id == PartStore.id)
+            .outerjoin(PartType, Part.part_type_id == PartType.id))
+
+
+# Conditions selecting a part's ledger lines within an optional since/until time range
+def ledger_filters(part_id: int, since: datetime = None, until: datetime = None) -> list:
+    filters = [JobLine.part_id == part_id]
+
+    if since:
+        filters.append(JobLine.time >= since)
+    if until:
+        filters.append(JobLine.time < until)
+    return filters
+
+
+# SELECT of the job columns with the store name joined in by id
+def select_jobs():
+    return (select(Job.job_id, Job.username, Job.time, PartStore.part_store_name, Job.parts_used)
+            .select_from(Job).outerjoin(PartStore, Job.part_store_id == PartStore.id))
+
+
+# Yield the rows of stmt in batches from a server side cursor on a session of its own (on a replica when one
+# has caught up), so exports never hold a whole table in memory or block the request's session
+def stream_rows(stmt, batch_size: int = 1000):
+    connection = replica_session(table_versions.for_request if replicas else None) or new_session()
+
+    try:
+        result = connection.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+        for partition in result.partitions(batch_size):
+            yield from partition
+    finally:
+        connection.close()
+
+
+# Run a gathered read with every database call it makes on a new session, closed once it returns.
+# The session is on a replica that has caught up with versions when there is one
+def run_on_own_session(call, versions: dict = None):
+    session = replica_session(versions) or new_session()
+    current_session.set(session)
+
+    try:
+        result = call()
+        if not session.info.get('failed'):
+            session.commit()
+        return result
+    finally:
+        session.close()
+
+
+@db_reader
 def get_current_store_name_icon(part_store_id: str, **kwargs) -> list:
     connection = kwargs.pop('connection')
     stmt = (select(PartStore.part_store_name, PartStore.icon).where(
@@ -85,17 +198,81 @@ def get_current_store_name_icon(part_store_id: str, **kwargs) -> list:
 
 
 class DatabaseManipulator:
+    # Run independent reads (functions without arguments calling this class) at the same time and return their
+    # results in order. The request's connections go back to the pool first, then the first read runs on the
+    # caller's thread and the others on the read pool, each on a pooled connection of its own in a copy of the
+    # caller's context. Reads run one after another on the caller's session when it wrote something (they
+    # have to see its writes), when gathered inside a gathered read or on the async layer's sessions, and
+    # when the pool had no connection for them in time
+    def gather(self, *calls) -> list:
+        if len(calls) < 2 or current_session.get() is not None:
+            return [call() for call in calls]
+
+        versions = table_versions.for_request() if replicas else None
+        if not release_request_connections():
+            return [call() for call in calls]
+
+        futures = [read_pool.submit(copy_context().run, run_on_own_session, call, versions) for call in calls[1:]]
+        waits = [partial(copy_context().run, run_on_own_session, calls[0], versions)] + [f.result for f in futures]
+        results = []
+
+        for call, wait in zip(calls, waits):
+            try:
+                results.append(wait())
+            except PoolTimeoutError:
+                results.append(call())
+        return results
+
     # Get all parts entries from database
-    @db_connector
+    @db_reader
     def fetchall(self, **kwargs) -> tuple:
         conn = kwargs.pop('connection')
-        stmt = conn.query(Part.id, Part.name, Part.amount,
-                          Part.part_number, Part.part_store_name, Part.type, Part.unit)
+        stmt = select_parts(Part.id, Part.name, Part.amount, Part.part_number,
+                            PartStore.part_store_name, part_type_name, part_type_unit)
         results = conn.execute(stmt).fetchall()
         return results
 
+    # Get one keyset page of parts filtered by part store, type and name prefix.
+    # Returns (rows, next_cursor), next_cursor is None on the last page
+    @db_reader
+    def get_parts_page(self, cursor: str = None, sort: str = 'id', descending: bool = False, limit: int = None,
+                       part_store_name: str = None, part_type: str = None, name: str = None, **kwargs) -> tuple:
+        connection = kwargs.pop('connection')
+        stmt = select_parts(Part.id, Part.name, Part.amount, Part.part_number,
+                            PartStore.part_store_name, part_type_name, part_type_unit)
+
+        if part_store_name:
+            stmt = stmt.where(Part.part_store_id == store_id_subquery(part_store_name))
+        if part_type:
+            stmt = stmt.where(Part.part_type_id == type_id_subquery(part_type))
+        if name:
+            stmt = stmt.where(Part.name.startswith(name, autoescape=True))
+
+        return keyset_page(connection, stmt, part_sort_columns.get(sort, Part.id), Part.id,
+                           cursor, descending, limit)
+
+    # Up to limit parts matching every word of query in their name, part number, store or type name, parts
+    # whose name starts with the query first. Matched in the in-process search index and the rows read by id.
+    # While the index is being built, parts whose name starts with the query are returned from the name index
+    @db_reader
+    def search_parts(self, query: str, limit: int = 20, **kwargs) -> list:
+        connection = kwargs.pop('connection')
+        ids = part_search.search(connection, query, limit)
+        stmt = select_parts(Part.id, Part.name, Part.amount, Part.part_number,
+                            PartStore.part_store_name, part_type_name, part_type_unit)
+
+        if ids is None:
+            stmt = stmt.where(Part.name.startswith(query.strip(), autoescape=True)).order_by(Part.name).limit(limit)
+            return connection.execute(stmt).fetchall()
+        if not ids:
+            return []
+
+        rows = {row.id: row for row in connection.execute(stmt.where(Part.id.in_(ids)))}
+        return [rows[i] for i in ids if i in rows]
+
     # Get part type names
-    @db_connector
+    @reference_cache.cached
+    @db_reader
     def get_part_type_names(self, **kwargs) -> list:
         connection = kwargs.pop('connection')
         stmt = (select(PartType.type_name))
@@ -112,7 +289,8 @@ class DatabaseManipulator:
         return results
 
     # Get all part types
-    @db_connector
+    @reference_cache.cached
+    @db_reader
     def get_part_types(self, **kwargs) -> list:
         connection = kwargs.pop('connection')
         stmt = (select(PartType.id, PartType.type_name, PartType.type_unit))
@@ -123,21 +301,14 @@ class DatabaseManipulator:
     @db_connector
     def get_part_type_by_name(self, type_name: str, **kwargs) -> list:
         connection = kwargs.pop('connection')
-        stmt = (select(Part.id, Part.name, Part.amount, Part.part_number,
-                Part.part_store_name, Part.type, Part.unit).where(Part.type == type_name))
+        stmt = (select_parts(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name,
+                             part_type_name, part_type_unit).where(Part.part_type_id == type_id_subquery(type_name)))
         results = connection.execute(stmt).fetchall()
         return results
 
     # Checks to see if the part_store_name exists in the database already
-    @db_connector
-    def check_duplicates(self, part_store_name: str, **kwargs) -> bool:
-        connection = kwargs.pop('connection')
-        stmt = (select(PartStore.part_store_name))
-        results = connection.execute(stmt).fetchall()
-        res = [i[0] for i in results]
-        if res.count(part_store_name) > 0:
-            return False
-        return True
+    def check_duplicates(self, part_store_name: str) -> bool:
+        return not self.get_dupes(PartStore.part_store_name, part_store_name)
 
     # Get password by username
     @db_connector
@@ -149,6 +320,14 @@ class DatabaseManipulator:
         fin_res = [i[2] for i in username_res]
         return fin_res
 
+    # Get the id, username, password hash, flags and auth version of an account in one query
+    @db_connector
+    def get_credentials(self, username: str, **kwargs) -> tuple or None:
+        connection = kwargs.pop('connection')
+        stmt = (select(Account.id, Account.username, Account.password, Account.is_admin,
+                       Account.is_confirmed, Account.auth_version).where(Account.username == username))
+        return connection.execute(stmt).first()
+
     # Get the unit by the part name
     @db_connector
     def get_unit_by_part(self, part_type: str, **kwargs) -> list:
@@ -170,29 +349,15 @@ class DatabaseManipulator:
             return False
         return True
 
-    # Check if duplicates exist in the database
+    # Check if a value exists in an indexed column with a single SELECT EXISTS(... LIMIT 1).
+    # The comparison is left on the bare column so the index is used; the tables' default
+    # case-insensitive collation makes the match ignore case for every caller
     @db_connector
     def get_dupes(self, query_table: object, row_to_find: str, **kwargs) -> bool:
         connection = kwargs.pop('connection')
-
-        # Use the distinct select statement in the parts DB
-        get_stores_dist = (select(distinct(query_table)).order_by(query_table))
-        dist_results = connection.execute(get_stores_dist).fetchall()
-
-        # List the results in an array
-        fin_dist = [i[0] for i in dist_results]
-
-        # Use the list of duplicates to see if the part store exists in the part store DB
-        get_duplicates = (select(query_table))
-        dupe_results = connection.execute(get_duplicates).fetchall()
-
-        # List the results in an array
-        fin_dupes = [i[0] for i in dupe_results]
-
-        # If the part_store_name exists in either database, return True; otherwise return False
-        if fin_dist.count(row_to_find) > 0 or row_to_find in fin_dupes:
-            return True
-        return False
+        stmt = select(exists(select(literal(1)).where(query_table == row_to_find).limit(1)))
+        result = connection.execute(stmt).scalar()
+        return bool(result)
 
     # Check if the part store exists and has a part within it from either the parts or part store DB
     def check_if_exists(self, part_store_name: str) -> bool:
@@ -206,18 +371,19 @@ class DatabaseManipulator:
     @db_connector
     def insert_part_store(self, part_store_name: str, part_store_icon: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
         if check_input(part_store_name) and check_input(part_store_icon):
+            change_feed.publish(connection, 'part_store')
             stmt = (insert(PartStore).values(
                 part_store_name=part_store_name, icon=part_store_icon))
             connection.execute(stmt)
-            connection.commit()
 
     # Get all part stores by part store name
-    @db_connector
-    def get_part_stores(selfself, part_store_name: int, **kwargs) -> tuple or None:
+    @db_reader
+    def get_part_stores(self, part_store_name: int, **kwargs) -> tuple or None:
         connection = kwargs.pop('connection')
-        stmt = select(Part.id, Part.name, Part.amount, Part.part_number, Part.part_store_name,
-                      Part.type, Part.unit).where(Part.part_store_name == part_store_name)
+        stmt = select_parts(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name,
+                            part_type_name, part_type_unit).where(Part.part_store_id == store_id_subquery(part_store_name))
         results = connection.execute(stmt).fetchall()
 
         # If the results are empty (i.e. the part_store_name doesn't exist) return None
@@ -226,7 +392,8 @@ class DatabaseManipulator:
         return results
 
     # Get list of part store names that exist in the database
-    @db_connector
+    @reference_cache.cached
+    @db_reader
     def get_part_store_names(self, **kwargs) -> tuple:
         connection = kwargs.pop('connection')
         stmt = select(PartStore.id, PartStore.part_store_name, PartStore.icon) \
@@ -246,20 +413,22 @@ class DatabaseManipulator:
         connection = kwargs.pop('connection')
         if check_input(part_name) and check_input(part_amount) and part_amount.isnumeric() and check_input(part_number) and check_input(part_store_name) and check_input(part_type):
             stmt = (insert(Part).values(name=part_name, amount=part_amount, part_number=part_number,
-                                        part_store_name=part_store_name, type=part_type,
-                                        unit=self.get_unit_by_part(part_type)))
-            connection.execute(stmt)
-            connection.commit()
+                                        part_store_id=store_id_subquery(part_store_name),
+                                        part_type_id=type_id_subquery(part_type)))
+            inserted = connection.execute(stmt).inserted_primary_key
+            part_search.changed_on_commit(connection, inserted)
+            change_feed.publish(connection, 'parts', 'insert', inserted)
 
     # Insert part type into the database
     @db_connector
     def insert_part_type(self, part_type: str, part_unit: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
         if check_input(part_type) and check_input(part_unit) and not self.check_if_type_exists(part_type):
+            change_feed.publish(connection, 'part_type')
             stmt = (insert(PartType).values(
                 type_name=part_type, type_unit=part_unit))
             connection.execute(stmt)
-            connection.commit()
 
      # Make sure the phone number is not in the database
     @db_connector
@@ -272,60 +441,60 @@ class DatabaseManipulator:
             return True
         return False
 
-    # Send text to the username supplied with the amount of low parts in the system
+    # Queue a text to the username supplied with the low parts in the system.
+    # The SMS dispatcher sends it in the background, repeated alerts for the same user are coalesced
     @db_connector
     def send_text(self, username: str, **kwargs) -> bool:
         connection = kwargs.pop('connection')
 
         # Get the phone number by username
         stmt = (select(Account.phone_num).where(Account.username == username))
-        phone_num = [i[0] for i in connection.execute(stmt).fetchall()]
+        phone_num = connection.execute(stmt).scalar()
+
+        if not phone_num:
+            return False
 
         # Line to separate each row for readability
         line = '-' * 20
-        low_parts = ['Part Name: ' + str(i[1]) + ' \nPart Number: ' + str(i[3]) + '\nPart Store Name: ' + str(i[4]) +
-                     '\nCurrent Amount: ' +
-                     str(i[2]) + '\nPart Threshold: ' + str(i[5]) + '\n' + line
-                     for i in self.get_low_parts()]
+        low_parts = [f'Part Name: {i[1]} \nPart Number: {i[3]}\nPart Store Name: {i[4]}\n'
+                     f'Current Amount: {i[2]}\nPart Threshold: {i[5]}\n{line}'
+                     for i in self.get_low_parts() or []]
         message = line + '\n' + '\n'.join(low_parts)
 
-        # Send the message
-        send = post(url=environ.get('TILL_URL'),
-                    headers={'Content-Type': 'application/json'},
-                    json={'phone': ['1' + phone_num[0]],
-                          'method': 'SMS',
-                          'text': message})
-
-        if send.status_code == 200:
-            return True
-        return False
+        sms_dispatcher.enqueue(phone_num, message, key='low_parts')
+        return True
 
     # Delete part type from database by ID
     @db_connector
     def delete_part_type(self, type_id: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
+        part_search.changed_on_commit(connection)
+        change_feed.publish(connection, 'part_type')
+        change_feed.publish(connection, 'parts')
         stmt = (delete(PartType).where(PartType.id == type_id))
         connection.execute(stmt)
-        connection.commit()
 
     # Update part type
     @db_connector
     def update_part_type(self, type_id: str, type_name: str, type_unit: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
 
         if check_input(type_name) and check_input(type_unit) and not self.check_if_type_exists(type_name.lower()):
+            part_search.changed_on_commit(connection)
+            change_feed.publish(connection, 'part_type')
             stmt = (update(PartType).values(type_name=type_name,
                     type_unit=type_unit).where(PartType.id == type_id))
             connection.execute(stmt)
-            connection.commit()
 
     # Get part information by part id
-    @db_connector
+    @db_reader
     def get_part_information(self, part_id: str, **kwargs) -> tuple:
         connection = kwargs.pop('connection')
         stmt = (
-            select(Part.id, Part.name, Part.amount, Part.part_number, Part.part_store_name, Part.low_thresh, Part.type,
-                   Part.unit).where(Part.id == part_id))
+            select_parts(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name, Part.low_thresh,
+                         part_type_name, part_type_unit).where(Part.id == part_id))
         results = connection.execute(stmt).fetchall()
         return results
 
@@ -333,56 +502,80 @@ class DatabaseManipulator:
     @db_connector
     def delete(self, row_id: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        part_search.changed_on_commit(connection, [row_id])
+        change_feed.publish(connection, 'parts', 'delete', [row_id])
         stmt = (delete(Part).where(Part.id == int(row_id)))
         connection.execute(stmt)
-        connection.commit()
 
     # Update entries from database by ID
     @db_connector
-    def update(self, row_id: str, part_name: str, part_amount: str, part_number: str, part_store_name: str, part_type: str, **kwargs) -> None:
+    def update(self, row_id: str, part_name: str, part_amount: str, part_number: str, part_store_name: str, part_type: str,
+               original_amount: str = None, **kwargs) -> int:
         connection = kwargs.pop('connection')
-        stmt = (update(Part).values(name=part_name, amount=part_amount,
-                                    part_number=part_number, part_store_name=part_store_name,
-                                    type=part_type, unit=self.get_unit_by_part(part_type))
-                .where(Part.id == row_id))
+        amount, filters = part_amount, [Part.id == row_id]
+
+        # With the amount the form was filled in with, apply the edit as a change to the current amount so
+        # jobs submitted meanwhile are kept. Returns 409 if they left too little stock for the change, 404 if the
+        # part was deleted meanwhile
+        if original_amount is not None and str(original_amount).isnumeric() and str(part_amount).isnumeric():
+            amount = Part.amount + (int(part_amount) - int(original_amount))
+            filters.append(amount >= 0)
+
+        stmt = (update(Part).values(name=part_name, amount=amount, part_number=part_number,
+                                    part_store_id=store_id_subquery(part_store_name),
+                                    part_type_id=type_id_subquery(part_type))
+                .where(*filters).execution_options(synchronize_session=False))
 
         if check_input(part_name) and check_input(part_amount) and check_input(part_number) and check_input(part_store_name) and check_input(part_type):
-            connection.execute(stmt)
-            connection.commit()
+            # Only an edit that changed a row is indexed and published, a refused one leaves no trace
+            if connection.execute(stmt).rowcount:
+                part_search.changed_on_commit(connection, [row_id])
+                change_feed.publish(connection, 'parts', 'update', [row_id])
+            elif not connection.execute(select(exists().where(Part.id == row_id))).scalar():
+                return 404
+            elif len(filters) > 1:
+                return 409
+        return 200
 
     # Delete part store by part_store_id
     @db_connector
     def delete_part_store(self, part_store_id: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
+        part_search.changed_on_commit(connection)
+        for table_name in ('part_store', 'parts', 'jobs'):
+            change_feed.publish(connection, table_name)
         stmt = (delete(PartStore).where(PartStore.id == part_store_id))
         connection.execute(stmt)
-        connection.commit()
 
     # Update part_store by part_store_id
     @db_connector
     def update_part_store(self, part_store_id: str, part_store_name: str, part_store_image: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        reference_cache.invalidate_on_commit(connection)
         current_name, current_icon = get_current_store_name_icon(part_store_id)
 
-        # Check for duplicates and validate input
+        # Check for duplicates and validate input, only a change that passes is published
         if part_store_name == current_name and part_store_image != current_icon \
                 and check_if_icon_exists(part_store_image):
             stmt = (update(PartStore).values(icon=part_store_image)
                     .where(PartStore.id == part_store_id))
             connection.execute(stmt)
-            connection.commit()
+            change_feed.publish(connection, 'part_store')
         elif part_store_name != current_name and part_store_image == current_icon and \
                 check_input(part_store_name) and self.check_duplicates(part_store_name):
             stmt = (update(PartStore).values(part_store_name=part_store_name)
                     .where(PartStore.id == part_store_id))
             connection.execute(stmt)
-            connection.commit()
+            part_search.changed_on_commit(connection)
+            change_feed.publish(connection, 'part_store')
         else:
             if check_input(part_store_name) and self.check_duplicates(part_store_name):
                 stmt = (update(PartStore).values(part_store_name=part_store_name, icon=part_store_image)
                         .where(PartStore.id == part_store_id))
                 connection.execute(stmt)
-                connection.commit()
+                part_search.changed_on_commit(connection)
+                change_feed.publish(connection, 'part_store')
 
     # Update part's threshold
     @db_connector
@@ -390,17 +583,54 @@ class DatabaseManipulator:
         connection = kwargs.pop('connection')
         stmt = (update(Part).values(low_thresh=thresh).where(Part.id == part_id))
         connection.execute(stmt)
-        connection.commit()
+        change_feed.publish(connection, 'parts', 'update', [part_id])
 
     # Get table of low parts
-    @db_connector
+    @db_reader
     def get_low_parts(self, **kwargs) -> tuple:
         connection = kwargs.pop('connection')
-        stmt = (select(Part.id, Part.name, Part.amount, Part.part_number, Part.part_store_name, Part.low_thresh)
-                .where(Part.low_thresh > Part.amount))
+        stmt = (select_parts(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name,
+                             Part.low_thresh).where(Part.is_low == 1))
         results = connection.execute(stmt).fetchall()
         return results
 
+    # Get the number of low parts in each part store
+    @db_reader
+    def get_low_part_counts(self, **kwargs) -> dict:
+        connection = kwargs.pop('connection')
+        counts = (select(Part.part_store_id, func.count().label('low'))
+                  .where(Part.is_low == 1).group_by(Part.part_store_id).subquery())
+        stmt = select(PartStore.part_store_name, counts.c.low).join(counts, counts.c.part_store_id == PartStore.id)
+        results = connection.execute(stmt).fetchall()
+        return {i[0]: i[1] for i in results}
+
+    # Dashboard aggregates: stock per store, jobs and parts used per store per day over the last days,
+    # units used per part type and the top most used parts. Usage comes from the rollup tables, so the
+    # cost depends on the number of stores, days and parts and not on the size of the job history
+    @db_reader
+    def get_dashboard_stats(self, days: int = 30, top: int = 10, **kwargs) -> dict:
+        connection = kwargs.pop('connection')
+        since = date.today() - timedelta(days=days - 1)
+
+        stock = (select(PartStore.part_store_name, func.count(Part.id).label('parts'),
+                        func.coalesce(func.sum(Part.amount), 0).label('units'))
+                 .select_from(PartStore).outerjoin(Part, Part.part_store_id == PartStore.id)
+                 .group_by(PartStore.id, PartStore.part_store_name).order_by(PartStore.part_store_name))
+        usage = (select(StoreDailyUsage.day, PartStore.part_store_name, StoreDailyUsage.jobs,
+                        StoreDailyUsage.parts_used)
+                 .join(PartStore, StoreDailyUsage.part_store_id == PartStore.id)
+                 .where(StoreDailyUsage.day >= since).order_by(StoreDailyUsage.day, PartStore.part_store_name))
+        types = (select(PartType.type_name, PartType.type_unit, PartTypeUsage.units_used)
+                 .join(PartTypeUsage, PartTypeUsage.part_type_id == PartType.id)
+                 .order_by(PartTypeUsage.units_used.desc()))
+        top_parts = (select(Part.id, Part.name, Part.part_number, PartStore.part_store_name, PartUsage.units_used)
+                     .select_from(PartUsage).join(Part, PartUsage.part_id == Part.id)
+                     .outerjoin(PartStore, Part.part_store_id == PartStore.id)
+                     .order_by(PartUsage.units_used.desc()).limit(top))
+
+        return {'stock': connection.execute(stock).fetchall(), 'usage': connection.execute(usage).fetchall(),
+                'types': connection.execute(types).fetchall(), 'top_parts': connection.execute(top_parts).fetchall()}
+
     # Check if account is confirmed
     @db_connector
     def check_if_confirmed(self, username: str, **kwargs) -> bool:
@@ -418,9 +648,9 @@ class DatabaseManipulator:
     def confirm_account(self, user_id: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
         stmt = (update(Account).values(
-            {'is_confirmed': 1}).where(Account.id == user_id))
+            {'is_confirmed': 1, 'auth_version': Account.auth_version + 1}).where(Account.id == user_id))
         connection.execute(stmt)
-        connection.commit()
+        change_feed.publish(connection, 'accounts')
 
     # Delete account by ID
     @db_connector
@@ -428,15 +658,15 @@ class DatabaseManipulator:
         connection = kwargs.pop('connection')
         stmt = (delete(Account).where(Account.id == user_id))
         connection.execute(stmt)
-        connection.commit()
+        change_feed.publish(connection, 'accounts')
 
-    # Login by username and password
-    def login(self, username: str, password: str) -> bool:
-        hash_pw = self.get_password_by_username(username)
-        if hash_pw and check_password_hash(password.encode('utf8'), hash_pw[0].encode('utf8')) \
-                and self.check_if_account_exists(username) and self.check_if_confirmed(username):
-            return True
-        return False
+    # Login by username and password, returning the account's credentials row or None
+    def login(self, username: str, password: str) -> tuple or None:
+        account = self.get_credentials(username)
+        if account and account.is_confirmed and account.password \
+                and check_password_hash(password.encode('utf8'), account.password.encode('utf8')):
+            return account
+        return None
 
     # Register by username, password, and conf_password
     @db_connector
@@ -444,14 +674,13 @@ class DatabaseManipulator:
         connection = kwargs.pop('connection')
 
         if check_password(password, conf_password) and check_input(password) and check_input(conf_password) and not self.check_if_account_exists(username) and not self.check_if_phone_num_exists(phone_num):
-            hashed_pw = create_password_hash(password.encode('utf-8'))
-
-            if check_password_hash(password.encode('utf-8'), hashed_pw) and check_phone_num(phone_num):
+            if check_phone_num(phone_num):
+                hashed_pw = create_password_hash(password.encode('utf-8'))
                 stmt = (insert(Account).values(username=username,
-                        password=hashed_pw, phone_num=phone_num))
+                        password=hashed_pw.decode('utf8'), phone_num=phone_num))
 
                 connection.execute(stmt)
-                connection.commit()
+                change_feed.publish(connection, 'accounts')
                 return 200
             return 422
         return 409
@@ -461,7 +690,7 @@ class DatabaseManipulator:
     def check_admin(self, username: str, **kwargs) -> bool:
         connection = kwargs.pop('connection')
         stmt = (select(Account.is_admin).where(
-            func.lower(Account.username) == username))
+            Account.username == username))
         results = connection.execute(stmt).fetchone()
         res = ''.join(map(str, str(results[0])))
         return True if int(res) == 1 else False
@@ -471,9 +700,9 @@ class DatabaseManipulator:
     def modify_admin(self, user_id: str, value: str or int, **kwargs) -> None:
         connection = kwargs.pop('connection')
         stmt = (update(Account).values(
-            is_admin=value).where(Account.id == user_id))
+            is_admin=value, auth_version=Account.auth_version + 1).where(Account.id == user_id))
         connection.execute(stmt)
-        connection.commit()
+        change_feed.publish(connection, 'accounts')
 
     # Get users that exist in the DB excluding the current user's username
     @db_connector
@@ -489,49 +718,173 @@ class DatabaseManipulator:
         return res
 
     # Get parts by part store name
-    @db_connector
+    @db_reader
     def get_parts_by_store(self, part_store_name: str, **kwargs) -> tuple:
         connection = kwargs.pop('connection')
         stmt = (select(Part.id, Part.name, Part.amount, Part.part_number)
-                .where(Part.part_store_name == part_store_name))
+                .where(Part.part_store_id == store_id_subquery(part_store_name)))
         results = connection.execute(stmt).fetchall()
         return results
 
-    # Update multiple parts according to the part store name
+    # Add {part_id: delta, ...} to the amounts of parts in the part store
     @db_connector
-    def update_multiple_parts_by_part_store(self, values: list, **kwargs) -> None:
+    def update_multiple_parts_by_part_store(self, deltas: dict, part_store_name: str, **kwargs) -> None:
         connection = kwargs.pop('connection')
 
-        for item in values:
-            stmt = (update(Part).values(
-                amount=item[0]).where(Part.id == item[1]))
+        for stmt in bulk_delta_updates(deltas, part_store_name):
             connection.execute(stmt)
-            connection.commit()
+        change_feed.publish(connection, 'parts', 'update', deltas)
+
+    # Apply a job's {part_id: delta, ...} stock changes as relative bulk updates and record the job, one job_lines
+    # row per changed part and the usage rollups in the same transaction. Returns (units taken out of stock,
+    # conflicts), increases are ledgered but not counted. If jobs submitted at the same time left a part with
+    # less than this job takes, its changes are reverted and nothing is recorded, conflicts then lists
+    # those parts with the amount still available. Conflicts aren't retried: relative updates already apply
+    # on top of every job committed before, so a conflict means the stock ran out and a retry would fail again
+    @db_connector
+    def submit_job(self, username: str, time: datetime, part_store_name: str, deltas: dict, **kwargs) -> tuple:
+        connection = kwargs.pop('connection')
+        deltas = {int(part_id): int(delta) for part_id, delta in deltas.items() if int(delta)}
+
+        if not deltas:
+            return 0, []
+
+        for stmt in bulk_delta_updates(deltas, part_store_name):
+            connection.execute(stmt)
+
+        # The updated rows stay locked until commit, so these are the amounts this job left
+        stmt = (select(Part.id, Part.name, Part.amount, Part.part_type_id, Part.part_store_id)
+                .where(Part.id.in_(list(deltas)), Part.part_store_id == store_id_subquery(part_store_name)))
+        changed = connection.execute(stmt).fetchall()
+
+        if not changed:
+            return 0, []
+
+        conflicts = [{'id': row.id, 'name': row.name, 'available': row.amount - deltas[row.id],
+                      'requested': -deltas[row.id]} for row in changed if row.amount < 0]
+        if conflicts:
+            for stmt in bulk_delta_updates({row.id: -deltas[row.id] for row in changed}, part_store_name):
+                connection.execute(stmt)
+            return 0, conflicts
+
+        parts_used = sum(-deltas[row.id] for row in changed if deltas[row.id] < 0)
+        part_store_id = changed[0].part_store_id
+        stmt = (insert(Job).values(username=func.lower(username), time=time,
+                part_store_id=part_store_id, parts_used=parts_used))
+        job_id = connection.execute(stmt).inserted_primary_key[0]
+        change_feed.publish(connection, 'parts', 'update', [row.id for row in changed])
+        change_feed.publish(connection, 'jobs', 'insert', [job_id])
+
+        connection.execute(insert(JobLine), [{'job_id': job_id, 'part_id': row.id, 'delta': deltas[row.id],
+                                              'quantity': row.amount, 'time': time} for row in changed])
+        record_usage(connection, part_store_id, time, parts_used,
+                     [(row.id, row.part_type_id, -deltas[row.id]) for row in changed])
+        return parts_used, []
 
     # Record a new job in the database
     @db_connector
-    def record_job(self, username: str, time: str, part_store_name: str, parts_used: str or int, **kwargs) -> None:
+    def record_job(self, username: str, time: datetime, part_store_name: str, parts_used: str or int, **kwargs) -> None:
         connection = kwargs.pop('connection')
+        part_store_id = connection.execute(select(store_id_subquery(part_store_name))).scalar()
         stmt = (insert(Job).values(username=func.lower(username), time=time,
-                part_store_name=part_store_name, parts_used=parts_used))
-        connection.execute(stmt)
-        connection.commit()
+                part_store_id=part_store_id, parts_used=parts_used))
+        job_id = connection.execute(stmt).inserted_primary_key[0]
+        change_feed.publish(connection, 'jobs', 'insert', [job_id])
+
+        if part_store_id is not None:
+            record_usage(connection, part_store_id, time, int(parts_used))
+
+    # Get one keyset page of a part's ledger lines, newest first, within an optional since/until time range.
+    # Returns (rows, next_cursor), next_cursor is None on the last page
+    @db_reader
+    def get_part_ledger_page(self, part_id: int, cursor: str = None, descending: bool = True, limit: int = None,
+                             since: datetime = None, until: datetime = None, **kwargs) -> tuple:
+        connection = kwargs.pop('connection')
+        stmt = (select(JobLine.id, JobLine.job_id, JobLine.time, JobLine.delta, JobLine.quantity)
+                .where(*ledger_filters(part_id, since, until)))
+        return keyset_page(connection, stmt, JobLine.time, JobLine.id, cursor, descending, limit)
+
+    # Units a part lost to and gained from jobs within an optional since/until time range, from the ledger
+    @db_reader
+    def get_part_consumption(self, part_id: int, since: datetime = None, until: datetime = None, **kwargs) -> dict:
+        connection = kwargs.pop('connection')
+        stmt = (select(func.count(JobLine.id),
+                       func.coalesce(func.sum(case((JobLine.delta < 0, -JobLine.delta), else_=0)), 0),
+                       func.coalesce(func.sum(case((JobLine.delta > 0, JobLine.delta), else_=0)), 0))
+                .where(*ledger_filters(part_id, since, until)))
+        lines, consumed, added = connection.execute(stmt).first()
+        return {'lines': lines, 'consumed': consumed, 'added': added}
+
+    # Parts whose amount no longer matches the quantity left by their latest ledger line,
+    # i.e. parts whose stock was changed outside of jobs since
+    @db_reader
+    def audit_stock(self, **kwargs) -> list:
+        connection = kwargs.pop('connection')
+        latest = select(JobLine.part_id, func.max(JobLine.id).label('line_id')).group_by(JobLine.part_id).subquery()
+        stmt = (select(Part.id, Part.name, PartStore.part_store_name, Part.amount,
+                       JobLine.quantity.label('ledger_quantity'), JobLine.time.label('ledger_time'))
+                .select_from(latest).join(JobLine, JobLine.id == latest.c.line_id)
+                .join(Part, Part.id == latest.c.part_id).outerjoin(PartStore, Part.part_store_id == PartStore.id)
+                .where(Part.amount != JobLine.quantity).order_by(Part.id))
+        return connection.execute(stmt).fetchall()
 
     # Get all jobs from database
-    @db_connector
+    @db_reader
     def get_jobs(self, **kwargs) -> tuple:
         connection = kwargs.pop('connection')
-        stmt = (select(Job.job_id, Job.username, Job.time,
-                Job.part_store_name, Job.parts_used))
+        stmt = select_jobs()
         results = connection.execute(stmt).fetchall()
         return results
 
+    # Get one keyset page of jobs (or archived jobs) filtered by part store, username and a since/until
+    # time range, newest first by default. The store and user filters ordered by time are served by the
+    # (part_store_id, time) and (username, time) indexes. Returns (rows, next_cursor), next_cursor is None
+    # on the last page
+    @db_reader
+    def get_jobs_page(self, cursor: str = None, sort: str = 'time', descending: bool = True, limit: int = None,
+                      part_store_name: str = None, username: str = None, since: datetime = None,
+                      until: datetime = None, archived: bool = False, **kwargs) -> tuple:
+        connection = kwargs.pop('connection')
+        table = ArchivedJob if archived else Job
+
+        if archived:
+            stmt = select(ArchivedJob.job_id, ArchivedJob.username, ArchivedJob.time, ArchivedJob.part_store_name,
+                          ArchivedJob.parts_used)
+            if part_store_name:
+                stmt = stmt.where(ArchivedJob.part_store_name == part_store_name)
+        else:
+            stmt = select_jobs()
+            if part_store_name:
+                stmt = stmt.where(Job.part_store_id == store_id_subquery(part_store_name))
+
+        if username:
+            stmt = stmt.where(table.username == username)
+        if since:
+            stmt = stmt.where(table.time >= since)
+        if until:
+            stmt = stmt.where(table.time < until)
+
+        sort_columns = archived_job_sort_columns if archived else job_sort_columns
+        return keyset_page(connection, stmt, sort_columns.get(sort, table.time), table.job_id,
+                           cursor, descending, limit)
+
+    # Stream every part ordered by id
+    def stream_parts(self, batch_size: int = 1000):
+        stmt = (select_parts(Part.id, Part.name, Part.amount, Part.part_number, PartStore.part_store_name,
+                             Part.low_thresh, part_type_name, part_type_unit).order_by(Part.id))
+        return stream_rows(stmt, batch_size)
+
+    # Stream every job ordered by job id
+    def stream_jobs(self, batch_size: int = 1000):
+        stmt = select_jobs().order_by(Job.job_id)
+        return stream_rows(stmt, batch_size)
+
     # Get the total amount of parts by part store
-    @db_connector
+    @db_reader
     def get_total_parts_by_part_store(self, part_store_name: int, **kwargs) -> int:
         connection = kwargs.pop('connection')
         stmt = (select(func.sum(Part.amount)).where(
-            Part.part_store_name == part_store_name))
+            Part.part_store_id == store_id_subquery(part_store_name)))
         results = connection.execute(stmt).fetchall()
         res = [i[0] for i in results]
         return res[0]
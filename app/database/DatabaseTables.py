@@ -1,27 +1,32 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, text
+from sqlalchemy import Column, Computed, Date, DateTime, ForeignKey, Index, Integer, String, Text, event, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 metadata = Base.metadata
 
+# Names compare, sort and are indexed ignoring case, like MySQL's default collation does, on SQLite too
+Name = String(255).with_variant(String(255, collation='NOCASE'), 'sqlite')
+
 
 class Account(Base):
     __tablename__ = 'accounts'
 
     id = Column(Integer, primary_key=True)
-    username = Column(Text)
+    username = Column(Name, unique=True)
     password = Column(Text)
     is_admin = Column(Integer, server_default=text("'0'"))
     is_confirmed = Column(Integer, server_default=text("'0'"))
     phone_num = Column(String(20))
+    # Bumped whenever the admin or confirmed flags change so cached sessions re-read them
+    auth_version = Column(Integer, server_default=text("'0'"))
 
 
 class PartStore(Base):
     __tablename__ = 'part_store'
 
     id = Column(Integer, primary_key=True)
-    part_store_name = Column(String(255), index=True)
+    part_store_name = Column(Name, index=True)
     icon = Column(String(255))
 
 
@@ -29,39 +34,141 @@ class PartType(Base):
     __tablename__ = 'part_type'
 
     id = Column(Integer, primary_key=True)
-    type_name = Column(String(255), index=True)
-    type_unit = Column(String(255), index=True)
+    type_name = Column(Name, index=True)
+    type_unit = Column(Name, index=True)
 
 
 class Job(Base):
     __tablename__ = 'jobs'
 
     job_id = Column(Integer, primary_key=True)
-    username = Column(String(255))
-    time = Column(String(255))
-    part_store_name = Column(ForeignKey(
-        'part_store.part_store_name', ondelete='CASCADE', onupdate='CASCADE'), index=True)
+    username = Column(Name)
+    time = Column(DateTime, index=True)
+    part_store_id = Column(ForeignKey('part_store.id', ondelete='CASCADE'))
     parts_used = Column(Integer)
 
     part_store = relationship('PartStore')
 
+    # Job history is read newest first per store or per user, optionally within a time range
+    __table_args__ = (Index('jobs_part_store_id_time_index', 'part_store_id', 'time'),
+                      Index('jobs_username_time_index', 'username', 'time'))
+
+
+# Jobs moved out of the jobs table once they are older than the retention window, stored compressed by InnoDB.
+# The part store name is copied in since the store can be removed after the job was archived
+class ArchivedJob(Base):
+    __tablename__ = 'jobs_archive'
+
+    job_id = Column(Integer, primary_key=True, autoincrement=False)
+    username = Column(Name)
+    time = Column(DateTime, index=True)
+    part_store_id = Column(Integer)
+    part_store_name = Column(Name)
+    parts_used = Column(Integer)
+
+    __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+
+
+# Append-only ledger of the stock changes made by jobs, one row per changed part holding the change and
+# the amount it left. Lines are kept when their job is archived
+class JobLine(Base):
+    __tablename__ = 'job_lines'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, index=True)
+    part_id = Column(ForeignKey('parts.id', ondelete='CASCADE'), nullable=False)
+    delta = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    time = Column(DateTime)
+
+    # A part's history, or its consumption within a time range, is one range scan
+    __table_args__ = (Index('job_lines_part_id_time_index', 'part_id', 'time'),)
+
 
 class Part(Base):
     __tablename__ = 'parts'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(255), index=True)
+    name = Column(Name, index=True)
     amount = Column(Integer, nullable=False, index=True,
                     server_default=text("'0'"))
-    part_number = Column(String(255), index=True, server_default=text("'0'"))
-    part_store_name = Column(String(255), index=True)
+    part_number = Column(Name, index=True, server_default=text("'0'"))
+    part_store_id = Column(ForeignKey('part_store.id', ondelete='CASCADE'))
+    part_type_id = Column(ForeignKey('part_type.id', ondelete='CASCADE'), index=True)
     low_thresh = Column(Integer)
-    type = Column(ForeignKey('part_type.type_name',
-                  ondelete='CASCADE', onupdate='CASCADE'), index=True)
-    unit = Column(ForeignKey('part_type.type_unit',
-                  ondelete='CASCADE', onupdate='CASCADE'), index=True)
-
-    part_type = relationship(
-        'PartType', primaryjoin='Part.type == PartType.type_name')
-    part_type1 = relationship(
-        'PartType', primaryjoin='Part.unit == PartType.type_unit')
+    # 1 while the part is below its threshold, kept up to date by the database on every write
+    is_low = Column(Integer, Computed('low_thresh > amount', persisted=True))
+
+    part_store = relationship('PartStore')
+    part_type = relationship('PartType')
+
+    # Parts are filtered by store and type together, and low parts are listed and counted per store,
+    # both straight from an index. The (part_store_id, ...) index also serves store only lookups
+    __table_args__ = (Index('parts_part_store_id_part_type_id_index', 'part_store_id', 'part_type_id'),
+                      Index('parts_is_low_part_store_id_index', 'is_low', 'part_store_id'))
+
+
+# Jobs and parts used per part store per day, kept up to date as jobs are recorded
+class StoreDailyUsage(Base):
+    __tablename__ = 'store_daily_usage'
+
+    part_store_id = Column(ForeignKey('part_store.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    jobs = Column(Integer, nullable=False, server_default=text("'0'"))
+    parts_used = Column(Integer, nullable=False, server_default=text("'0'"))
+
+
+# Units of each part taken out of stock by jobs
+class PartUsage(Base):
+    __tablename__ = 'part_usage'
+
+    part_id = Column(ForeignKey('parts.id', ondelete='CASCADE'), primary_key=True)
+    units_used = Column(Integer, nullable=False, index=True, server_default=text("'0'"))
+
+
+# Units of each part type taken out of stock by jobs
+class PartTypeUsage(Base):
+    __tablename__ = 'part_type_usage'
+
+    part_type_id = Column(ForeignKey('part_type.id', ondelete='CASCADE'), primary_key=True)
+    units_used = Column(Integer, nullable=False, server_default=text("'0'"))
+
+
+# Change counter of each table the pages are rendered from, bumped by the commit of every write to it
+class TableVersion(Base):
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, server_default=text("'0'"))
+    changed_at = Column(DateTime)
+
+
+# Tables with a row in table_versions
+versioned_tables = ('accounts', 'jobs', 'part_store', 'part_type', 'parts')
+
+
+# A new table_versions table starts with a row for every versioned table
+@event.listens_for(TableVersion.__table__, 'after_create')
+def insert_table_versions(target, connection, **kwargs):
+    connection.execute(target.insert(), [{'table_name': name, 'version': 0} for name in versioned_tables])
+
+
+# Rows changed by committed writes, read by the change feed to push them to open pages. row_id is NULL
+# when a whole table changed. Events are pruned once they are older than change_feed_retention minutes
+class ChangeEvent(Base):
+    __tablename__ = 'change_events'
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(64), nullable=False)
+    row_id = Column(Integer)
+    action = Column(String(8), nullable=False)
+    time = Column(DateTime, index=True)
+
+
+# Migrations applied to the database by flask migrate
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(255))
+    applied_at = Column(DateTime)
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+from os import environ
+from time import perf_counter
+
+from sqlalchemy import delete, insert, select
+
+from app.database.ChangeFeed import change_feed
+from app.database.DatabaseTables import ArchivedJob, Job, PartStore
+from app.decorators import new_session
+
+# Days jobs stay in the jobs table before archive_jobs moves them to jobs_archive
+retention_days = int(environ.get('job_retention_days', 365))
+
+
+# Move the oldest batch_size jobs from before cutoff to the archive in one transaction on a session of its own.
+# Returns the number of jobs moved
+def archive_batch(cutoff: datetime, batch_size: int) -> int:
+    connection = new_session()
+
+    try:
+        stmt = (select(Job.job_id).where(Job.time < cutoff)
+                .order_by(Job.time, Job.job_id).limit(batch_size).with_for_update())
+        ids = connection.execute(stmt).scalars().all()
+
+        if not ids:
+            return 0
+
+        rows = (select(Job.job_id, Job.username, Job.time, Job.part_store_id, PartStore.part_store_name,
+                       Job.parts_used)
+                .select_from(Job).outerjoin(PartStore, Job.part_store_id == PartStore.id)
+                .where(Job.job_id.in_(ids)))
+        connection.execute(insert(ArchivedJob).from_select(
+            ['job_id', 'username', 'time', 'part_store_id', 'part_store_name', 'parts_used'], rows))
+        connection.execute(delete(Job).where(Job.job_id.in_(ids)).execution_options(synchronize_session=False))
+        change_feed.publish(connection, 'jobs', 'delete', ids)
+        connection.commit()
+        return len(ids)
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+# Move every job older than days into jobs_archive, batch_size jobs per transaction so the jobs
+# table is never locked for long. Returns the number of archived jobs, the cutoff and the time taken
+def archive_jobs(days: int = retention_days, batch_size: int = 1000, log=print) -> dict:
+    start = perf_counter()
+    cutoff = datetime.now().replace(microsecond=0) - timedelta(days=days)
+    archived = 0
+
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        archived += moved
+
+        if moved < batch_size:
+            break
+        log(f'Archived {archived} jobs')
+
+    return {'archived': archived, 'cutoff': str(cutoff), 'seconds': round(perf_counter() - start, 3)}
@@ -0,0 +1,117 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime, timedelta
+from json import dumps, loads
+from os import environ
+
+from sqlalchemy import DateTime, and_, or_
+
+# Default and maximum number of rows returned by one page
+page_size = int(environ.get('page_size', 100))
+max_page_size = int(environ.get('max_page_size', 500))
+
+
+# Keep the requested page size between 1 and max_page_size
+def clamp_limit(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return page_size
+    return max(1, min(limit, max_page_size))
+
+
+# Read the cursor, sort, direction and limit arguments from a request's query arguments
+def page_args(args, default_descending: bool = False) -> dict:
+    direction = args.get('direction')
+    return {'cursor': args.get('cursor'),
+            'sort': args.get('sort', ''),
+            'descending': direction == 'desc' if direction else default_descending,
+            'limit': args.get('limit')}
+
+
+# Read the since and until query arguments (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS) into datetimes.
+# until is exclusive and a date only until includes that whole day, missing or malformed values are None
+def date_args(args) -> dict:
+    dates = {}
+
+    for key in ('since', 'until'):
+        value = (args.get(key) or '').strip()
+
+        try:
+            dates[key] = datetime.fromisoformat(value) if value else None
+        except ValueError:
+            dates[key] = None
+
+        if key == 'until' and dates[key] is not None and len(value) == 10:
+            dates[key] += timedelta(days=1)
+    return dates
+
+
+# Encode the sort value and id of the last row of a page into an opaque URL-safe cursor.
+# Datetimes are written as 'YYYY-MM-DD HH:MM:SS' and read back by keyset_page
+def encode_cursor(sort_value, row_id: int) -> str:
+    return urlsafe_b64encode(dumps([sort_value, row_id], default=str).encode('utf-8')).decode('ascii')
+
+
+# Decode a cursor into (sort_value, row_id), or None if it is missing or malformed
+def decode_cursor(cursor: str or None) -> tuple or None:
+    if not cursor:
+        return None
+
+    try:
+        sort_value, row_id = loads(urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(row_id)
+    except (DecodeError, ValueError, TypeError, UnicodeError):
+        return None
+
+
+# Condition selecting the rows after the cursor for a (sort_column, id_column) ordering.
+# NULLs sort first ascending and last descending on both MySQL and SQLite
+def after_cursor(sort_column, id_column, cursor: tuple, descending: bool):
+    sort_value, row_id = cursor
+
+    if sort_column is id_column:
+        return id_column < row_id if descending else id_column > row_id
+
+    if descending:
+        if sort_value is None:
+            return and_(sort_column.is_(None), id_column < row_id)
+        return or_(sort_column < sort_value, and_(sort_column == sort_value, id_column < row_id),
+                   sort_column.is_(None))
+
+    if sort_value is None:
+        return or_(sort_column.isnot(None), and_(sort_column.is_(None), id_column > row_id))
+    return or_(sort_column > sort_value, and_(sort_column == sort_value, id_column > row_id))
+
+
+# Run stmt as one keyset page ordered by sort_column then id_column.
+# Returns the rows and the cursor of the next page (None on the last page)
+def keyset_page(connection, stmt, sort_column, id_column, cursor: str or None = None,
+                descending: bool = False, limit: int or None = None) -> tuple:
+    limit = clamp_limit(limit)
+    position = decode_cursor(cursor)
+
+    if position is not None and position[0] is not None and isinstance(sort_column.type, DateTime):
+        try:
+            position = datetime.fromisoformat(position[0]), position[1]
+        except (TypeError, ValueError):
+            position = None
+
+    if position is not None:
+        stmt = stmt.where(after_cursor(sort_column, id_column, position, descending))
+
+    if sort_column is id_column:
+        order = [id_column.desc() if descending else id_column.asc()]
+    elif descending:
+        order = [sort_column.desc(), id_column.desc()]
+    else:
+        order = [sort_column.asc(), id_column.asc()]
+
+    rows = connection.execute(stmt.order_by(*order).limit(limit + 1)).fetchall()
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]._mapping
+    return rows, encode_cursor(last[sort_column.key], last[id_column.key])
@@ -0,0 +1,280 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+from heapq import nsmallest
+from os import environ
+from threading import Lock, Thread
+from time import monotonic
+
+from sqlalchemy import event, select
+
+from app.database.DatabaseTables import Part, PartStore, PartType
+from app.decorators import new_session
+
+# Marks the start of a word in the prefix keys, so one and two character queries match word prefixes only
+WORD_START = '\x01'
+
+# Refreshes changing more parts than this sort the names once instead of inserting them one by one
+BULK_SIZE = 1000
+
+
+# What is indexed for a part: its lowercase name and part number on separate lines, its lowercase name
+# for ranking and its store and type ids
+def part_entry(name: str or None, part_number: str or None, part_store_id: int, part_type_id: int) -> tuple:
+    return f'{name or ""}\n{part_number or ""}'.lower(), (name or '').lower(), part_store_id, part_type_id
+
+
+# Index keys of a text: every trigram, plus the first one and two characters of every word
+def text_keys(text: str) -> set:
+    keys = {text[i:i + 3] for i in range(len(text) - 2)}
+
+    for word in text.split():
+        keys.add(WORD_START + word[:1])
+        keys.add(WORD_START + word[:2])
+    return keys
+
+
+# Index keys every match of a query term has: its trigrams, or for terms under three characters its word prefix
+def term_keys(term: str) -> set:
+    if len(term) < 3:
+        return {WORD_START + term}
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+# In-process trigram and word prefix index over part names and part numbers, with the store and type of
+# every part so their names can be searched too. Built in the background on the first search, then kept up
+# to date incrementally: DatabaseManipulator writes mark the parts they change and those rows are re-read
+# on the next search. Changes made by other processes are picked up by a background refresh every
+# refresh_ttl seconds, which re-reads every row but only re-indexes the ones that changed
+class PartSearchIndex:
+    def __init__(self, refresh_ttl: float = 60):
+        self.refresh_ttl = refresh_ttl
+        self.refreshes = 0
+        self._parts = {}
+        self._names = []
+        self._postings = defaultdict(set)
+        self._by_store = defaultdict(set)
+        self._by_type = defaultdict(set)
+        self._store_names = {}
+        self._type_names = {}
+        self._bulk = False
+        self._dirty = None
+        self._expires = None
+        self._refreshing = False
+        self._lock = Lock()
+
+    # Index one part, replacing what was indexed for it before
+    def _add(self, part_id: int, entry: tuple) -> None:
+        self._remove(part_id)
+        self._parts[part_id] = entry
+
+        # Bulk refreshes sort the names once they are done
+        if not self._bulk:
+            insort(self._names, (entry[1], part_id))
+
+        for key in text_keys(entry[0]):
+            self._postings[key].add(part_id)
+        self._by_store[entry[2]].add(part_id)
+        self._by_type[entry[3]].add(part_id)
+
+    # Drop a part from the index
+    def _remove(self, part_id: int) -> None:
+        entry = self._parts.pop(part_id, None)
+
+        if entry is None:
+            return
+
+        text, name, part_store_id, part_type_id = entry
+        if not self._bulk:
+            position = bisect_left(self._names, (name, part_id))
+            if position < len(self._names) and self._names[position] == (name, part_id):
+                del self._names[position]
+
+        for key in text_keys(text):
+            postings = self._postings.get(key)
+            if postings is not None:
+                postings.discard(part_id)
+                if not postings:
+                    del self._postings[key]
+        self._by_store[part_store_id].discard(part_id)
+        self._by_type[part_type_id].discard(part_id)
+
+    # Drop the parts in gone, index the changed {part_id: entry, ...} and replace the store and type names,
+    # dropping the parts of stores and types that were deleted
+    def _apply(self, gone: set, changed: dict, store_names: dict, type_names: dict) -> None:
+        self._bulk = len(gone) + len(changed) > BULK_SIZE
+
+        for part_id in gone:
+            self._remove(part_id)
+        for part_id, entry in changed.items():
+            self._add(part_id, entry)
+
+        self._store_names, self._type_names = store_names, type_names
+        for by_key, names in ((self._by_store, store_names), (self._by_type, type_names)):
+            for key in [key for key in by_key if key is not None and key not in names]:
+                for part_id in list(by_key.pop(key)):
+                    self._remove(part_id)
+
+        if self._bulk:
+            self._names = sorted((entry[1], part_id) for part_id, entry in self._parts.items())
+            self._bulk = False
+
+    # Re-read the parts with the given ids, or every part when ids is None, and re-index the ones that changed.
+    # The store and type names are re-read either way. The first build fills a new index and swaps it in,
+    # so searches never wait for it
+    def refresh(self, connection, ids: set = None) -> None:
+        stmt = select(Part.id, Part.name, Part.part_number, Part.part_store_id, Part.part_type_id)
+
+        if ids is not None:
+            stmt = stmt.where(Part.id.in_(list(ids)))
+        rows = connection.execute(stmt).fetchall() if ids is None or ids else []
+        store_names = {i: (name or '').lower() for i, name in
+                       connection.execute(select(PartStore.id, PartStore.part_store_name))}
+        type_names = {i: (name or '').lower() for i, name in
+                      connection.execute(select(PartType.id, PartType.type_name))}
+        entries = {row.id: part_entry(*row[1:]) for row in rows}
+
+        if ids is None and self._expires is None:
+            index = PartSearchIndex()
+            index._apply(set(), entries, store_names, type_names)
+
+            with self._lock:
+                self._parts, self._names, self._postings = index._parts, index._names, index._postings
+                self._by_store, self._by_type = index._by_store, index._by_type
+                self._store_names, self._type_names = store_names, type_names
+        else:
+            with self._lock:
+                gone = (set(ids) if ids is not None else set(self._parts)) - set(entries)
+                changed = {part_id: entry for part_id, entry in entries.items() if self._parts.get(part_id) != entry}
+                self._apply(gone, changed, store_names, type_names)
+
+        if ids is None:
+            with self._lock:
+                self._expires = monotonic() + self.refresh_ttl
+                self.refreshes += 1
+
+    # Full refresh on a session of its own, run in the background when the index is missing or expired
+    def refresh_all(self) -> None:
+        connection = new_session()
+
+        try:
+            self.refresh(connection)
+        finally:
+            self._refreshing = False
+            connection.close()
+
+    # Bring the index up to date before a search: parts changed by this process are re-read in place, a
+    # missing or expired index is refreshed in the background. Returns False while the index is being built
+    def _ensure_fresh(self, connection) -> bool:
+        with self._lock:
+            expires, dirty, self._dirty = self._expires, self._dirty, None
+
+            start = (expires is None or expires <= monotonic()) and not self._refreshing
+            if start:
+                self._refreshing = True
+
+        if start:
+            Thread(target=self.refresh_all, daemon=True).start()
+
+        if expires is None:
+            return False
+
+        if dirty is not None:
+            self.refresh(connection, dirty)
+        return True
+
+    # Store and type ids whose name matches a lowercase term
+    def _name_matches(self, term: str) -> tuple:
+        def matching(names):
+            return {key for key, name in names.items() if (name.startswith(term) if len(term) < 3 else term in name)}
+
+        return matching(self._store_names), matching(self._type_names)
+
+    # Whether an indexed part matches a term, given the stores and types whose name matches it
+    def _matches(self, part_id: int, term: str, stores: set, types: set) -> bool:
+        text, _, part_store_id, part_type_id = self._parts[part_id]
+
+        if part_store_id in stores or part_type_id in types:
+            return True
+        if len(term) < 3:
+            return any(word.startswith(term) for word in text.split())
+        return term in text
+
+    # Parts matching one lowercase term, from the postings of its keys checked against the text
+    # (trigrams can all occur without the term itself), plus the parts of the matching stores and types
+    def _term_matches(self, term: str, stores: set, types: set) -> set:
+        postings = sorted((self._postings.get(key, set()) for key in term_keys(term)), key=len)
+        matches = postings[0].intersection(*postings[1:])
+
+        if len(term) > 3:
+            matches = {part_id for part_id in matches if term in self._parts[part_id][0]}
+
+        for ids, by_key in ((stores, self._by_store), (types, self._by_type)):
+            for key in ids:
+                matches |= by_key.get(key, set())
+        return matches
+
+    # Ids of up to limit parts matching every word of query, parts whose name starts with the query first,
+    # then by name and part number, or None while the index is being built. Parts whose name starts with the query match
+    # every word, so typeahead on a common prefix is answered from the sorted names alone. Otherwise the term
+    # with the fewest candidates is looked up in the index and the other terms are checked on its matches
+    def search(self, connection, query: str, limit: int = 20) -> list or None:
+        terms = list(dict.fromkeys(query.lower().split()))
+
+        if not terms:
+            return []
+
+        if not self._ensure_fresh(connection):
+            return None
+        prefix = query.lower().strip()
+
+        with self._lock:
+            position = bisect_left(self._names, (prefix,))
+            ranked = [part_id for name, part_id in self._names[position:position + limit] if name.startswith(prefix)]
+
+            if len(ranked) == limit:
+                return ranked
+
+            names = {term: self._name_matches(term) for term in terms}
+
+            def candidates(term):
+                stores, types = names[term]
+                return (min(len(self._postings.get(key, ())) for key in term_keys(term))
+                        + sum(len(self._by_store.get(i, ())) for i in stores)
+                        + sum(len(self._by_type.get(i, ())) for i in types))
+
+            driver = min(terms, key=candidates)
+            matches = {part_id for part_id in self._term_matches(driver, *names[driver])
+                       if all(self._matches(part_id, term, *names[term]) for term in terms if term != driver)}
+
+            # The parts whose name starts with the query come first, the other matches follow by name
+            matches.difference_update(ranked)
+            return ranked + nsmallest(limit - len(ranked), matches, key=self._parts.__getitem__)
+
+    # Once the session's transaction committed, re-read the given parts and the store and type names on the
+    # next search. With part_ids=None the whole index is refreshed in the background instead
+    def changed_on_commit(self, session, part_ids=()) -> None:
+        def changed(s):
+            with self._lock:
+                if part_ids is None:
+                    self._expires = 0 if self._expires is not None else None
+                else:
+                    self._dirty = (self._dirty or set()) | {int(part_id) for part_id in part_ids}
+
+        event.listen(session, 'after_commit', changed, once=True)
+
+    # Drop the whole index, it is built again in the background by the next search
+    def invalidate(self) -> None:
+        with self._lock:
+            for index in (self._parts, self._names, self._postings, self._by_store, self._by_type):
+                index.clear()
+            self._dirty = None
+            self._expires = None
+
+    # Size of the index and the number of full refreshes
+    def stats(self) -> dict:
+        with self._lock:
+            return {'parts': len(self._parts), 'keys': len(self._postings), 'refreshes': self.refreshes,
+                    'refresh_ttl': self.refresh_ttl, 'ready': self._expires is not None}
+
+
+part_search = PartSearchIndex(refresh_ttl=float(environ.get('search_refresh_ttl', 60)))
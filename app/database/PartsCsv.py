@@ -0,0 +1,131 @@
+from csv import DictReader, writer
+from io import StringIO
+from time import perf_counter
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.database.DatabaseManipulator import DatabaseManipulator, check_input
+from app.database.ChangeFeed import change_feed
+from app.database.DatabaseTables import Part
+from app.database.PartSearch import part_search
+from app.decorators import new_session
+
+# Columns read by the import and written by the export, in order
+csv_columns = ['name', 'amount', 'part_number', 'part_store_name', 'type', 'low_thresh']
+required_columns = csv_columns[:-1]
+
+dbm = DatabaseManipulator()
+
+
+# Map lower cased part store names and part type names to their ids
+def load_references() -> tuple:
+    stores = {row[1].lower(): row[0] for row in dbm.get_part_store_names() or [] if row[1]}
+    types = {row[1].lower(): row[0] for row in dbm.get_part_types() or [] if row[1]}
+    return stores, types
+
+
+# Validate one CSV row, returning (values for the INSERT, None) or (None, error message)
+def validate_row(row: dict, stores: dict, types: dict) -> tuple:
+    for column in required_columns:
+        if not check_input((row.get(column) or '').strip()):
+            return None, f'{column} is blank or invalid'
+
+    amount = row['amount'].strip()
+    if not amount.isnumeric():
+        return None, 'amount must be a whole number'
+
+    low_thresh = (row.get('low_thresh') or '').strip()
+    if low_thresh and not low_thresh.isnumeric():
+        return None, 'low_thresh must be a whole number'
+
+    store_id = stores.get(row['part_store_name'].strip().lower())
+    if store_id is None:
+        return None, f'part store {row["part_store_name"]!r} does not exist'
+
+    type_id = types.get(row['type'].strip().lower())
+    if type_id is None:
+        return None, f'part type {row["type"]!r} does not exist'
+
+    return {'name': row['name'].strip(), 'amount': int(amount), 'part_number': row['part_number'].strip(),
+            'part_store_id': store_id, 'part_type_id': type_id,
+            'low_thresh': int(low_thresh) if low_thresh else None}, None
+
+
+# Insert one batch with executemany (PyMySQL rewrites it into multi-row INSERTs) and commit it on its own session
+def insert_batch(batch: list) -> str or None:
+    connection = new_session()
+
+    try:
+        connection.execute(insert(Part), [values for _, values in batch])
+        part_search.changed_on_commit(connection, None)
+        change_feed.publish(connection, 'parts')
+        connection.commit()
+    except SQLAlchemyError as e:
+        connection.rollback()
+        return str(e.orig if hasattr(e, 'orig') else e)
+    finally:
+        connection.close()
+
+
+# Import parts from a text stream of CSV, validating and inserting batch_size rows at a time.
+# Returns the number of inserted rows, the per-row errors and the throughput
+def import_parts_csv(stream, batch_size: int = 1000, max_errors: int = 1000) -> dict:
+    start = perf_counter()
+    reader = DictReader(stream)
+    missing = [column for column in required_columns if column not in (reader.fieldnames or [])]
+
+    if missing:
+        return {'inserted': 0, 'rows': 0, 'errors': [{'line': 1, 'error': f'missing columns: {", ".join(missing)}'}],
+                'seconds': 0, 'rows_per_second': 0}
+
+    stores, types = load_references()
+    inserted, rows, errors, batch = 0, 0, [], []
+
+    # Insert the pending batch, every row of a failed batch is reported with the database error
+    def flush():
+        nonlocal inserted
+        error = insert_batch(batch)
+
+        if error is None:
+            inserted += len(batch)
+        else:
+            errors.extend({'line': line, 'error': error} for line, _ in batch)
+        batch.clear()
+
+    for row in reader:
+        rows += 1
+        values, error = validate_row(row, stores, types)
+
+        if error is not None:
+            errors.append({'line': reader.line_num, 'error': error})
+        else:
+            batch.append((reader.line_num, values))
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    seconds = perf_counter() - start
+    return {'inserted': inserted, 'rows': rows, 'errors': errors[:max_errors], 'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds) if seconds else rows}
+
+
+# Yield every part as CSV text, one chunk of lines per batch read from the server side cursor
+def export_parts_csv(batch_size: int = 1000):
+    buffer = StringIO()
+    csv_writer = writer(buffer)
+    csv_writer.writerow(csv_columns + ['unit'])
+
+    for count, row in enumerate(dbm.stream_parts(batch_size), start=1):
+        csv_writer.writerow([row.name, row.amount, row.part_number, row.part_store_name, row.type,
+                             row.low_thresh if row.low_thresh is not None else '', row.unit])
+
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from functools import wraps
+from os import environ
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event
+
+from app.database.TableVersions import table_versions
+
+
+# In-process read-through cache for reference data (part types, part stores, store icons).
+# Entries expire after ttl seconds and the oldest entries are evicted past max_size. Entries are stored with
+# the shared versions of tables (read by versions()) and only served while those are unchanged, so a write
+# committed by any process drops them. A load that raced with a write committed in this process isn't stored
+class ReferenceCache:
+    def __init__(self, ttl: float = 60, max_size: int = 128, versions=None, tables: tuple = ()):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.versions = versions
+        self.tables = tables
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    # Versions of the tables the entries depend on, None if they can't be read
+    def _stamp(self) -> tuple or None:
+        if self.versions is None:
+            return ()
+
+        versions = self.versions()
+        if versions is None:
+            return None
+        return tuple(versions.get(name, (None,))[0] for name in self.tables)
+
+    # Return the cached value for key, or call loader and cache its result
+    def get(self, key: tuple, loader):
+        now = monotonic()
+        stamp = self._stamp()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] > now and entry[1] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            self.misses += 1
+            generation = self._generation
+
+        value = loader()
+
+        # Failed lookups return None from db_connector, don't cache those. Without versions to check the entry
+        # against, or once a write committed while loading, the value may be stale, don't cache it either
+        if value is not None and stamp is not None:
+            with self._lock:
+                if generation != self._generation:
+                    return value
+
+                self._entries[key] = (now + self.ttl, stamp, value)
+                self._entries.move_to_end(key)
+
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    # Drop every cached entry
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    # Drop every cached entry of this process now and again once the session's transaction ends, so its
+    # readers never keep rows cached from before the commit or from a rolled back write. Other processes
+    # drop theirs once they read the versions the commit bumped
+    def invalidate_on_commit(self, session) -> None:
+        self.invalidate()
+        event.listen(session, 'after_commit', lambda s: self.invalidate(), once=True)
+        event.listen(session, 'after_rollback', lambda s: self.invalidate(), once=True)
+
+    # Hit/miss counters and current size
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                    'max_size': self.max_size, 'ttl': self.ttl}
+
+    # Decorator caching a function's return value by its name and arguments
+    def cached(self, func):
+        @wraps(func)
+        def with_cache_(*args, **kwargs):
+            # Skip self for methods so every DatabaseManipulator shares the entries
+            key_args = args[1:] if '.' in func.__qualname__ else args
+            key = (func.__qualname__, key_args, tuple(sorted(kwargs.items())))
+            value = self.get(key, lambda: func(*args, **kwargs))
+            return list(value) if isinstance(value, list) else value
+
+        return with_cache_
+
+
+reference_cache = ReferenceCache(ttl=float(environ.get('reference_cache_ttl', 60)),
+                                 max_size=int(environ.get('reference_cache_size', 128)),
+                                 versions=table_versions.get, tables=('part_store', 'part_type'))
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.database.DatabaseTables import PartTypeUsage, PartUsage, StoreDailyUsage
+
+
+# Add rows of counters to a rollup table in one statement, inserting the keys that are not there yet.
+# rows are dictionaries holding the key columns and the amounts to add to every other column
+def increment(connection, table, keys: list, rows: list) -> None:
+    if not rows:
+        return
+
+    counters = [name for name in rows[0] if name not in keys]
+
+    if connection.get_bind().dialect.name == 'mysql':
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in counters})
+    else:
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=keys,
+                                          set_={name: table.c[name] + stmt.excluded[name] for name in counters})
+    connection.execute(stmt, rows)
+
+
+# Add a recorded job to the rollups, in the transaction that records it.
+# used_parts is [(part_id, part_type_id, units taken out of stock), ...]
+def record_usage(connection, part_store_id: int, time: datetime, parts_used: int, used_parts: list = ()) -> None:
+    increment(connection, StoreDailyUsage.__table__, ['part_store_id', 'day'],
+              [{'part_store_id': part_store_id, 'day': time.date(), 'jobs': 1, 'parts_used': parts_used}])
+
+    used_parts = [i for i in used_parts if i[2] > 0]
+    type_units = {}
+    for _, part_type_id, units in used_parts:
+        if part_type_id is not None:
+            type_units[part_type_id] = type_units.get(part_type_id, 0) + units
+
+    increment(connection, PartUsage.__table__, ['part_id'],
+              [{'part_id': part_id, 'units_used': units} for part_id, _, units in used_parts])
+    increment(connection, PartTypeUsage.__table__, ['part_type_id'],
+              [{'part_type_id': part_type_id, 'units_used': units} for part_type_id, units in type_units.items()])
@@ -0,0 +1,98 @@
+from datetime import datetime
+from os import environ
+from threading import Lock
+from time import monotonic
+
+from flask import g, has_request_context
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.database.DatabaseTables import TableVersion
+from app.decorators import new_session
+
+
+# Change versions of the versioned tables, shared by every process through the table_versions table.
+# Writes bump the versions of the tables they change in their own transaction, right before it commits,
+# so the version rows are only locked while committing. Readers share a copy of every version that is
+# re-read once it is older than ttl seconds, or right after a write in this process committed
+class TableVersions:
+    def __init__(self, ttl: float = 1):
+        self.ttl = ttl
+        self.reads = 0
+        self._versions = None
+        self._expires = 0
+        self._generation = 0
+        self._lock = Lock()
+
+    # Bump the versions of tables once the session's transaction commits, nothing is bumped on rollback
+    def bump_on_commit(self, session, *tables: str) -> None:
+        pending = session.info.get('changed_tables')
+
+        if pending is None:
+            pending = session.info['changed_tables'] = set()
+            event.listen(session, 'before_commit', self._bump, once=True)
+            event.listen(session, 'after_commit', lambda s: self.invalidate(), once=True)
+            event.listen(session, 'after_rollback', lambda s: s.info.pop('changed_tables', None), once=True)
+        pending.update(tables)
+
+    # Last statement of a transaction that changed versioned tables, rows are locked in name order.
+    # changed_at is in UTC for Last-Modified
+    def _bump(self, session) -> None:
+        tables = session.info.pop('changed_tables', None)
+
+        if tables:
+            stmt = (update(TableVersion).where(TableVersion.table_name.in_(sorted(tables)))
+                    .values(version=TableVersion.version + 1, changed_at=datetime.utcnow().replace(microsecond=0)))
+            session.execute(stmt.execution_options(synchronize_session=False))
+
+    # {table_name: (version, changed_at), ...} of every versioned table, or None if they can't be read
+    def get(self) -> dict or None:
+        with self._lock:
+            if self._versions is not None and self._expires > monotonic():
+                return self._versions
+            generation = self._generation
+
+        # On a session of their own, a failed read can't roll back the writes of the request it runs in
+        connection = new_session()
+
+        try:
+            stmt = select(TableVersion.table_name, TableVersion.version, TableVersion.changed_at)
+            versions = {row.table_name: (row.version, row.changed_at) for row in connection.execute(stmt)}
+            connection.commit()
+        except SQLAlchemyError as e:
+            print(str(e))
+            connection.rollback()
+            return None
+        finally:
+            connection.close()
+
+        # Versions read while a write committed in this process may be older than that write, don't keep them
+        with self._lock:
+            self.reads += 1
+            if generation == self._generation:
+                self._versions, self._expires = versions, monotonic() + self.ttl
+        return versions
+
+    # The versions as the current request first read them, so its reads are checked against one copy.
+    # Outside requests the same as get()
+    def for_request(self) -> dict or None:
+        if not has_request_context():
+            return self.get()
+
+        if 'table_versions' not in g:
+            g.table_versions = self.get()
+        return g.table_versions
+
+    # Re-read the versions on the next get
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._versions = None
+
+    # Number of times the versions were read from the database
+    def stats(self) -> dict:
+        with self._lock:
+            return {'reads': self.reads, 'ttl': self.ttl}
+
+
+table_versions = TableVersions(ttl=float(environ.get('table_versions_ttl', 1)))
@@ -0,0 +1,136 @@
+from datetime import datetime
+from importlib import import_module
+
+from sqlalchemy import func, inspect, insert, select
+
+from app.database.DatabaseTables import SchemaVersion, metadata
+
+# Migration modules in the order they are applied, a migration's version is its position in this list.
+# Each module has a name, is_applied(inspector) and upgrade(engine, batch_size, log)
+migration_modules = ['m0001_integer_foreign_keys', 'm0002_usage_rollups', 'm0003_job_history_indexes',
+                     'm0004_job_lines', 'm0005_table_versions', 'm0006_change_events', 'm0007_account_auth_version']
+
+
+# Column names of a table
+def columns(inspector, table_name: str) -> list:
+    return [i['name'] for i in inspector.get_columns(table_name)]
+
+
+# Run an ALTER TABLE, on MySQL only if it can run in place without locking the table
+def alter(conn, statement: str) -> None:
+    if conn.dialect.name == 'mysql':
+        statement += ', ALGORITHM=INPLACE, LOCK=NONE'
+    conn.exec_driver_sql(statement)
+
+
+# Add an index if it is missing, in place on MySQL
+def add_index(conn, index_name: str, table_name: str, index_columns: str, unique: bool = False) -> None:
+    if any(index['name'] == index_name for index in inspect(conn).get_indexes(table_name)):
+        return
+
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    if conn.dialect.name == 'mysql':
+        alter(conn, f'ALTER TABLE {table_name} ADD {kind} {index_name} ({index_columns})')
+    else:
+        conn.exec_driver_sql(f'CREATE {kind} {index_name} ON {table_name} ({index_columns})')
+
+
+# Drop an index if it exists, in place on MySQL
+def drop_index(conn, index_name: str, table_name: str) -> None:
+    if not any(index['name'] == index_name for index in inspect(conn).get_indexes(table_name)):
+        return
+
+    if conn.dialect.name == 'mysql':
+        alter(conn, f'ALTER TABLE {table_name} DROP INDEX {index_name}')
+    else:
+        conn.exec_driver_sql(f'DROP INDEX {index_name}')
+
+
+# Import every migration as (version, module)
+def load_migrations() -> list:
+    return [(version, import_module(f'{__name__}.{module}'))
+            for version, module in enumerate(migration_modules, start=1)]
+
+
+# Record a migration as applied
+def stamp(engine, version: int, module) -> None:
+    with engine.begin() as conn:
+        conn.execute(insert(SchemaVersion).values(version=version, name=module.name, applied_at=datetime.now()))
+
+
+# Whether the database has no schema yet, like a new SQLite file
+def is_empty(engine) -> bool:
+    return not inspect(engine).has_table('parts')
+
+
+# Version the database is at, read without changing it. Databases that were never migrated (created from the
+# models or an older database.sql) are at the last of the leading migrations whose changes they already have.
+# Empty databases are at version 0
+def current_version(engine) -> int:
+    if is_empty(engine):
+        return 0
+
+    inspector = inspect(engine)
+    if inspector.has_table(SchemaVersion.__tablename__):
+        with engine.connect() as conn:
+            version = conn.execute(select(func.max(SchemaVersion.version))).scalar()
+
+        if version is not None:
+            return version
+
+    version = 0
+    for migration_version, module in load_migrations():
+        if not module.is_applied(inspector):
+            break
+        version = migration_version
+    return version
+
+
+# Migrations newer than the database's version as (version, module). An empty database has none, it gets
+# the schema of the models instead
+def pending_migrations(engine) -> list:
+    if is_empty(engine):
+        return []
+
+    version = current_version(engine)
+    return [(migration_version, module) for migration_version, module in load_migrations()
+            if migration_version > version]
+
+
+# Get the database ready to be upgraded: an empty one gets the schema of the models with every migration
+# stamped, one that was never migrated is stamped with the migrations it already has
+def prepare(engine) -> None:
+    if is_empty(engine):
+        metadata.create_all(engine)
+
+        for version, module in load_migrations():
+            stamp(engine, version, module)
+        return
+
+    SchemaVersion.__table__.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        if conn.execute(select(func.max(SchemaVersion.version))).scalar() is not None:
+            return
+
+    for version, module in load_migrations():
+        if not module.is_applied(inspect(engine)):
+            break
+        stamp(engine, version, module)
+
+
+# Apply every pending migration up to target (default: all) in order, stamping each one once it finished.
+# Migrations are resumable, rerunning after an interruption continues where it stopped
+def migrate(engine, target: int = None, batch_size: int = 1000, log=print) -> list:
+    prepare(engine)
+    applied = []
+
+    for version, module in pending_migrations(engine):
+        if target is not None and version > target:
+            break
+
+        log(f'Applying {version:04d} {module.name}')
+        module.upgrade(engine, batch_size, log)
+        stamp(engine, version, module)
+        applied.append(version)
+    return applied
@@ -0,0 +1,280 @@
+from datetime import datetime
+
+from sqlalchemy import (Column, Computed, DateTime, ForeignKey, Integer, MetaData, String, Table, case, func, inspect,
+                        select, text, update)
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import column, table
+
+from app.database.migrations import alter, columns
+
+# Parts and jobs reference part stores and part types by id instead of by name, parts drop the unit
+# copied from their type and jobs store their time as an indexed DATETIME.
+#
+# The migration expands, backfills and then contracts the tables, so it can be rerun after an
+# interruption. New columns are added and filled batch_size rows per transaction while the app keeps
+# running. On MySQL every ALTER is requested with ALGORITHM=INPLACE, LOCK=NONE and fails instead of
+# silently locking the table; other databases (SQLite) rebuild parts and jobs in one transaction.
+# Stop the app for the final contract step, the old code still writes the name columns it drops
+name = 'integer foreign keys'
+
+# The tables as they were before this migration, only the columns it reads and writes
+old_parts = table('parts', column('id'), column('part_store_name'), column('type'),
+                  column('part_store_id'), column('part_type_id'))
+old_jobs = table('jobs', column('job_id'), column('part_store_name'), column('time'),
+                 column('part_store_id'), column('new_time'))
+part_store = table('part_store', column('id'), column('part_store_name'))
+part_type = table('part_type', column('id'), column('type_name'))
+
+# Indexes of the migrated tables as (name, table, columns), named like the models create them
+new_indexes = [('parts_part_store_id_part_type_id_index', 'parts', 'part_store_id, part_type_id'),
+               ('parts_is_low_part_store_id_index', 'parts', 'is_low, part_store_id'),
+               ('ix_parts_part_type_id', 'parts', 'part_type_id'),
+               ('ix_jobs_time', 'jobs', 'time'),
+               ('ix_jobs_part_store_id', 'jobs', 'part_store_id')]
+
+# Indexes on the columns that are kept, only created again when a table is rebuilt
+kept_indexes = [('ix_parts_name', 'parts', 'name'),
+                ('ix_parts_amount', 'parts', 'amount'),
+                ('ix_parts_part_number', 'parts', 'part_number')]
+
+# Foreign keys of the migrated tables as (name, table, column, referenced table)
+new_foreign_keys = [('parts_part_store_id_fk', 'parts', 'part_store_id', 'part_store'),
+                    ('parts_part_type_id_fk', 'parts', 'part_type_id', 'part_type'),
+                    ('jobs_part_store_id_fk', 'jobs', 'part_store_id', 'part_store')]
+
+
+# The migrated parts and jobs tables under the given names, used to rebuild them outside MySQL
+def new_tables(parts_name: str, jobs_name: str) -> tuple:
+    metadata = MetaData()
+    Table('part_store', metadata, Column('id', Integer, primary_key=True))
+    Table('part_type', metadata, Column('id', Integer, primary_key=True))
+
+    parts = Table(parts_name, metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', String(255)),
+                  Column('amount', Integer, nullable=False, server_default=text("'0'")),
+                  Column('part_number', String(255), server_default=text("'0'")),
+                  Column('part_store_id', Integer, ForeignKey('part_store.id', ondelete='CASCADE')),
+                  Column('part_type_id', Integer, ForeignKey('part_type.id', ondelete='CASCADE')),
+                  Column('low_thresh', Integer),
+                  Column('is_low', Integer, Computed('low_thresh > amount', persisted=True)))
+    jobs = Table(jobs_name, metadata,
+                 Column('job_id', Integer, primary_key=True),
+                 Column('username', String(255)),
+                 Column('time', DateTime),
+                 Column('part_store_id', Integer, ForeignKey('part_store.id', ondelete='CASCADE')),
+                 Column('parts_used', Integer))
+    return parts, jobs
+
+
+# Done once parts and jobs no longer reference part stores and part types by name
+def is_applied(inspector) -> bool:
+    return 'part_store_name' not in columns(inspector, 'parts') and 'part_store_name' not in columns(inspector, 'jobs')
+
+
+# Read a job time stored as text, None if it is not a date
+def parse_time(value) -> datetime or None:
+    if value is None or isinstance(value, datetime):
+        return value
+
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
+
+# Add the id columns next to the name columns, and the new job time column
+def expand(engine, log) -> None:
+    inspector = inspect(engine)
+    part_columns, job_columns = columns(inspector, 'parts'), columns(inspector, 'jobs')
+
+    with engine.begin() as conn:
+        for column_name in ('part_store_id', 'part_type_id'):
+            if column_name not in part_columns:
+                log(f'Adding parts.{column_name}')
+                alter(conn, f'ALTER TABLE parts ADD COLUMN {column_name} INTEGER NULL')
+
+        if 'part_store_id' not in job_columns:
+            log('Adding jobs.part_store_id')
+            alter(conn, 'ALTER TABLE jobs ADD COLUMN part_store_id INTEGER NULL')
+
+        if 'new_time' not in job_columns and 'part_store_name' in job_columns:
+            log('Adding jobs.new_time')
+            alter(conn, f'ALTER TABLE jobs ADD COLUMN new_time {DateTime().compile(dialect=conn.dialect)} NULL')
+
+        # Databases that never got the low stock column: adding a stored column copies the table on MySQL
+        if 'is_low' not in part_columns and conn.dialect.name == 'mysql':
+            log('Adding parts.is_low, this copies the parts table')
+            conn.exec_driver_sql('ALTER TABLE parts ADD COLUMN is_low int AS (low_thresh > amount) STORED')
+
+
+# Call fill(conn, low, high) for every id range of batch_size rows of a table, committing each range
+def in_batches(engine, id_column, batch_size: int, fill, log, label: str) -> None:
+    with engine.connect() as conn:
+        low, high = conn.execute(select(func.min(id_column), func.max(id_column))).first()
+
+    if low is None:
+        return
+
+    for start in range(low - 1, high, batch_size):
+        with engine.begin() as conn:
+            fill(conn, start, start + batch_size)
+        log(f'{label}: ids up to {min(start + batch_size, high)} of {high}')
+
+
+# Fill the part store and part type ids of the parts in (low, high] that do not have them yet
+def fill_parts(conn, low: int, high: int) -> None:
+    store_id = (select(func.min(part_store.c.id))
+                .where(part_store.c.part_store_name == old_parts.c.part_store_name).scalar_subquery())
+    type_id = select(func.min(part_type.c.id)).where(part_type.c.type_name == old_parts.c.type).scalar_subquery()
+
+    conn.execute(update(old_parts).values(part_store_id=store_id, part_type_id=type_id)
+                 .where(old_parts.c.id > low, old_parts.c.id <= high,
+                        (old_parts.c.part_store_id.is_(None) | old_parts.c.part_type_id.is_(None))))
+
+
+# Fill the part store id and convert the time of the jobs in (low, high] that do not have them yet.
+# Times are parsed here and written with one CASE expression, unreadable times are left NULL
+def fill_jobs(conn, low: int, high: int) -> None:
+    store_id = (select(func.min(part_store.c.id))
+                .where(part_store.c.part_store_name == old_jobs.c.part_store_name).scalar_subquery())
+    in_range = (old_jobs.c.job_id > low, old_jobs.c.job_id <= high)
+
+    conn.execute(update(old_jobs).values(part_store_id=store_id)
+                 .where(*in_range, old_jobs.c.part_store_id.is_(None)))
+
+    rows = conn.execute(select(old_jobs.c.job_id, old_jobs.c.time)
+                        .where(*in_range, old_jobs.c.new_time.is_(None), old_jobs.c.time.isnot(None))).fetchall()
+    times = {row.job_id: parse_time(row.time) for row in rows}
+    times = {job_id: value for job_id, value in times.items() if value is not None}
+
+    if times:
+        time_case = case({job_id: value for job_id, value in times.items()}, value=old_jobs.c.job_id,
+                         else_=old_jobs.c.new_time)
+        conn.execute(update(old_jobs).values(new_time=time_case).where(old_jobs.c.job_id.in_(list(times))))
+
+
+# Fill the new columns of every existing row of the tables that still have the name columns
+def backfill(engine, batch_size: int, log) -> None:
+    inspector = inspect(engine)
+
+    if 'part_store_name' in columns(inspector, 'jobs'):
+        in_batches(engine, old_jobs.c.job_id, batch_size, fill_jobs, log, 'jobs')
+
+    if 'part_store_name' not in columns(inspector, 'parts'):
+        return
+
+    in_batches(engine, old_parts.c.id, batch_size, fill_parts, log, 'parts')
+
+
+# Report the parts whose store or type name matched no row, they keep a NULL id
+def report_unmatched(engine, log) -> None:
+    if 'part_store_name' not in columns(inspect(engine), 'parts'):
+        return
+
+    with engine.connect() as conn:
+        missing_store = conn.execute(select(func.count()).select_from(old_parts).where(
+            old_parts.c.part_store_id.is_(None), old_parts.c.part_store_name.isnot(None))).scalar()
+        missing_type = conn.execute(select(func.count()).select_from(old_parts).where(
+            old_parts.c.part_type_id.is_(None), old_parts.c.type.isnot(None))).scalar()
+
+    if missing_store:
+        log(f'{missing_store} parts name a part store that does not exist, they are left without a store')
+    if missing_type:
+        log(f'{missing_type} parts name a part type that does not exist, they are left without a type')
+
+
+# Drop the name columns and add the new indexes and foreign keys with in place ALTERs
+def contract_mysql(engine, log) -> None:
+    inspector = inspect(engine)
+    old_columns = {'parts': {'part_store_name', 'type', 'unit'}, 'jobs': {'part_store_name', 'time'}}
+
+    with engine.connect() as conn:
+        for table_name, dropped in old_columns.items():
+            table_columns = columns(inspector, table_name)
+
+            if 'part_store_name' in table_columns:
+                for fk in inspector.get_foreign_keys(table_name):
+                    if set(fk['constrained_columns']) & dropped and fk.get('name'):
+                        alter(conn, f'ALTER TABLE {table_name} DROP FOREIGN KEY {fk["name"]}')
+
+                drops = [f'DROP INDEX {index["name"]}' for index in inspector.get_indexes(table_name)
+                         if set(index['column_names']) & dropped]
+                drops += [f'DROP COLUMN {column_name}' for column_name in sorted(dropped)
+                          if column_name in table_columns]
+                log(f'Dropping {", ".join(sorted(dropped & set(table_columns)))} from {table_name}')
+                alter(conn, f'ALTER TABLE {table_name} {", ".join(drops)}')
+
+        if 'new_time' in columns(inspect(engine), 'jobs'):
+            log('Renaming jobs.new_time to jobs.time')
+            alter(conn, 'ALTER TABLE jobs CHANGE COLUMN new_time time DATETIME NULL')
+
+        inspector = inspect(engine)
+        existing = {index['name'] for table_name in ('parts', 'jobs') for index in inspector.get_indexes(table_name)}
+        for index_name, table_name, index_columns in new_indexes:
+            if index_name not in existing:
+                log(f'Adding index {index_name}')
+                alter(conn, f'ALTER TABLE {table_name} ADD INDEX {index_name} ({index_columns})')
+
+        # Foreign keys are only added in place with the checks off, the backfill already matched every id
+        existing = {fk['name'] for table_name in ('parts', 'jobs') for fk in inspector.get_foreign_keys(table_name)}
+        conn.exec_driver_sql('SET foreign_key_checks = 0')
+        try:
+            for fk_name, table_name, column_name, referenced in new_foreign_keys:
+                if fk_name not in existing:
+                    log(f'Adding foreign key {fk_name}')
+                    alter(conn, f'ALTER TABLE {table_name} ADD CONSTRAINT {fk_name} FOREIGN KEY ({column_name}) '
+                                f'REFERENCES {referenced} (id) ON DELETE CASCADE')
+        finally:
+            conn.exec_driver_sql('SET foreign_key_checks = 1')
+
+
+# Rebuild parts and jobs without the name columns, for databases without in place ALTERs
+def contract_rebuild(engine, log) -> None:
+    parts, jobs = new_tables('parts_migrated', 'jobs_migrated')
+    job_columns = columns(inspect(engine), 'jobs')
+
+    with engine.connect() as conn:
+        foreign_keys = conn.dialect.name == 'sqlite' and conn.exec_driver_sql('PRAGMA foreign_keys').scalar()
+        if foreign_keys:
+            conn.exec_driver_sql('PRAGMA foreign_keys = OFF')
+
+        try:
+            with conn.begin():
+                if 'part_store_name' in columns(inspect(conn), 'parts'):
+                    log('Rebuilding parts')
+                    conn.execute(CreateTable(parts))
+                    conn.exec_driver_sql(
+                        'INSERT INTO parts_migrated (id, name, amount, part_number, part_store_id, part_type_id, '
+                        'low_thresh) SELECT id, name, amount, part_number, part_store_id, part_type_id, low_thresh '
+                        'FROM parts')
+                    conn.exec_driver_sql('DROP TABLE parts')
+                    conn.exec_driver_sql('ALTER TABLE parts_migrated RENAME TO parts')
+
+                if 'part_store_name' in job_columns:
+                    log('Rebuilding jobs')
+                    conn.execute(CreateTable(jobs))
+                    conn.exec_driver_sql('INSERT INTO jobs_migrated (job_id, username, time, part_store_id, parts_used) '
+                                         'SELECT job_id, username, new_time, part_store_id, parts_used FROM jobs')
+                    conn.exec_driver_sql('DROP TABLE jobs')
+                    conn.exec_driver_sql('ALTER TABLE jobs_migrated RENAME TO jobs')
+
+                for index_name, table_name, index_columns in new_indexes + kept_indexes:
+                    conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({index_columns})')
+        finally:
+            if foreign_keys:
+                conn.exec_driver_sql('PRAGMA foreign_keys = ON')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    expand(engine, log)
+    backfill(engine, batch_size, log)
+
+    # Catch up on rows the app wrote while the first pass ran
+    backfill(engine, batch_size, log)
+    report_unmatched(engine, log)
+
+    if engine.dialect.name == 'mysql':
+        contract_mysql(engine, log)
+    else:
+        contract_rebuild(engine, log)
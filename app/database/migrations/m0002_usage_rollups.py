@@ -0,0 +1,66 @@
+from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, Table, func, inspect, select, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import column, table
+
+from app.database.Rollups import increment
+
+# Rollup tables for the dashboard statistics. Jobs and parts used per store per day are rebuilt from
+# the job history batch_size jobs at a time; per part and per part type usage was never recorded per
+# part, so it starts empty and fills up as new jobs are submitted.
+# Run it before starting the version of the app that writes the rollups
+name = 'usage rollups'
+
+jobs = table('jobs', column('job_id'), column('part_store_id'), column('time'), column('parts_used'))
+
+metadata = MetaData()
+Table('part_store', metadata, Column('id', Integer, primary_key=True))
+Table('part_type', metadata, Column('id', Integer, primary_key=True))
+Table('parts', metadata, Column('id', Integer, primary_key=True))
+
+store_daily_usage = Table('store_daily_usage', metadata,
+                          Column('part_store_id', Integer, ForeignKey('part_store.id', ondelete='CASCADE'),
+                                 primary_key=True),
+                          Column('day', Date, primary_key=True, index=True),
+                          Column('jobs', Integer, nullable=False, server_default=text("'0'")),
+                          Column('parts_used', Integer, nullable=False, server_default=text("'0'")))
+part_usage = Table('part_usage', metadata,
+                   Column('part_id', Integer, ForeignKey('parts.id', ondelete='CASCADE'), primary_key=True),
+                   Column('units_used', Integer, nullable=False, index=True, server_default=text("'0'")))
+part_type_usage = Table('part_type_usage', metadata,
+                        Column('part_type_id', Integer, ForeignKey('part_type.id', ondelete='CASCADE'),
+                               primary_key=True),
+                        Column('units_used', Integer, nullable=False, server_default=text("'0'")))
+
+
+# Done once the rollup tables exist
+def is_applied(inspector) -> bool:
+    return all(inspector.has_table(i.name) for i in (store_daily_usage, part_usage, part_type_usage))
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    for rollup in (store_daily_usage, part_usage, part_type_usage):
+        if not inspect(engine).has_table(rollup.name):
+            log(f'Creating {rollup.name}')
+            rollup.create(engine)
+
+    # A rerun after an interruption starts the rebuild over
+    with engine.begin() as conn:
+        conn.execute(store_daily_usage.delete())
+        low, high = conn.execute(select(func.min(jobs.c.job_id), func.max(jobs.c.job_id))).first()
+
+    if low is None:
+        return
+
+    day = func.date(jobs.c.time, type_=Date)
+    for start in range(low - 1, high, batch_size):
+        stmt = (select(jobs.c.part_store_id, day.label('day'), func.count().label('jobs'),
+                       func.coalesce(func.sum(jobs.c.parts_used), 0).label('parts_used'))
+                .where(jobs.c.job_id > start, jobs.c.job_id <= start + batch_size,
+                       jobs.c.part_store_id.isnot(None), jobs.c.time.isnot(None))
+                .group_by(jobs.c.part_store_id, day))
+
+        with Session(engine) as session:
+            rows = [dict(row._mapping) for row in session.execute(stmt)]
+            increment(session, store_daily_usage, ['part_store_id', 'day'], rows)
+            session.commit()
+        log(f'store_daily_usage: jobs up to {min(start + batch_size, high)} of {high}')
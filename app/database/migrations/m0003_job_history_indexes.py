@@ -0,0 +1,36 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect
+
+from app.database.migrations import add_index, drop_index
+
+# Composite job history indexes for the store and user filters, ordered by time, and the compressed
+# jobs_archive table that archive-jobs moves old jobs into. Indexes are added in place on MySQL
+name = 'job history indexes'
+
+metadata = MetaData()
+jobs_archive = Table('jobs_archive', metadata,
+                     Column('job_id', Integer, primary_key=True, autoincrement=False),
+                     Column('username', String(255)),
+                     Column('time', DateTime, index=True),
+                     Column('part_store_id', Integer),
+                     Column('part_store_name', String(255)),
+                     Column('parts_used', Integer),
+                     mysql_row_format='COMPRESSED')
+
+
+# Done once the archive table exists
+def is_applied(inspector) -> bool:
+    return inspector.has_table('jobs_archive')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    with engine.begin() as conn:
+        log('Adding jobs_part_store_id_time_index and jobs_username_time_index')
+        add_index(conn, 'jobs_part_store_id_time_index', 'jobs', 'part_store_id, time')
+        add_index(conn, 'jobs_username_time_index', 'jobs', 'username, time')
+
+        # The (part_store_id, time) index also backs the part store foreign key
+        drop_index(conn, 'ix_jobs_part_store_id', 'jobs')
+
+    if not inspect(engine).has_table(jobs_archive.name):
+        log('Creating jobs_archive')
+        jobs_archive.create(engine)
@@ -0,0 +1,28 @@
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, MetaData, Table, inspect
+
+# Per line job ledger. Every part a job changes gets a line with the signed change and the amount left
+# afterwards. Jobs submitted before this migration only have their total, so the ledger starts empty
+name = 'job lines'
+
+metadata = MetaData()
+Table('parts', metadata, Column('id', Integer, primary_key=True))
+
+job_lines = Table('job_lines', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('job_id', Integer, index=True),
+                  Column('part_id', Integer, ForeignKey('parts.id', ondelete='CASCADE'), nullable=False),
+                  Column('delta', Integer, nullable=False),
+                  Column('quantity', Integer, nullable=False),
+                  Column('time', DateTime),
+                  Index('job_lines_part_id_time_index', 'part_id', 'time'))
+
+
+# Done once the ledger table exists
+def is_applied(inspector) -> bool:
+    return inspector.has_table('job_lines')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    if not inspect(engine).has_table(job_lines.name):
+        log('Creating job_lines')
+        job_lines.create(engine)
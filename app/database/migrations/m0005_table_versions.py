@@ -0,0 +1,31 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, insert, inspect, select
+
+# Change versions of the tables the pages are rendered from, used for their ETags. Every table starts at
+# version 0, so pages cached by browsers before this migration are never answered with 304
+name = 'table versions'
+
+metadata = MetaData()
+table_versions = Table('table_versions', metadata,
+                       Column('table_name', String(64), primary_key=True),
+                       Column('version', Integer, nullable=False, server_default='0'),
+                       Column('changed_at', DateTime))
+
+versioned_tables = ('accounts', 'jobs', 'part_store', 'part_type', 'parts')
+
+
+# Done once the versions table exists
+def is_applied(inspector) -> bool:
+    return inspector.has_table('table_versions')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    if not inspect(engine).has_table(table_versions.name):
+        log('Creating table_versions')
+        table_versions.create(engine)
+
+    with engine.begin() as conn:
+        existing = set(conn.execute(select(table_versions.c.table_name)).scalars())
+        missing = [{'table_name': i, 'version': 0} for i in versioned_tables if i not in existing]
+
+        if missing:
+            conn.execute(insert(table_versions), missing)
@@ -0,0 +1,23 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect
+
+# Log of the rows changed by committed writes, which the change feed streams to open pages
+name = 'change events'
+
+metadata = MetaData()
+change_events = Table('change_events', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('table_name', String(64), nullable=False),
+                      Column('row_id', Integer),
+                      Column('action', String(8), nullable=False),
+                      Column('time', DateTime, index=True))
+
+
+# Done once the change log exists
+def is_applied(inspector) -> bool:
+    return inspector.has_table('change_events')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    if not inspect(engine).has_table(change_events.name):
+        log('Creating change_events')
+        change_events.create(engine)
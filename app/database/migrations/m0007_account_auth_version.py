@@ -0,0 +1,35 @@
+from sqlalchemy import inspect
+
+from app.database.migrations import add_index, alter, columns
+
+# Accounts are looked up by a unique, indexed varchar username and carry the auth version that is bumped
+# when their admin or confirmed flags change. Accounts created from the oldest database.sql also get the
+# phone number column the models always had
+name = 'account auth version'
+
+
+# Done once accounts have the auth version
+def is_applied(inspector) -> bool:
+    return 'auth_version' in columns(inspector, 'accounts')
+
+
+def upgrade(engine, batch_size: int, log) -> None:
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        username = next(i for i in inspector.get_columns('accounts') if i['name'] == 'username')
+
+        # TEXT columns can't be indexed without a prefix length on MySQL, converting one copies the table
+        if conn.dialect.name == 'mysql' and 'TEXT' in str(username['type']).upper():
+            log('Converting accounts.username to varchar(255)')
+            conn.exec_driver_sql('ALTER TABLE accounts MODIFY username varchar(255) null')
+
+        if 'phone_num' not in columns(inspector, 'accounts'):
+            log('Adding accounts.phone_num')
+            alter(conn, 'ALTER TABLE accounts ADD COLUMN phone_num varchar(20) null')
+
+        if 'auth_version' not in columns(inspector, 'accounts'):
+            log('Adding accounts.auth_version')
+            alter(conn, 'ALTER TABLE accounts ADD COLUMN auth_version int default 0 null')
+
+        log('Adding accounts_username_uindex')
+        add_index(conn, 'accounts_username_uindex', 'accounts', 'username', unique=True)
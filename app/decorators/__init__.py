@@ -1,20 +1,220 @@
+from contextvars import ContextVar
 from os import environ
+from time import time
 
-from sqlalchemy import create_engine
+from flask import g, has_request_context, session as user_session
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import Session
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 
-engine = create_engine(f'mysql+pymysql://{environ.get("username")}:{environ.get("password")}@{environ.get("host")}:'
-                       f'{int(environ.get("db_port"))}/{environ.get("db")}', poolClass=NullPool)
+from app.decorators.replicas import Replicas
 
+# Connection pool settings, each one can be overridden through the environment
+pool_settings = {
+    'pool_size': int(environ.get('db_pool_size', 5)),
+    'max_overflow': int(environ.get('db_max_overflow', 10)),
+    'pool_timeout': int(environ.get('db_pool_timeout', 30)),
+    'pool_recycle': int(environ.get('db_pool_recycle', 1800)),
+    'pool_pre_ping': environ.get('db_pool_pre_ping', 'true').lower() != 'false'
+}
 
+# SQLite pragmas set on every new connection. WAL lets reads run while a write commits and NORMAL only syncs
+# at checkpoints in WAL mode, the page cache and memory map are per connection. Foreign keys enforce the
+# ON DELETE CASCADEs MySQL runs
+sqlite_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': environ.get('sqlite_synchronous', 'NORMAL'),
+    'foreign_keys': 'ON',
+    'busy_timeout': int(environ.get('sqlite_busy_timeout', 5000)),
+    'cache_size': -int(float(environ.get('sqlite_cache_mb', 64)) * 1024),
+    'mmap_size': int(float(environ.get('sqlite_mmap_mb', 256)) * 1024 * 1024),
+    'temp_store': 'MEMORY'
+}
+
+
+# URL of the database: database_url (like sqlite:////var/lib/inventory/parts.db), or the MySQL settings
+def database_url() -> str:
+    return environ.get('database_url') or (
+        f'mysql+pymysql://{environ.get("username")}:{environ.get("password")}@{environ.get("host")}:'
+        f'{int(environ.get("db_port", 3306))}/{environ.get("db")}')
+
+
+# Set the SQLite pragmas on a new connection
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+# Engine for a database URL. SQLite files are pooled like MySQL connections, so the connections and their
+# page caches are kept instead of reopening the file on every checkout, and shared between threads
+def create_database_engine(url: str):
+    if not url.startswith('sqlite'):
+        return create_engine(url, **pool_settings)
+
+    options = {}
+    if url not in ('sqlite://', 'sqlite:///:memory:'):
+        options = {'poolclass': QueuePool, 'connect_args': {'check_same_thread': False},
+                   **{name: pool_settings[name] for name in ('pool_size', 'max_overflow', 'pool_timeout')}}
+
+    engine = create_engine(url, **options)
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+engine = create_database_engine(database_url())
+
+# Read replicas of the database, comma separated SQLAlchemy URLs. Read only DatabaseManipulator methods run on them
+replicas = Replicas([url.strip() for url in environ.get('db_replica_urls', '').split(',') if url.strip()],
+                    create_database_engine, check_interval=float(environ.get('db_replica_check_interval', 5)))
+
+# Seconds the reads of a user who wrote something stay on the primary, longer than replication usually lags
+replica_pin_seconds = float(environ.get('db_replica_pin_seconds', 5))
+
+
+# Session the database calls of the current context run on when set, like the async layer's sessions
+current_session = ContextVar('current_session', default=None)
+
+
+# Open a new session on the pooled engine
+def new_session() -> Session:
+    session = Session(engine)
+    session.expire_on_commit = False
+    event.listen(session, 'do_orm_execute', mark_written)
+    return session
+
+
+# Remember that a session on the primary wrote something, its reads have to stay on it
+def mark_written(state) -> None:
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info['written'] = True
+
+
+# Whether the reads of the current request have to run on the primary: its session wrote something that may not
+# have been replayed by the replicas yet, in this request or in one of the user's requests before
+def primary_pinned() -> bool:
+    if not has_request_context():
+        return False
+    if 'db_session' in g and g.db_session.info.get('written'):
+        return True
+    return user_session.get('primary_until', 0) > time()
+
+
+# Session on a replica that has caught up with versions (the primary's table versions, or a function reading
+# them only when a replica could be used) for reads, or None to read from the primary
+def replica_session(versions) -> Session or None:
+    if not replicas or versions is None or primary_pinned():
+        return None
+
+    versions = versions() if callable(versions) else versions
+    return replicas.session(versions) if versions is not None else None
+
+
+# Share one session between every database call made during a Flask request,
+# otherwise (scripts, CLI, background work) open a session that is owned by the caller.
+# Calls made while current_session is set use that session, whoever set it commits.
+# Read only calls given the primary's table versions run on a replica session when one has caught up,
+# one per request, unless the request or the user wrote something recently. Given as a function, the
+# versions are only read when the replica session is opened
 class DatabaseSession:
+    def __init__(self, read_only: bool = False, versions=None):
+        self.read_only = read_only
+        self.versions = versions
+
     def __enter__(self):
-        self.session = Session(engine)
+        override = current_session.get()
+        self.owned = override is None and not has_request_context()
+        replica = self.read_only and override is None and not primary_pinned()
+
+        if override is not None:
+            self.session = override
+        elif self.owned:
+            self.session = (replica and replica_session(self.versions)) or new_session()
+        else:
+            if replica and 'db_replica_session' not in g:
+                g.db_replica_session = replica_session(self.versions)
 
-        self.session.expire_on_commit = False
+            if replica and g.db_replica_session is not None:
+                self.session = g.db_replica_session
+            else:
+                if 'db_session' not in g:
+                    g.db_session = new_session()
+                self.session = g.db_session
 
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.session.close()
+        if self.owned:
+            self.session.close()
+
+    # Roll back after a failed call. A shared session lost the earlier writes of its transaction with it, so it is
+    # flagged and whoever would commit it rolls back instead, nothing after the failure is committed either
+    def rollback(self) -> None:
+        self.session.rollback()
+
+        if not self.owned and self.replica is None:
+            self.session.info['failed'] = True
+
+    # The replica the session is on, or None
+    @property
+    def replica(self):
+        return self.session.info.get('replica')
+
+    # Take the session's replica out of rotation after its connection failed, the request's later reads
+    # run on the primary
+    def replica_failed(self) -> None:
+        replicas.failed(self.replica)
+
+        if has_request_context() and g.get('db_replica_session') is self.session:
+            g.db_replica_session = None
+            self.session.close()
+
+
+# Return the connections of the request's sessions to their pools before the request waits on work that needs
+# connections of its own, so it never holds one while waiting for another. Nothing is released and False is
+# returned when the request's session wrote something, its transaction has to stay open
+def release_request_connections() -> bool:
+    if not has_request_context():
+        return True
+    if 'db_session' in g and g.db_session.info.get('written'):
+        return False
+
+    for name in ('db_session', 'db_replica_session'):
+        if g.get(name) is not None:
+            g.get(name).commit()
+    return True
+
+
+# Keep the reads of a user whose request wrote something on the primary for replica_pin_seconds
+def pin_writer(response):
+    if replicas and 'db_session' in g and g.db_session.info.get('written'):
+        user_session['primary_until'] = time() + replica_pin_seconds
+    return response
+
+
+# Commit or roll back the request's session once, when the request is torn down. It is rolled back when the
+# request raised or one of its database calls failed
+def close_request_session(exception=None) -> None:
+    replica = g.pop('db_replica_session', None)
+    if replica is not None:
+        replica.close()
+
+    session = g.pop('db_session', None)
+
+    if session is None:
+        return
+
+    try:
+        if exception is None and not session.info.get('failed'):
+            session.commit()
+        else:
+            session.rollback()
+    finally:
+        session.close()
+
+
+# Register the request scoped session teardown on the Flask app
+def init_app(app) -> None:
+    app.after_request(pin_writer)
+    app.teardown_request(close_request_session)
@@ -1,12 +1,16 @@
 from functools import wraps
+from hmac import compare_digest
 from inspect import getframeinfo, currentframe
+from os import environ
 
-from flask import redirect, url_for, session
+from flask import Response, current_app, jsonify, redirect, request, url_for, session
 
 from pymysql import Error
 from sqlalchemy.exc import OperationalError
 
-from app.decorators import DatabaseSession
+from app.database.TableVersions import table_versions
+from app.decorators import DatabaseSession, replicas
+from app.profiler import record_call
 
 
 # Make sure the user is logged in
@@ -26,31 +30,106 @@ def admin_login_required(func):
     def decorated_function(*args, **kwargs):
         if 'logged_in' not in session:
             return redirect(url_for('login'))
-        elif not session['is_admin']:
+        elif not session.get('is_admin'):
             return redirect(url_for('index'))
         return func(*args, **kwargs)
 
     return decorated_function
 
 
-# Connect to the database and roll back commits when exceptions are thrown
-def db_connector(f):
+# Bearer tokens of API clients that aren't browsers, scripts importing parts and Prometheus scraping
+# /metrics. Empty disables them
+api_token = environ.get('api_token', '')
+metrics_token = environ.get('metrics_token', '')
+
+
+# Whether an Authorization header carries token as its bearer token
+def bearer_token_matches(authorization: str, token: str) -> bool:
+    scheme, _, sent = authorization.partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and compare_digest(sent.encode(), token.encode())
+
+
+# Let API clients in with the api_token as a bearer token, browsers with an admin session and a CSRF token.
+# Views using it are exempt from the app wide CSRF check, which would refuse the token clients
+def admin_or_token_required(func):
+    admin_func = admin_login_required(func)
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        authorization = request.headers.get('Authorization')
+
+        if authorization is not None:
+            if not bearer_token_matches(authorization, api_token):
+                return jsonify(error='401: Invalid API token'), 401
+            return func(*args, **kwargs)
+
+        if current_app.config.get('WTF_CSRF_ENABLED', True):
+            current_app.extensions['csrf'].protect()
+        return admin_func(*args, **kwargs)
+
+    return decorated_function
+
+
+# Let scrapers in with the metrics_token as a bearer token, browsers with an admin session
+def metrics_access_required(func):
+    admin_func = admin_login_required(func)
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        authorization = request.headers.get('Authorization')
+
+        if authorization is not None:
+            if not bearer_token_matches(authorization, metrics_token):
+                return Response('401: Invalid metrics token\n', 401, mimetype='text/plain')
+            return func(*args, **kwargs)
+        return admin_func(*args, **kwargs)
+
+    return decorated_function
+
+
+# Connect to the database and roll back commits when exceptions are thrown.
+# Standalone sessions are committed here, request sessions are committed once in teardown,
+# or rolled back there when one of the request's calls failed.
+# Read only methods run on a replica when there are replicas, see db_reader
+def db_connector(f, read_only: bool = False):
+    @wraps(f)
     def with_connection_(*args, **kwargs):
-        with DatabaseSession() as conn:
-            try:
-                result = f(*args, connnection=conn, **kwargs)
-            except Error or OperationalError as e:
-                print(str(getframeinfo(currentframe()).function) + '\n' + 'Line: ' +
-                      str(getframeinfo(currentframe()).lineno) + '\n' + str(e))
-                conn.rollback()
-            except TypeError as e:
-                print(str(getframeinfo(currentframe()).function) + '\n' + 'Line: ' +
-                      str(getframeinfo(currentframe()).lineno) +
-                      '\n' + str(e) + '\n'
-                      + 'Blank input detected, database not manipulated')
-                conn.rollback()
-            finally:
-                conn.close()
-            return result
+        record_call(f.__qualname__)
+        db_session = DatabaseSession(read_only, table_versions.for_request if read_only and replicas else None)
+        result, failed = call_with_connection(db_session, f, args, kwargs)
+
+        # A replica that can't be reached is taken out of rotation and the read runs again on the primary
+        if failed and db_session.replica is not None:
+            db_session.replica_failed()
+            result, failed = call_with_connection(DatabaseSession(), f, args, kwargs)
+        return result
 
     return with_connection_
+
+
+# db_connector for methods that only read, they run on a replica that has caught up with the primary
+def db_reader(f):
+    return db_connector(f, read_only=True)
+
+
+# Call f on the session's connection, returns its result and whether the database call failed
+def call_with_connection(db_session: DatabaseSession, f, args: tuple, kwargs: dict) -> tuple:
+    with db_session as conn:
+        try:
+            result = f(*args, connection=conn, **kwargs)
+
+            if db_session.owned:
+                conn.commit()
+            return result, False
+        except (Error, OperationalError) as e:
+            print(str(getframeinfo(currentframe()).function) + '\n' + 'Line: ' +
+                  str(getframeinfo(currentframe()).lineno) + '\n' + str(e))
+            db_session.rollback()
+            return None, True
+        except TypeError as e:
+            print(str(getframeinfo(currentframe()).function) + '\n' + 'Line: ' +
+                  str(getframeinfo(currentframe()).lineno) +
+                  '\n' + str(e) + '\n'
+                  + 'Blank input detected, database not manipulated')
+            db_session.rollback()
+            return None, False
@@ -0,0 +1,113 @@
+from itertools import count
+from threading import Lock, Thread
+from time import sleep
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.database.DatabaseTables import TableVersion
+
+
+# Read replicas of the primary database. Read sessions are opened on the replicas round robin, skipping the ones
+# that are down: a replica whose connection fails is taken out of rotation and pinged every check_interval
+# seconds, by a background thread that runs while any replica is down, until it answers again. A replica only
+# serves a session once it has replayed the table versions it is given (the primary's), so the rows read from
+# it are never older than the versions pages and ETags are keyed by
+class Replicas:
+    def __init__(self, urls: list, create=create_engine, check_interval: float = 5):
+        self.create = create
+        self.engines = []
+        self.check_interval = check_interval
+        self.sessions = 0
+        self.behind = 0
+        self.failures = 0
+        self._down = set()
+        self._next = count()
+        self._checking = False
+        self._lock = Lock()
+        self.configure(urls)
+
+    def __bool__(self) -> bool:
+        return bool(self.engines)
+
+    # Replace the replicas by the databases at urls, like the benchmarks' throwaway copies
+    def configure(self, urls: list) -> None:
+        engines = [self.create(url) for url in urls]
+
+        with self._lock:
+            self.engines = engines
+            self._down.clear()
+
+    # A session on the next replica that is up and has caught up with versions ({table_name: (version, ...)}),
+    # or None when none has
+    def session(self, versions: dict) -> Session or None:
+        with self._lock:
+            up = [engine for engine in self.engines if engine not in self._down]
+            start = next(self._next)
+
+        for i in range(len(up)):
+            engine = up[(start + i) % len(up)]
+            session = Session(engine)
+            session.expire_on_commit = False
+            session.info['replica'] = engine
+
+            try:
+                stmt = select(TableVersion.table_name, TableVersion.version)
+                replayed = {row.table_name: row.version for row in session.execute(stmt)}
+            except SQLAlchemyError as e:
+                print(str(e))
+                session.close()
+                self.failed(engine)
+                continue
+
+            if all(replayed.get(name, -1) >= version[0] for name, version in versions.items()):
+                with self._lock:
+                    self.sessions += 1
+                return session
+
+            session.close()
+            with self._lock:
+                self.behind += 1
+        return None
+
+    # Take a replica out of rotation until it answers a ping again, dropping its pooled connections
+    def failed(self, engine) -> None:
+        engine.dispose()
+
+        with self._lock:
+            self.failures += 1
+            self._down.add(engine)
+
+            if not self._checking:
+                self._checking = True
+                Thread(target=self._check, daemon=True).start()
+
+    # Ping the replicas that are down until none is left
+    def _check(self) -> None:
+        while True:
+            sleep(self.check_interval)
+
+            with self._lock:
+                down = list(self._down)
+
+            for engine in down:
+                try:
+                    with engine.connect() as connection:
+                        connection.execute(text('SELECT 1'))
+                except SQLAlchemyError:
+                    continue
+
+                with self._lock:
+                    self._down.discard(engine)
+
+            with self._lock:
+                if not self._down:
+                    self._checking = False
+                    return
+
+    # Replicas in rotation and down, sessions opened on them and refused because the replica was behind
+    def stats(self) -> dict:
+        with self._lock:
+            return {'replicas': len(self.engines), 'down': len(self._down), 'sessions': self.sessions,
+                    'behind': self.behind, 'failures': self.failures}
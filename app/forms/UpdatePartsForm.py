@@ -9,6 +9,8 @@ class UpdatePartsForm(FlaskForm):
     partName = StringField('Part Name', validators=[DataRequired()])
     partNumber = StringField('Part Number', validators=[DataRequired()])
     newPartAmount = IntegerField('Part Amount', validators=[DataRequired()])
+    # The amount the form was filled in with, the edit is applied as the difference to it
+    partAmount = HiddenField()
     newPartStore = SelectField(validators=[DataRequired()])
     newUnit = SelectField('Select Unit', validators=[DataRequired()])
     confirmUpdateBtn = SubmitField('Submit')
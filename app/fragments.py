@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from functools import wraps
+from os import environ
+from secrets import token_hex
+from threading import Lock
+
+from flask import current_app, g, make_response, request
+from flask_wtf.csrf import generate_csrf
+
+from app.database.TableVersions import table_versions
+
+
+# LRU cache of rendered table fragments shared by every user, keyed by the versions of the tables a fragment is
+# rendered from, its URL (which holds the store or type id and the page) and a per user variant. Entries are
+# evicted oldest first once they take more than max_bytes. CSRF tokens are rendered as a placeholder and
+# the requesting user's token is spliced in on the way out, so no user's token is ever served to another
+class FragmentCache:
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.placeholder = 'csrf-' + token_hex(16)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    # Cached body for key, or None
+    def get(self, key: tuple) -> bytes or None:
+        with self._lock:
+            body = self._entries.get(key)
+
+            if body is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    # Cache a body, evicting the least recently used entries past max_bytes. Bodies larger than a quarter
+    # of the cache are not kept
+    def put(self, key: tuple, body: bytes) -> None:
+        if len(body) > self.max_bytes // 4:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            self.size += len(body) - (len(previous) if previous is not None else 0)
+            self._entries[key] = body
+
+            while self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+    # Render a view with every CSRF token it asks for replaced by the placeholder
+    def _render(self, func, *args, **kwargs):
+        field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+        token = g.pop(field_name, None)
+        setattr(g, field_name, self.placeholder)
+
+        try:
+            return make_response(func(*args, **kwargs))
+        finally:
+            g.pop(field_name, None)
+            if token is not None:
+                setattr(g, field_name, token)
+
+    # Splice the requesting user's CSRF token into a cached body
+    def _splice(self, body: bytes) -> bytes:
+        placeholder = self.placeholder.encode()
+
+        if placeholder in body:
+            return body.replace(placeholder, generate_csrf().encode())
+        return body
+
+    # Decorator caching the HTML a GET view renders. tables is a function of the view's arguments returning the
+    # tables it reads (None for views that are never cached), variant() the parts of the user it depends on
+    def cached(self, tables, variant=None):
+        def decorator(func):
+            @wraps(func)
+            def decorated_function(*args, **kwargs):
+                names = tables(**kwargs) if request.method == 'GET' else None
+                versions = table_versions.get() if names else None
+
+                if versions is None:
+                    return func(*args, **kwargs)
+
+                # Versions are read before the view queries anything, so an entry is never older than its key
+                key = (request.full_path, tuple(versions.get(name, (0, None))[0] for name in names),
+                       variant(**kwargs) if variant else None)
+                body = self.get(key)
+
+                if body is None:
+                    response = self._render(func, *args, **kwargs)
+
+                    if response.is_streamed:
+                        return response
+
+                    body = response.get_data()
+                    if response.status_code != 200 or response.mimetype != 'text/html':
+                        response.set_data(self._splice(body))
+                        return response
+                    self.put(key, body)
+
+                return make_response(self._splice(body))
+
+            return decorated_function
+
+        return decorator
+
+    # Drop every cached fragment
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    # Hit/miss counters, entries and bytes used
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+
+fragment_cache = FragmentCache(max_bytes=int(float(environ.get('fragment_cache_mb', 32)) * 1024 * 1024))
@@ -0,0 +1,155 @@
+from atexit import register
+from collections import OrderedDict
+from os import environ, getpid
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import sleep
+
+from requests import post
+from requests.exceptions import ConnectionError, RequestException
+
+
+# Background SMS sender for the Till gateway.
+# Messages are collected per recipient for batch_window seconds, repeated alerts with the same key
+# are coalesced into the newest one, and each batch is posted by a pool of worker threads with
+# exponential backoff between retries, so requests never wait on the gateway. What is queued is still
+# sent when the process exits
+class SmsDispatcher:
+    def __init__(self, url: str = None, workers: int = 2, batch_window: float = 2.0, max_retries: int = 3,
+                 backoff: float = 1.0, timeout: float = 10.0):
+        self.url = url
+        self.workers = workers
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.counters = {'enqueued': 0, 'coalesced': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+
+        self._pending = OrderedDict()
+        self._queue = Queue()
+        self._lock = Lock()
+        self._stopping = Event()
+        self._threads = []
+        self._pid = None
+        self._exit_registered = False
+
+    # Start the batching thread and the worker pool, again after a fork (gunicorn workers)
+    def start(self) -> None:
+        with self._lock:
+            if self._pid == getpid():
+                return
+
+            self._pid = getpid()
+            self._stopping.clear()
+            self._threads = [Thread(target=self._batch_loop, name='sms-batcher', daemon=True)]
+            self._threads += [Thread(target=self._send_loop, name=f'sms-worker-{i}', daemon=True)
+                              for i in range(self.workers)]
+
+            for thread in self._threads:
+                thread.start()
+
+            # Forked processes inherit the registration
+            if not self._exit_registered:
+                self._exit_registered = True
+                register(self.stop, self.timeout)
+
+    # Queue a message for a phone number, a newer message with the same key replaces the pending one
+    def enqueue(self, phone_num: str, text: str, key: str = None) -> None:
+        self.start()
+
+        with self._lock:
+            messages = self._pending.setdefault(phone_num, OrderedDict())
+            key = key if key is not None else len(messages)
+
+            if key in messages:
+                self.counters['coalesced'] += 1
+                messages.pop(key)
+            messages[key] = text
+            self.counters['enqueued'] += 1
+
+    # Hand every pending batch to the workers now
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+
+        # Recipients receiving the same text share one gateway request
+        batches = OrderedDict()
+        for phone_num, messages in pending.items():
+            batches.setdefault('\n'.join(messages.values()), []).append(phone_num)
+
+        for text, phone_nums in batches.items():
+            self._queue.put((phone_nums, text))
+
+    # Flush what is pending, wait for the workers to drain the queue and stop the threads
+    def stop(self, timeout: float = None) -> None:
+        self.flush()
+        self._stopping.set()
+
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    # Counters and the current backlog
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, 'pending': len(self._pending), 'queued': self._queue.qsize()}
+
+    def _batch_loop(self) -> None:
+        while not self._stopping.wait(self.batch_window):
+            self.flush()
+
+    def _send_loop(self) -> None:
+        while True:
+            try:
+                phone_nums, text = self._queue.get(timeout=0.5)
+            except Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            try:
+                self._send(phone_nums, text)
+            finally:
+                self._queue.task_done()
+
+    # Post one batch, retrying with exponential backoff when the gateway can't be reached, is rate limiting
+    # (429) or failed (5xx). Other responses and errors would fail again, and a request that timed out
+    # may have been sent already, those aren't retried
+    def _send(self, phone_nums: list, text: str) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = post(url=self.url or environ.get('TILL_URL'),
+                                headers={'Content-Type': 'application/json'},
+                                json={'phone': ['1' + i for i in phone_nums], 'method': 'SMS', 'text': text},
+                                timeout=self.timeout)
+
+                if response.status_code == 200:
+                    self._count('sent')
+                    return True
+                elif response.status_code != 429 and response.status_code < 500:
+                    print(f'SMS gateway refused the batch: {response.status_code}')
+                    break
+            except ConnectionError as e:
+                print('SMS gateway error: ' + str(e))
+            except RequestException as e:
+                print('SMS gateway error: ' + str(e))
+                break
+
+            if attempt < self.max_retries:
+                self._count('retried')
+                sleep(self.backoff * 2 ** attempt)
+
+        self._count('failed')
+        return False
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self.counters[counter] += 1
+
+
+sms_dispatcher = SmsDispatcher(workers=int(environ.get('sms_workers', 2)),
+                               batch_window=float(environ.get('sms_batch_window', 2)),
+                               max_retries=int(environ.get('sms_max_retries', 3)),
+                               backoff=float(environ.get('sms_backoff', 1)),
+                               timeout=float(environ.get('sms_timeout', 10)))
@@ -0,0 +1,235 @@
+from collections import defaultdict
+from os import environ
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.conditional import stats as conditional_stats
+from app.database.ChangeFeed import change_feed
+from app.database.ReferenceCache import reference_cache
+from app.database.TableVersions import table_versions
+from app.decorators import replicas
+from app.fragments import fragment_cache
+from app.notifications.SmsDispatcher import sms_dispatcher
+
+# Opt-in per request instrumentation, enabled with profile_requests=true
+enabled = environ.get('profile_requests', 'false').lower() == 'true'
+
+# Histogram buckets (seconds) for statement latency
+query_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+# Process wide totals exposed on /metrics in the Prometheus text format
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = defaultdict(int)
+        self.request_seconds = defaultdict(float)
+        self.request_queries = defaultdict(int)
+        self.dbm_calls = defaultdict(int)
+        self.query_buckets = [0] * len(query_buckets)
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.checkout_count = 0
+        self.checkout_seconds = 0.0
+        self.render_count = 0
+        self.render_seconds = 0.0
+
+    # Add a finished request's profile to the totals
+    def add(self, endpoint: str, profile: dict, seconds: float) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.request_seconds[endpoint] += seconds
+            self.request_queries[endpoint] += profile['queries']
+
+            for name, count in profile['dbm_calls'].items():
+                self.dbm_calls[name] += count
+
+            for duration in profile['statements']:
+                self.query_count += 1
+                self.query_seconds += duration
+                for i, bucket in enumerate(query_buckets):
+                    if duration <= bucket:
+                        self.query_buckets[i] += 1
+
+            self.checkout_count += profile['checkouts']
+            self.checkout_seconds += profile['checkout_seconds']
+            self.render_count += profile['renders']
+            self.render_seconds += profile['render_seconds']
+
+    # Render the totals in the Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, description: str, samples: list):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+
+        with self.lock:
+            metric('inventory_requests_total', 'counter', 'Requests handled per endpoint.',
+                   [(f'{{endpoint="{k}"}}', v) for k, v in self.requests.items()])
+            metric('inventory_request_seconds_total', 'counter', 'Time spent handling requests per endpoint.',
+                   [(f'{{endpoint="{k}"}}', round(v, 6)) for k, v in self.request_seconds.items()])
+            metric('inventory_request_queries_total', 'counter', 'SQL statements executed per endpoint.',
+                   [(f'{{endpoint="{k}"}}', v) for k, v in self.request_queries.items()])
+            metric('inventory_dbm_calls_total', 'counter', 'DatabaseManipulator calls per method.',
+                   [(f'{{method="{k}"}}', v) for k, v in self.dbm_calls.items()])
+
+            cumulative = [(f'{{le="{b}"}}', n) for b, n in zip(query_buckets, self.query_buckets)]
+            metric('inventory_query_duration_seconds', 'histogram', 'SQL statement latency.',
+                   [('_bucket' + labels, n) for labels, n in cumulative] +
+                   [('_bucket{le="+Inf"}', self.query_count), ('_sum', round(self.query_seconds, 6)),
+                    ('_count', self.query_count)])
+            metric('inventory_connection_checkout_seconds', 'summary', 'Time to check a connection out of the pool.',
+                   [('_sum', round(self.checkout_seconds, 6)), ('_count', self.checkout_count)])
+            metric('inventory_template_render_seconds', 'summary', 'Time spent rendering templates.',
+                   [('_sum', round(self.render_seconds, 6)), ('_count', self.render_count)])
+
+        cache = reference_cache.stats()
+        metric('inventory_reference_cache_total', 'counter', 'Reference data cache lookups by result.',
+               [('{result="hit"}', cache['hits']), ('{result="miss"}', cache['misses'])])
+        fragments = fragment_cache.stats()
+        metric('inventory_fragment_cache_total', 'counter', 'Rendered fragment cache lookups by result.',
+               [('{result="hit"}', fragments['hits']), ('{result="miss"}', fragments['misses'])])
+        metric('inventory_fragment_cache_bytes', 'gauge', 'Bytes of rendered fragments cached.',
+               [('', fragments['bytes'])])
+        metric('inventory_conditional_responses_total', 'counter', 'Conditional GET responses by result.',
+               [(f'{{result="{k}"}}', v) for k, v in conditional_stats().items()])
+        metric('inventory_table_versions_reads_total', 'counter', 'Table versions read from the database.',
+               [('', table_versions.stats()['reads'])])
+        feed = change_feed.stats()
+        metric('inventory_change_streams', 'gauge', 'Open change feed streams.', [('', feed['clients'])])
+        metric('inventory_change_batches_total', 'counter', 'Change feed batches read from the change log.',
+               [('', feed['batches'])])
+        replica = replicas.stats()
+        metric('inventory_replicas', 'gauge', 'Read replicas by state.',
+               [('{state="up"}', replica['replicas'] - replica['down']), ('{state="down"}', replica['down'])])
+        metric('inventory_replica_sessions_total', 'counter', 'Read sessions opened on replicas or refused by result.',
+               [('{result="opened"}', replica['sessions']), ('{result="behind"}', replica['behind']),
+                ('{result="failed"}', replica['failures'])])
+        metric('inventory_sms_total', 'counter', 'SMS dispatcher events.',
+               [(f'{{event="{k}"}}', v) for k, v in sms_dispatcher.stats().items()
+                if k not in ('pending', 'queued')])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# The profile of the current request, or None when profiling is off or outside a request
+def current_profile() -> dict or None:
+    if enabled and has_request_context():
+        return g.get('profile')
+    return None
+
+
+# Count a DatabaseManipulator call, called by db_connector
+def record_call(name: str) -> None:
+    profile = current_profile()
+
+    if profile is not None:
+        with profile['lock']:
+            profile['dbm_calls'][name] += 1
+
+
+# The start time is kept on the statement's execution context, a statement that fails leaves nothing behind
+# on the pooled connection
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = perf_counter() - context._query_start
+    profile = current_profile()
+
+    if profile is not None:
+        with profile['lock']:
+            profile['queries'] += 1
+            profile['query_seconds'] += duration
+            profile['statements'].append(duration)
+
+
+# The first execute on a session without a transaction starts a pool checkout, after_begin ends it
+def do_orm_execute(orm_execute_state):
+    if not orm_execute_state.session.in_transaction():
+        orm_execute_state.session.info['checkout_start'] = perf_counter()
+
+
+def after_begin(session, transaction, connection):
+    start = session.info.pop('checkout_start', None)
+    profile = current_profile()
+
+    if start is not None and profile is not None:
+        with profile['lock']:
+            profile['checkouts'] += 1
+            profile['checkout_seconds'] += perf_counter() - start
+
+
+# Jinja template that records how long each top level render takes
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = perf_counter()
+
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            profile = current_profile()
+
+            if profile is not None:
+                with profile['lock']:
+                    profile['renders'] += 1
+                    profile['render_seconds'] += perf_counter() - start
+
+
+# The gathered reads of a request run on other threads and add to its profile too, under its lock
+def start_profile() -> None:
+    g.profile = {'start': perf_counter(), 'queries': 0, 'query_seconds': 0.0, 'statements': [],
+                 'dbm_calls': defaultdict(int), 'checkouts': 0, 'checkout_seconds': 0.0,
+                 'renders': 0, 'render_seconds': 0.0, 'lock': Lock()}
+
+
+# Add the Server-Timing header and fold the request into the process metrics
+def finish_profile(response: Response) -> Response:
+    profile = g.pop('profile', None)
+
+    if profile is None or request.endpoint in (None, 'static', 'metrics'):
+        return response
+
+    seconds = perf_counter() - profile['start']
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={profile["query_seconds"] * 1000:.2f};desc="{profile["queries"]} queries, '
+        f'{sum(profile["dbm_calls"].values())} dbm calls"',
+        f'checkout;dur={profile["checkout_seconds"] * 1000:.2f}',
+        f'render;dur={profile["render_seconds"] * 1000:.2f}',
+        f'total;dur={seconds * 1000:.2f}'])
+
+    metrics.add(request.endpoint, profile, seconds)
+    return response
+
+
+# Prometheus scrape endpoint
+def metrics_view() -> Response:
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Install the hooks and the /metrics endpoint when profiling is enabled, /metrics behind the access check
+# require wraps it in
+def init_app(app, require) -> None:
+    if not enabled:
+        return
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Session, 'do_orm_execute', do_orm_execute)
+    event.listen(Session, 'after_begin', after_begin)
+
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.add_url_rule('/metrics', 'metrics', require(metrics_view))
@@ -0,0 +1,37 @@
+$(function () {
+    let path = window.location.pathname.replace(/\/+$/, '').split('/');
+    let name = decodeURIComponent(path[3] || '').toLowerCase();
+
+    // Element, fragment and tables shown by each page, and which parts belong on it
+    if (path[1] === 'parts' && !path[2]) {
+        ns.liveUpdates('#table', '/table/main/all', ['parts', 'part_store', 'part_type'], null);
+    } else if (path[1] === 'parts' && path[2] === 'stores' && path[3]) {
+        ns.liveUpdates('#table', '/table/part_store_list/' + path[3], ['parts', 'part_store', 'part_type'],
+            function (row) {
+                return String(row.part_store_name).toLowerCase() === name;
+            });
+    } else if (path[1] === 'parts' && path[2] === 'stores') {
+        ns.liveUpdates('#mySpan', '/table/part_store_list/all', ['part_store'], null);
+    } else if (path[1] === 'parts' && path[2] === 'type' && path[3]) {
+        ns.liveUpdates('#table', '/table/part_type_list/' + path[3], ['parts', 'part_store', 'part_type'],
+            function (row) {
+                return String(row.type).toLowerCase() === name;
+            });
+    } else if (path[1] === 'parts' && path[2] === 'type') {
+        ns.liveUpdates('#table', '/table/part_type_list/all', ['part_type'], null);
+    } else if (path[1] === 'parts') {
+        ns.liveUpdates('#info', '/table/display_part/' + path[2], ['parts', 'part_store', 'part_type'],
+            function (row) {
+                return String(row.id) === path[2];
+            });
+    } else if (path[1] === 'jobs' && path[2]) {
+        let store = decodeURIComponent(path[2]).toLowerCase();
+        ns.liveUpdates('#table', '/table/jobs/' + path[2], ['parts', 'part_store'], function (row) {
+            return String(row.part_store_name).toLowerCase() === store;
+        });
+    } else if (path[1] === 'jobs') {
+        ns.liveUpdates('#table', '/table/jobs/all', ['jobs', 'part_store'], null);
+    } else if (path[1] === 'users') {
+        ns.liveUpdates('#table', '/table/users/default', ['accounts'], null);
+    }
+});
@@ -41,6 +41,58 @@
         }
     }
 
+    // Keep the current page, sort and filter query arguments when reloading a table
+    let pagePath = function (getPath) {
+        return getPath + window.location.search;
+    }
+
+    // Change feed of the page, tables are kept up to date by it while it's open
+    let liveFeed = null;
+
+    // Reload a table after an action, unless the change feed brings the change
+    let reloadTable = function (element, getPath) {
+        if (!liveFeed || liveFeed.readyState !== EventSource.OPEN) {
+            $(element).load(pagePath(getPath));
+        }
+    }
+
+    // Show a part's current values in its row. The inputs of a row being edited keep what was typed, its edit is
+    // sent relative to the amount the row was loaded with. On the job page an amount that wasn't changed follows
+    // the stock, a changed one keeps the change
+    let patchPart = function (row) {
+        let id = row.id;
+
+        if ($('#thisPartName' + id).is(':visible')) {
+            $('#partName' + id).val(row.name).attr('value', row.name);
+            $('#partNumber' + id).val(row.part_number).attr('value', row.part_number);
+            $('#newPartAmount' + id).val(row.amount).attr('value', row.amount);
+        }
+        $('#thisPartName' + id).text(row.name);
+        $('#thisPartNumber' + id).text(row.part_number);
+        $('#thisPartStoreName' + id).text(row.part_store_name);
+        $('#thisAmount' + id).text(row.type ? row.amount + ' ' + row.unit : row.amount);
+        $('#thisPartUnit' + id).text(row.type || '');
+
+        $('.changeAmount[data-value="' + id + '"]').each(function () {
+            let change = parseInt($(this).val()) - parseInt($(this).attr('max'));
+            $(this).attr('max', row.amount).attr('id', 'changeAmount' + row.amount)
+                .val(Math.max(0, row.amount + (isNaN(change) ? 0 : change)));
+            $(this).closest('tr').find('.resetValBtn').attr('id', 'resetValBtn' + row.amount)
+                .attr('data-value', row.amount);
+            $(this).closest('tr').find('td').first().text(row.name);
+        });
+    }
+
+    // Remove a deleted part's row
+    let removePart = function (id) {
+        $('#thisPartName' + id + ', .changeAmount[data-value="' + id + '"]').closest('tr').remove();
+    }
+
+    // Whether a part has a row on the page
+    let hasPart = function (id) {
+        return $('#thisPartName' + id + ', .changeAmount[data-value="' + id + '"]').length > 0;
+    }
+
     // POST request function
     let postRequest = function (url, data, toggles, enctype, getPath, extras, type) {
         $('html').css('cursor', 'progress');
@@ -55,7 +107,7 @@
 
                 // On success, load the span from the getPath
                 success: function () {
-                    $('#table').load(getPath);
+                    reloadTable('#table', getPath);
                     toggleProps(toggles);
                     $('html').css('cursor', 'default');
                     return extras;
@@ -63,7 +115,15 @@
 
                 // On failure, print errors
                 error: function (e) {
-                    if (e.status === 409) {
+                    if (e.status === 409 && e.responseJSON && e.responseJSON.conflicts) {
+                        $('#instructions').html('The stock changed while editing, the current amounts were reloaded.')
+                            .css('color', 'red');
+                        $('#table').load(pagePath(getPath));
+                    } else if (e.status === 404 && e.responseJSON && e.responseJSON.deleted) {
+                        $('#instructions').html('The part was deleted while editing, the table was reloaded.')
+                            .css('color', 'red');
+                        $('#table').load(pagePath(getPath));
+                    } else if (e.status === 409) {
                         $('#instructions').html('Duplicate entries are not allowed.').css('color', 'red');
                     } else {
                         console.log('ERROR : ', e);
@@ -108,7 +168,7 @@
 
                 // On success, load the span from the getPath
                 success: function () {
-                    $('#table').load(getPath);
+                    reloadTable('#table', getPath);
                     toggleProps(toggles);
                     $('html').css('cursor', 'default');
                     return extras;
@@ -374,7 +434,8 @@
                                         window.location.pathname.split('/')[3] + '</b>').css('color', 'black');
                                 }
                             };
-                            text = 'id=' + id + '&partName=' + partNameHtml + '&newPartAmount=' + partAmountHtml + '&partNumber=' +
+                            text = 'id=' + id + '&partName=' + partNameHtml + '&newPartAmount=' + partAmountHtml +
+                                '&partAmount=' + origVal(partAmount) + '&partNumber=' +
                                 partNumberHtml + '&newPartStore=' + storeNameHtml()
                                 + '&newUnit=' + partUnitHtml;
                             url = (window.location.pathname.split('/')[2] !== 'type' && window.location.pathname !== '/parts'
@@ -551,6 +612,7 @@
                         let orig = $(this).attr('max');
                         let item = {}
                         item['amount'] = amount;
+                        item['original'] = orig;
                         item['part_id'] = id;
 
                         // Make sure the values are not more than what exists in the database
@@ -579,13 +641,23 @@
                         // On success, load the span from the getPath
                         success: function () {
                             $(instructions).html('Record a job in the database: ').css('color', 'black');
-                            $('#table').load(getPath);
+                            $('#table').load(pagePath(getPath));
                             toggleProps(toggles);
                         },
 
-                        // On failure, print errors
+                        // On a conflict other jobs took stock meanwhile, reload the current amounts. If the job
+                        // couldn't be recorded ask to submit again. Else print errors
                         error: function (e) {
-                            console.log('ERROR : ', e);
+                            if (e.status === 409) {
+                                $(instructions).html('Another job changed the stock, check the amounts and submit again.')
+                                    .css('color', 'red');
+                                $('#table').load(pagePath(getPath));
+                            } else if (e.status === 503) {
+                                $(instructions).html('The job could not be recorded, nothing was changed. Submit it again.')
+                                    .css('color', 'red');
+                            } else {
+                                console.log('ERROR : ', e);
+                            }
                             toggleProps(toggles);
                         }
                     });
@@ -602,7 +674,7 @@
             let table = $('#table');
             let btn = $('.refreshJobs');
             $(btn).click(function () {
-                $(table).load(getPath);
+                $(table).load(pagePath(getPath));
                 $(btn).attr('disabled', true);
                 $(btn).html('Please wait before refreshing again');
                 setTimeout(function () {
@@ -611,6 +683,32 @@
                 }, 5000);
             });
         },
+        // Suggest matching part names while typing in the parts search
+        searchParts: function (searchPath) {
+            let search = $('#partSearch');
+            let suggestions = $('#partSuggestions');
+            let timer;
+
+            $(search).off('input').on('input', function () {
+                let query = $(this).val();
+                clearTimeout(timer);
+
+                // Wait for a pause in typing before asking the server
+                timer = setTimeout(function () {
+                    if (!query.trim()) {
+                        $(suggestions).empty();
+                        return;
+                    }
+                    $.getJSON(searchPath, {q: query, limit: 10}, function (data) {
+                        $(suggestions).empty();
+                        $.each(data.items, function (i, item) {
+                            $(suggestions).append($('<option>').val(item.name).text(item.part_number + ' - ' +
+                                item.part_store_name));
+                        });
+                    });
+                }, 150);
+            });
+        },
         // Functionality to add part type on /parts/type
         addType: function (getPath) {
             let typeName = $('#typeName');
@@ -708,6 +806,73 @@
                 });
             });
         },
+        // Keep a table up to date with the change feed. tables are the tables it shows, matches(row) whether a part
+        // not on the page belongs on it (null when the page lists every part). Changed parts on the page are patched
+        // in place, new jobs are added to the first page of jobs, anything else reloads the table
+        liveUpdates: function (element, getPath, tables, matches) {
+            if (!window.EventSource) {
+                return;
+            }
+            let timer;
+
+            // Reload once the changes that came in together were applied, while nothing is being edited
+            let reload = function () {
+                clearTimeout(timer);
+                timer = setTimeout(function () {
+                    if ($(element).find('.cancelUpdateBtn:visible, .confirmMe:visible, .cancelBtn:visible').length) {
+                        reload();
+                    } else {
+                        $(element).load(pagePath(getPath));
+                    }
+                }, 250);
+            }
+
+            let applyParts = function (change) {
+                let stale = false;
+
+                $.each(change.deleted, function (i, id) {
+                    stale = stale || (matches && matches({id: id}) && !hasPart(id));
+                    removePart(id);
+                });
+                $.each(change.updated.concat(change.inserted), function (i, row) {
+                    let belongs = matches ? matches(row) : hasPart(row.id) || change.inserted.includes(row);
+
+                    if (belongs && hasPart(row.id)) {
+                        patchPart(row);
+                    } else if (belongs || hasPart(row.id)) {
+                        stale = true;
+                    }
+                });
+                return stale;
+            }
+
+            let applyJobs = function (change) {
+                if (change.deleted.length || window.location.search) {
+                    return change.deleted.length > 0;
+                }
+                let header = $(element).find('tr').first();
+
+                $.each(change.inserted, function (i, row) {
+                    header.after($('<tr>').append($('<td>').text(row.part_store_name), $('<td>').text(row.parts_used),
+                        $('<td>').text(row.time), $('<td>').text(row.username)));
+                });
+                return false;
+            }
+
+            liveFeed = new EventSource('/api/v1/changes');
+            liveFeed.addEventListener('reload', reload);
+            liveFeed.addEventListener('change', function (e) {
+                let change = JSON.parse(e.data);
+
+                if (!tables.includes(change.table)) {
+                    return;
+                }
+                if (change.reload || (change.table === 'parts' ? applyParts(change)
+                    : change.table === 'jobs' ? applyJobs(change) : true)) {
+                    reload();
+                }
+            });
+        },
         loginUser: function () {
             let username = $('#username');
             let password = $('#password');
@@ -0,0 +1,3 @@
+$(function() {
+    ns.searchParts('/api/v1/parts/search');
+});
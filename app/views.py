@@ -1,16 +1,16 @@
 from datetime import datetime
 from inspect import getframeinfo, currentframe
 from os import environ
-from turtle import update
-from unittest import result
 from urllib.parse import unquote
 
-from flask import Flask, render_template, request, redirect, url_for, session, Response
+from flask import Flask, render_template, request, redirect, url_for, session, Response, jsonify
 from flask_talisman import Talisman
 from flask_wtf import CSRFProtect
 from werkzeug.exceptions import HTTPException, abort
 
-from app.database.DatabaseManipulator import DatabaseManipulator, check_input, get_difference, get_store_icon_names, check_if_icon_exists
+from app.database.AsyncDatabase import async_dbm
+from app.database.DatabaseManipulator import DatabaseManipulator, check_input, get_store_icon_names, check_if_icon_exists
+from app.database.Pagination import date_args, page_args, page_size
 
 from app.forms.AddTypeForm import AddTypeForm
 from app.forms.LoginForm import LoginForm
@@ -23,9 +23,16 @@ from app.forms.UpdateTypeForm import UpdateTypeForm
 from app.forms.UpdatePartStoreForm import UpdatePartStoreForm
 from app.forms.PartStoreForm import PartStoreForm
 
+from app.api.v1 import api as api_v1, import_parts
+from app.cli import init_app as init_cli
+from app.profiler import init_app as init_profiler
+from app.auth import accounts_version, clear_auth, refresh_auth, store_auth
+from app.conditional import conditional
+from app.fragments import fragment_cache
 from app.csp import csp
 
-from app.decorators.flask_decorators import login_required, admin_login_required
+from app.decorators import init_app as init_db_session
+from app.decorators.flask_decorators import login_required, admin_login_required, metrics_access_required
 
 # Initialize the app
 app = Flask(__name__)
@@ -35,6 +42,24 @@ app.secret_key = environ.get('SECRET_KEY')
 csrf = CSRFProtect()
 csrf.init_app(app)
 
+# Register the versioned JSON API and the command line commands. The parts import checks CSRF tokens itself,
+# API clients send a bearer token instead
+app.register_blueprint(api_v1)
+csrf.exempt(import_parts)
+init_cli(app)
+
+# Share one pooled database session per request, committed or rolled back in teardown
+init_db_session(app)
+
+# Per request query profiling, Server-Timing headers and /metrics for admins and scrapers when profile_requests=true
+init_profiler(app, metrics_access_required)
+
+
+# Re-read the logged in account's flags once an account changed or they are older than auth_cache_ttl
+@app.before_request
+def refresh_session_auth():
+    refresh_auth(dbm)
+
 # Only trigger SSLify if the app is running on Heroku
 if 'DYNO' in environ:
     Talisman(app, content_security_policy=csp)
@@ -43,6 +68,39 @@ if 'DYNO' in environ:
 dbm = DatabaseManipulator()
 
 
+# Get one page of parts using the page and filter query arguments (store, type, name, q)
+def parts_page(**filters) -> tuple:
+    # A search (q) on the unfiltered parts table shows its best matches on a single page
+    if request.args.get('q') and not filters:
+        return dbm.search_parts(request.args['q'], page_size) or [], None
+
+    filters.setdefault('part_store_name', request.args.get('store'))
+    filters.setdefault('part_type', request.args.get('type'))
+    return dbm.get_parts_page(name=request.args.get('name'), **filters, **page_args(request.args)) or ([], None)
+
+
+# Run independent reads (functions without arguments) concurrently, on the async database layer when
+# async_database=true and on the read pool otherwise. Returns their results in order
+def read_all(*calls) -> list:
+    if async_dbm.enabled:
+        return async_dbm.gather(*calls)
+    return dbm.gather(*calls)
+
+
+# Get one page of jobs using the page and filter query arguments (store, user, since, until)
+def jobs_page() -> tuple:
+    return dbm.get_jobs_page(part_store_name=request.args.get('store'), username=request.args.get('user'),
+                             **date_args(request.args), **page_args(request.args, default_descending=True)) or ([], None)
+
+
+# Build the next/first page links of a paginated view, keeping the current filters
+def pager(next_cursor: str or None, endpoint: str, **values) -> dict:
+    args = {key: value for key, value in request.args.items() if key != 'cursor' and key not in values}
+
+    return {'next': url_for(endpoint, **values, **args, cursor=next_cursor) if next_cursor else None,
+            'first': url_for(endpoint, **values, **args) if request.args.get('cursor') else None}
+
+
 # Handle the 401 error
 @app.errorhandler(401)
 @login_required
@@ -77,7 +135,6 @@ def internal_error(e):
 def index():
     try:
         username = session['username']
-        session['is_admin'] = dbm.check_admin(username)
         return render_template('index.html', username=username)
     except IndexError:
         abort(404), 404
@@ -94,11 +151,14 @@ def login():
         if request.method == 'POST':
             username = form.username.data
             password = form.password.data
+            # The accounts version is read before the account, see store_auth
+            version = accounts_version()
             my_login = dbm.login(username=username, password=password)
 
             if my_login:
                 session['logged_in'] = True
                 session['username'] = username
+                store_auth(my_login, version)
             else:
                 # if the login is incorrenct, throw 401 unauthorized
                 return render_template('login.html', form=form)
@@ -146,9 +206,7 @@ def register():
 # App route for /logout
 @app.route('/logout', strict_slashes=False, methods=['GET', 'POST'])
 def logout():
-    session.pop('logged_in', default=None)
-    session.pop('username', default=None)
-    session.pop('is_admin', default=None)
+    clear_auth()
     return redirect(url_for('index'))
 
 
@@ -156,8 +214,8 @@ def logout():
 @app.route('/parts', strict_slashes=False, methods=['GET', 'POST'])
 @login_required
 def parts():
-    part_results = dbm.fetchall()
-    part_store_names = dbm.get_part_store_names()
+    (part_results, next_cursor), part_store_names, store_choices, type_choices = read_all(
+        parts_page, dbm.get_part_store_names, dbm.get_selections, dbm.get_part_type_names)
     form = PartsForm()
     update_form = UpdatePartsForm()
 
@@ -174,11 +232,10 @@ def parts():
 
     try:
         # Populate the part_store choices and type choices for the insert/update part select statements
-        form.partStore.choices = dbm.get_selections()
-        form.unit.choices = dbm.get_part_type_names()
-        update_form.newPartStore.choices = dbm.get_selections()
-        update_form.newUnit.choices = dbm.get_part_type_names()
-        return render_template('parts.html', results=part_results, part_store_names=part_store_names, form=form, update_form=update_form)
+        form.partStore.choices = update_form.newPartStore.choices = store_choices
+        form.unit.choices = update_form.newUnit.choices = type_choices
+        return render_template('parts.html', results=part_results, part_store_names=part_store_names, form=form,
+                               update_form=update_form, pager=pager(next_cursor, 'parts'))
     except IndexError:
         abort(404), 404
     except HTTPException:
@@ -211,12 +268,13 @@ def low_parts():
     results = dbm.get_low_parts()
 
     if request.method == 'POST':
+        # Only queues the text, the SMS dispatcher sends it in the background
         message_user = dbm.send_text(low_parts_form.user.data)
 
-        # if message is not sent, return HTTP 400
+        # if the message could not be queued, return HTTP 400
         if not message_user:
             return render_template('low_parts.html', results=results, form=low_parts_form), 400
-        return render_template('low_parts.html', results=results, form=low_parts_form)
+    return render_template('low_parts.html', results=results, form=low_parts_form)
 
 
 # Route for displaying/adding the type of parts
@@ -241,14 +299,17 @@ def type_parts():
 # Route for displaying parts by Type ID
 @app.route('/parts/type/<type_id>', strict_slashes=False, methods=['GET'])
 def type_parts_id(type_id):
-    results = dbm.get_part_type_by_name(type_id)
+    (results, next_cursor), store_choices, type_choices, type_exists = read_all(
+        lambda: parts_page(part_type=type_id), dbm.get_selections, dbm.get_part_type_names,
+        lambda: dbm.check_if_type_exists(type_id))
     update_form = UpdatePartsForm()
-    update_form.newPartStore.choices = dbm.get_selections()
-    update_form.newUnit.choices = dbm.get_part_type_names()
+    update_form.newPartStore.choices = store_choices
+    update_form.newUnit.choices = type_choices
 
     # Make sure the part exists, if not redirect back to the /types route
-    if dbm.check_if_type_exists(type_id):
-        return render_template('display_type_part.html', results=results, update_form=update_form)
+    if type_exists:
+        return render_template('display_type_part.html', results=results, update_form=update_form,
+                               pager=pager(next_cursor, 'type_parts_id', type_id=type_id))
     return redirect(url_for('type_parts'))
 
 
@@ -289,33 +350,64 @@ def store_number(part_store_num):
     update_form = UpdatePartsForm()
 
     # Populate the insert form/update form select elements
-    insert_form.unit.choices = dbm.get_part_type_names()
-    update_form.newUnit.choices = dbm.get_part_type_names()
-    results = dbm.get_part_stores(part_store_num)
-    check_exist = dbm.check_if_exists(part_store_num)
+    type_choices, (results, next_cursor), check_exist = read_all(
+        dbm.get_part_type_names, lambda: parts_page(part_store_name=part_store_num),
+        lambda: dbm.check_if_exists(part_store_num))
+    insert_form.unit.choices = update_form.newUnit.choices = type_choices
+    page_links = pager(next_cursor, 'store_number', part_store_num=part_store_num)
 
     # If there are no results in the part stores database, but it exists, execute the following
-    if results is None and check_exist:
-        return render_template('display_part_stores.html', results=None, check_exist=check_exist, form=insert_form, update_form=update_form)
-    # If the results are not None, return the following
-    elif results is not None:
-        return render_template('display_part_stores.html', results=results, form=insert_form, update_form=update_form)
+    if not results and check_exist:
+        return render_template('display_part_stores.html', results=None, check_exist=check_exist, form=insert_form,
+                               update_form=update_form, pager=page_links)
+    # If the results are not empty, return the following
+    elif results:
+        return render_template('display_part_stores.html', results=results, form=insert_form, update_form=update_form,
+                               pager=page_links)
     # Otherwise, redirect to the main /parts/stores page
     return redirect(url_for('part_stores'))
 
 
 # Displays the table code in parts_table.html, so it can be refreshed dynamically without reloading the page
-@app.route('/table/<table_name>/<quantity_id>', strict_slashes=False, method=['GET', 'POST'])
+# Tables each /table/<table_name>/<quantity_id> fragment is rendered from, by (table_name, quantity_id == 'all')
+fragment_tables = {
+    ('part_store_list', False): ('parts', 'part_store', 'part_type'),
+    ('users', False): ('accounts',),
+    ('jobs', False): ('parts', 'part_store'),
+    ('jobs', True): ('jobs', 'part_store'),
+    ('main', True): ('parts', 'part_store', 'part_type'),
+    ('display_part', False): ('parts', 'part_store', 'part_type'),
+    ('part_store_list', True): ('part_store',),
+    ('part_type_list', False): ('parts', 'part_store', 'part_type'),
+    ('part_type_list', True): ('part_type',)
+}
+
+
+# Tables a fragment is rendered from, None for URLs that only redirect
+def fragment_dependencies(table_name, quantity_id) -> tuple or None:
+    return fragment_tables.get((table_name, quantity_id == 'all'))
+
+
+# What a fragment shows of the logged in user: the accounts list leaves out their own account,
+# the other fragments only differ for admins
+def fragment_variant(table_name, quantity_id):
+    return session.get('username') if table_name == 'users' else bool(session.get('is_admin'))
+
+
+@app.route('/table/<table_name>/<quantity_id>', strict_slashes=False, methods=['GET', 'POST'])
+@conditional(fragment_dependencies)
+@fragment_cache.cached(fragment_dependencies, variant=fragment_variant)
 def table(table_name, quantity_id):
     if table_name == 'part_store_list' and quantity_id != 'all':
         # Requirements to return the results for a part store by its number
         form = PartsForm()
         update_form = UpdatePartsForm()
-        results = dbm.get_part_stores(quantity_id)
-        check_exist = dbm.check_if_exists(quantity_id)
-        form.unit.choices = dbm.get_part_type_names()
+        (results, next_cursor), check_exist, form.unit.choices = read_all(
+            lambda: parts_page(part_store_name=quantity_id), lambda: dbm.check_if_exists(quantity_id),
+            dbm.get_part_type_names)
 
-        return render_template('load/part_stores_table.html', results=results, check_exist=check_exist, form=form, update_form=update_form)
+        return render_template('load/part_stores_table.html', results=results, check_exist=check_exist, form=form,
+                               update_form=update_form, pager=pager(next_cursor, 'store_number', part_store_num=quantity_id))
     elif table_name == 'users' and quantity_id != 'all':
         # Requirements to return the list of accounts
         results = dbm.get_users(username=session['username'])
@@ -328,21 +420,20 @@ def table(table_name, quantity_id):
         return render_template('load/jobs_table.html', part_store_parts=select_parts)
     elif table_name == 'jobs' and quantity_id == 'all':
         # Requirements to return the full job list of parts
-        job_parts = dbm.get_jobs()
+        job_parts, next_cursor = jobs_page()
 
-        return render_template('load/display_jobs_table.html', jobs=job_parts)
+        return render_template('load/display_jobs_table.html', jobs=job_parts, pager=pager(next_cursor, '_jobs'))
     elif table_name == 'main' and quantity_id == 'all':
         # Requirements to return the master list of parts
         form = PartsForm()
         update_form = UpdatePartsForm()
-        results = dbm.fetchall()
-        store_names = dbm.get_part_store_names()
 
         # Set the choices for selecting a new part store
-        update_form.newPartStore.choices = dbm.get_selections()
-        update_form.newUnit.choices = dbm.get_part_type_names()
+        (results, next_cursor), store_names, update_form.newPartStore.choices, update_form.newUnit.choices = read_all(
+            parts_page, dbm.get_part_store_names, dbm.get_selections, dbm.get_part_type_names)
 
-        return render_template('load/parts_table.html', results=results, store_names=store_names, form=form, update_form=update_form)
+        return render_template('load/parts_table.html', results=results, store_names=store_names, form=form,
+                               update_form=update_form, pager=pager(next_cursor, 'parts'))
     elif table_name == 'display_part' and quantity_id != 'all':
         # Requirements for the individual attributes for a part
         form = UpdatePartThresh()
@@ -358,11 +449,11 @@ def table(table_name, quantity_id):
 
         return render_template('load/part_stores_list.html', part_store_names=store_names, update_form=update_form)
     elif table_name == 'part_type_list' and quantity_id != 'all':
-        results = dbm.get_part_type_by_name(type_name=quantity_id)
         update_form = UpdatePartsForm()
-        update_form.newPartStore.choices = dbm.get_selections()
-        update_form.newUnit.choices = dbm.get_part_type_names()
-        return render_template('load/display_part_type_table.html', results=results, update_form=update_form)
+        (results, next_cursor), update_form.newPartStore.choices, update_form.newUnit.choices = read_all(
+            lambda: parts_page(part_type=quantity_id), dbm.get_selections, dbm.get_part_type_names)
+        return render_template('load/display_part_type_table.html', results=results, update_form=update_form,
+                               pager=pager(next_cursor, 'type_parts_id', type_id=quantity_id))
     elif table_name == 'part_type_list' and quantity_id == 'all':
         add_type_form = AddTypeForm()
         update_type_form = UpdateTypeForm()
@@ -412,13 +503,20 @@ def update(id_type):
             part_id = form.id.data
             part_name = form.partName.data
             part_amount = str(form.newPartAmount.data)
+            original_amount = form.partAmount.data
             part_number = form.partNumber.data
             part_store_name = unquote(form.newPartStore.data)
             part_type = form.newUnit.data
 
             if check_input(part_id) and check_input(part_name) and check_input(part_amount) and check_input(part_number) and check_input(part_store_name) and check_input(part_type):
-                dbm.update(part_id, part_name, part_amount,
-                           part_number, part_store_name, part_type)
+                # 409 if jobs submitted while the part was edited left too little stock for the change, 404 if
+                # the part was deleted meanwhile
+                updated = dbm.update(part_id, part_name, part_amount, part_number, part_store_name, part_type,
+                                     original_amount)
+                if updated == 409:
+                    return jsonify(conflicts=[{'id': int(part_id)}]), 409
+                elif updated == 404:
+                    return jsonify(deleted=[{'id': int(part_id)}]), 404
         if request.method == 'POST' and id_type == 'threshold':
             # Update the threshold of a part by its ID
             form = UpdatePartThresh()
@@ -481,17 +579,17 @@ def users():
 @app.route('/jobs/', strict_slashes=False, methods=['GET'])
 @admin_login_required
 def _jobs():
-    all_jobs = dbm.get_jobs()
-    return render_template('display_jobs.html', jobs=all_jobs)
+    (all_jobs, next_cursor), part_store_names = read_all(jobs_page, dbm.get_part_store_names)
+    return render_template('display_jobs.html', jobs=all_jobs, pager=pager(next_cursor, '_jobs'),
+                           part_store_names=part_store_names)
 
 
 # Route for jobs/<part_store_id>
 @app.route('/jobs/<part_store_id>', strict_slashes=False, methods=['GET', 'POST'])
 @login_required
 def jobs(part_store_id):
-    part_store_amount = dbm.get_total_parts_by_part_store(part_store_id)
-    select_parts = dbm.get_parts_by_store(part_store_id)
-    check_exist = dbm.check_if_exists(part_store_id)
+    select_parts, check_exist = read_all(lambda: dbm.get_parts_by_store(part_store_id),
+                                         lambda: dbm.check_if_exists(part_store_id))
 
     # If the store does not exist or does not contain at least one part, redirect to index
     if not check_exist or not select_parts:
@@ -499,26 +597,20 @@ def jobs(part_store_id):
     elif request.method == 'POST' and request.is_json and select_parts:
         content = request.get_json()
 
-        # The list of values to be added
-        lst = []
-        for i in content:
-            for key, val in i.items():
-                lst.append(val)
-
-        # Zip values into the format [(value, value), (value, value), ...]
-        values = [*zip(lst[::2], lst[1::2])]
-
-        # Values to get difference of
-        res = [int(i) for i in lst[::2]]
-        parts_used = sum(res)
-
-        # Get the difference of the two values
-        difference = get_difference(int(part_store_amount), int(parts_used))
-        dbm.update_multiple_parts_by_part_store(values)
-
-        if difference > 0:
-            # Record job in the database if there is at least 1 part changed
-            dbm.record_job(session['username'], str(datetime.now().strftime(
-                '%Y-%m-%d %H:%M:%S')), part_store_id, difference)
+        # Each part's change relative to the amount the page showed, so jobs submitted at the same time add up
+        try:
+            deltas = {int(i['part_id']): int(i['amount']) - int(i['original']) for i in content}
+        except (KeyError, TypeError, ValueError):
+            return jsonify(error='Every part needs a part_id, amount and original amount'), 400
+
+        # Update every part and record the job (if at least 1 part changed) in one transaction. On a conflict
+        # nothing is changed and the parts other jobs took stock from are returned. None if the database failed
+        submitted = dbm.submit_job(session['username'], datetime.now().replace(microsecond=0), part_store_id, deltas)
+        if submitted is None:
+            return jsonify(error='503: The job could not be recorded, try again'), 503
+
+        parts_used, conflicts = submitted
+        if conflicts:
+            return jsonify(conflicts=conflicts), 409
 
     return render_template('jobs.html', part_store_parts=select_parts)
@@ -0,0 +1,9 @@
+from os import environ
+
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app.views import app as wsgi_app
+
+# ASGI entry point, served with uvicorn asgi:app. Requests run on a pool of asgi_threads threads, pair
+# it with async_database=true so the reads of a page run concurrently on the async database driver
+app = WSGIMiddleware(wsgi_app, workers=int(environ.get('asgi_threads', 32)))
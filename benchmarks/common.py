@@ -0,0 +1,149 @@
+# Shared helpers for the benchmark suite: pointing the app at a throwaway database,
+# seeding it with synthetic inventory data, counting queries and summarising timings.
+from datetime import datetime, timedelta
+from os import environ, path, remove
+from random import Random
+from shutil import copyfile
+from statistics import mean
+from subprocess import CalledProcessError, check_output
+from tempfile import gettempdir
+from time import sleep
+
+for key, value in {'username': 'bench', 'password': 'bench', 'host': 'localhost', 'db_port': '3306',
+                   'db': 'bench', 'SECRET_KEY': 'bench'}.items():
+    environ.setdefault(key, value)
+
+from sqlalchemy import event, insert, select
+
+import app.decorators
+from app.database.DatabaseTables import metadata, Account, Job, JobLine, Part, PartStore, PartType, StoreDailyUsage
+from app.database.ReferenceCache import reference_cache
+
+DEFAULT_URL = f'sqlite:///{path.join(gettempdir(), "inventory_bench.db")}'
+ICONS = ['box', 'shelf', 'van', 'warehouse']
+
+
+# Delete a SQLite database file and its write-ahead log
+def remove_sqlite(file: str) -> None:
+    for name in (file, file + '-wal', file + '-shm'):
+        if path.exists(name):
+            remove(name)
+
+
+# Create an engine for url, set up like the app's, and make every DatabaseManipulator call use it.
+# SQLite files are deleted first; other databases are only dropped when reset is True
+def configure(url: str = DEFAULT_URL, reset: bool = True):
+    if url.startswith('sqlite:///') and reset:
+        remove_sqlite(url[len('sqlite:///'):])
+
+    engine = app.decorators.create_database_engine(url)
+
+    if reset:
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+
+    app.decorators.engine = engine
+    reference_cache.invalidate()
+    return engine
+
+
+# Route the read only calls to replicas at urls. SQLite replicas are copies of the seeded SQLite primary at url
+def configure_replicas(url: str, urls: list) -> None:
+    if url.startswith('sqlite:///'):
+        with app.decorators.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    for replica in urls:
+        if url.startswith('sqlite:///') and replica.startswith('sqlite:///'):
+            remove_sqlite(replica[len('sqlite:///'):])
+            copyfile(url[len('sqlite:///'):], replica[len('sqlite:///'):])
+
+    app.decorators.replicas.configure(urls)
+
+
+# The same database on its asyncio driver
+def async_url(url: str) -> str:
+    return url.replace('sqlite:', 'sqlite+aiosqlite:', 1).replace('mysql+pymysql:', 'mysql+aiomysql:', 1)
+
+
+# Fill the database with parts spread over stores and types, plus a job history with two ledger lines
+# per job and one admin account
+def seed(engine, parts: int = 10000, stores: int = 50, types: int = 20, jobs: int = 10000,
+         batch: int = 5000, seed_value: int = 0) -> dict:
+    rng = Random(seed_value)
+    store_names = [str(100 + i) for i in range(stores)]
+    type_rows = [{'type_name': f'type{i}', 'type_unit': f'unit{i}'} for i in range(types)]
+
+    with engine.begin() as conn:
+        conn.execute(insert(Account), [{'username': 'bench', 'password': 'x', 'is_admin': 1, 'is_confirmed': 1,
+                                        'phone_num': '5555555555'}])
+        conn.execute(insert(PartStore), [{'part_store_name': name, 'icon': rng.choice(ICONS)} for name in store_names])
+        conn.execute(insert(PartType), type_rows)
+        store_ids = conn.execute(select(PartStore.id).order_by(PartStore.id)).scalars().all()
+        type_ids = conn.execute(select(PartType.id).order_by(PartType.id)).scalars().all()
+
+        for start in range(0, parts, batch):
+            conn.execute(insert(Part), [{'name': f'part{i}', 'amount': rng.randint(0, 100), 'part_number': f'PN{i:07d}',
+                                         'part_store_id': rng.choice(store_ids), 'low_thresh': rng.choice([None, 5, 10]),
+                                         'part_type_id': rng.choice(type_ids)}
+                                        for i in range(start, min(start + batch, parts))])
+
+        start_time = datetime(2022, 1, 1)
+        usage = {}
+        for start in range(0, jobs, batch):
+            rows = [{'username': 'bench', 'part_store_id': rng.choice(store_ids),
+                     'time': start_time + timedelta(minutes=17 * i), 'parts_used': rng.randint(1, 40)}
+                    for i in range(start, min(start + batch, jobs))]
+            conn.execute(insert(Job), rows)
+            conn.execute(insert(JobLine), [{'job_id': job_id, 'part_id': rng.randint(1, parts), 'delta': -used,
+                                            'quantity': rng.randint(0, 100), 'time': row['time']}
+                                           for job_id, row in enumerate(rows, start=start + 1)
+                                           for used in (row['parts_used'] // 2, (row['parts_used'] + 1) // 2)])
+
+            for row in rows:
+                key = (row['part_store_id'], row['time'].date())
+                jobs_count, parts_used = usage.get(key, (0, 0))
+                usage[key] = (jobs_count + 1, parts_used + row['parts_used'])
+
+        if usage:
+            conn.execute(insert(StoreDailyUsage), [{'part_store_id': store_id, 'day': day, 'jobs': count,
+                                                    'parts_used': used}
+                                                   for (store_id, day), (count, used) in usage.items()])
+
+    return {'parts': parts, 'stores': stores, 'types': types, 'jobs': jobs, 'store_names': store_names,
+            'type_names': [row['type_name'] for row in type_rows]}
+
+
+# Count the SQL statements executed on an engine
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+# Delay every statement on engine by milliseconds, like the round trip to a database on another host
+def simulate_latency(engine, milliseconds: float) -> None:
+    event.listen(engine, 'before_cursor_execute', lambda *args: sleep(milliseconds / 1000))
+
+
+# p50/p95/p99/mean/max in milliseconds for a list of durations in seconds
+def summarise(samples: list) -> dict:
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {'runs': len(ordered), 'p50_ms': round(percentile(50), 3), 'p95_ms': round(percentile(95), 3),
+            'p99_ms': round(percentile(99), 3), 'mean_ms': round(mean(ordered) * 1000, 3),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+# Short hash of the checked out commit, used to name result files
+def git_commit() -> str:
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (CalledProcessError, OSError):
+        return 'unknown'
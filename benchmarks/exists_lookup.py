@@ -0,0 +1,75 @@
+# Benchmark the part store / part type existence checks as the tables grow.
+# Seeds a throwaway SQLite database with N rows per table and times the
+# indexed SELECT EXISTS lookup against the old full-column scan.
+#
+# Usage: python -m benchmarks.exists_lookup [sizes...]
+from os import environ, path, remove
+from sys import argv
+from tempfile import gettempdir
+from time import perf_counter
+
+for key, value in {'username': 'bench', 'password': 'bench', 'host': 'localhost', 'db_port': '3306', 'db': 'bench'}.items():
+    environ.setdefault(key, value)
+
+from sqlalchemy import create_engine, distinct, insert, select
+
+import app.decorators
+from app.database.DatabaseTables import metadata, PartStore, PartType
+
+DB_FILE = path.join(gettempdir(), 'inventory_exists_bench.db')
+LOOKUPS = 200
+
+
+# Recreate the SQLite database and fill part_store and part_type with size rows each
+def seed(size: int):
+    if path.exists(DB_FILE):
+        remove(DB_FILE)
+
+    engine = create_engine(f'sqlite:///{DB_FILE}')
+    metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        conn.execute(insert(PartStore), [{'part_store_name': f'store{i}', 'icon': 'van'} for i in range(size)])
+        conn.execute(insert(PartType), [{'type_name': f'type{i}', 'type_unit': 'ea'} for i in range(size)])
+
+    app.decorators.engine = engine
+    return engine
+
+
+# The lookup removed from DatabaseManipulator.get_dupes, kept here as the baseline
+def full_scan(engine, column, value) -> bool:
+    with engine.connect() as conn:
+        dist = [i[0] for i in conn.execute(select(distinct(column)).order_by(column)).fetchall()]
+        dupes = [i[0] for i in conn.execute(select(column)).fetchall()]
+    return dist.count(value) > 0 or value in dupes
+
+
+# Average milliseconds per call of func over calls calls
+def time_ms(func, *args, calls: int = LOOKUPS) -> float:
+    start = perf_counter()
+    for _ in range(calls):
+        func(*args)
+    return (perf_counter() - start) * 1000 / calls
+
+
+def main(sizes: list):
+    from app.database.DatabaseManipulator import DatabaseManipulator
+    dbm = DatabaseManipulator()
+
+    print(f'{"rows":>8} {"exists store ms":>16} {"exists type ms":>15} {"scan store ms":>14}')
+    for size in sizes:
+        engine = seed(size)
+        target = f'store{size - 1}'
+
+        store_ms = time_ms(dbm.check_if_exists, target)
+        type_ms = time_ms(dbm.check_if_type_exists, f'type{size - 1}')
+        scan_ms = time_ms(full_scan, engine, PartStore.part_store_name, target, calls=10)
+
+        print(f'{size:>8} {store_ms:>16.3f} {type_ms:>15.3f} {scan_ms:>14.3f}')
+        engine.dispose()
+
+    remove(DB_FILE)
+
+
+if __name__ == '__main__':
+    main([int(i) for i in argv[1:]] or [100, 1000, 10000, 100000])
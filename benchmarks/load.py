@@ -0,0 +1,117 @@
+# End-to-end load scenarios driven through the Flask test client against a seeded database.
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from time import perf_counter
+
+from benchmarks.common import QueryCounter, summarise
+
+
+# (name, method, url(rng, client), json body(rng, client) or None[, headers(rng, client, path)])
+def scenarios(data: dict) -> list:
+    stores = data['store_names']
+
+    def job_body(rng, client, store):
+        rows = client.get(f'/api/v1/parts?store={store}&limit=500').get_json()['items']
+        return [{'amount': max(row['amount'] - rng.randint(0, 2), 0), 'original': row['amount'], 'part_id': row['id']}
+                for row in rows]
+
+    # Revalidate the copy a browser would have cached from an earlier load of the same page
+    def revalidate(rng, client, path):
+        return {'If-None-Match': client.get(path).headers.get('ETag', '')}
+
+    return [
+        ('GET /parts', 'GET', lambda rng: '/parts', None),
+        ('GET /parts/stores/<id>', 'GET', lambda rng: f'/parts/stores/{rng.choice(stores)}', None),
+        ('GET /parts/low', 'GET', lambda rng: '/parts/low', None),
+        ('GET /jobs/', 'GET', lambda rng: '/jobs/', None),
+        ('GET /jobs/?store&since&until', 'GET',
+         lambda rng: f'/jobs/?store={rng.choice(stores)}&since=2022-02-01&until=2022-02-28', None),
+        ('POST /jobs/<id>', 'POST', lambda rng: f'/jobs/{rng.choice(stores)}', job_body),
+        ('GET /table/main/all', 'GET', lambda rng: '/table/main/all', None),
+        ('GET /table/part_store_list/<id>', 'GET', lambda rng: f'/table/part_store_list/{rng.choice(stores)}', None),
+        ('GET /table/part_store_list/all', 'GET', lambda rng: '/table/part_store_list/all', None),
+        ('GET /table/part_type_list/all', 'GET', lambda rng: '/table/part_type_list/all', None),
+        ('GET /table/jobs/all', 'GET', lambda rng: '/table/jobs/all', None),
+        ('GET /table/jobs/<id>', 'GET', lambda rng: f'/table/jobs/{rng.choice(stores)}', None),
+        ('GET /table/main/all (If-None-Match)', 'GET', lambda rng: '/table/main/all', None, revalidate),
+        ('GET /table/part_store_list/<id> (If-None-Match)', 'GET',
+         lambda rng: f'/table/part_store_list/{rng.choice(stores)}', None, revalidate),
+        ('GET /table/jobs/all (If-None-Match)', 'GET', lambda rng: '/table/jobs/all', None, revalidate),
+        ('GET /api/v1/parts/export', 'GET', lambda rng: '/api/v1/parts/export', None),
+        ('GET /api/v1/stats', 'GET', lambda rng: '/api/v1/stats?days=366', None),
+        ('GET /api/v1/stats (If-None-Match)', 'GET', lambda rng: '/api/v1/stats?days=366', None, revalidate),
+        ('GET /api/v1/parts (If-None-Match)', 'GET', lambda rng: '/api/v1/parts', None, revalidate),
+        ('GET /api/v1/parts/search', 'GET',
+         lambda rng: '/api/v1/parts/search?q=' + f'part{rng.randint(0, data["parts"] - 1)}'[:rng.randint(3, 8)], None),
+    ]
+
+
+# A test client logged in as the seeded admin
+def logged_in_client(app):
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['username'] = 'bench'
+        session['is_admin'] = True
+    return client
+
+
+# Run every scenario requests times over concurrency clients, returning latency percentiles,
+# queries per request and response sizes. Query counts are only exact with one client
+def run(engine, data: dict, requests: int = 100, concurrency: int = 1, only: list = None) -> dict:
+    from app.views import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    counter = QueryCounter(engine)
+    results = {}
+
+    for name, method, url, body, *headers in scenarios(data):
+        if only and not any(name.startswith(i) for i in only):
+            continue
+
+        def worker(seed: int) -> tuple:
+            rng = Random(seed)
+            client = logged_in_client(app)
+            samples, sizes, statuses, queries = [], [], set(), 0
+
+            for _ in range(max(1, requests // concurrency)):
+                path = url(rng)
+                json = body(rng, client, path.rsplit('/', 1)[-1]) if body else None
+                extra_headers = headers[0](rng, client, path) if headers else None
+                before = counter.count
+                start = perf_counter()
+                response = client.open(path, method=method, json=json, headers=extra_headers)
+                size = len(response.get_data())
+                samples.append(perf_counter() - start)
+                queries += counter.count - before
+                sizes.append(size)
+                statuses.add(response.status_code)
+            return samples, sizes, statuses, queries
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(worker, range(concurrency)))
+        elapsed = perf_counter() - start
+
+        samples = [i for outcome in outcomes for i in outcome[0]]
+        sizes = [i for outcome in outcomes for i in outcome[1]]
+        results[name] = {**summarise(samples),
+                         'requests_per_second': round(len(samples) / elapsed, 1),
+                         'queries_per_request': round(sum(outcome[3] for outcome in outcomes) / len(samples), 2),
+                         'mean_response_bytes': round(sum(sizes) / len(sizes)),
+                         'statuses': sorted(set().union(*(outcome[2] for outcome in outcomes)))}
+    return results
+
+
+# Run the scenarios again with the reads of each page gathered on the async database layer at url. Query counts
+# only cover the synchronous engine
+def run_async(engine, data: dict, url: str, requests: int = 100, concurrency: int = 1, only: list = None) -> dict:
+    from app.database.AsyncDatabase import async_dbm
+
+    async_dbm.configure(url)
+    async_dbm.enabled = True
+    try:
+        return run(engine, data, requests, concurrency, only)
+    finally:
+        async_dbm.enabled = False
@@ -0,0 +1,112 @@
+# Micro-benchmarks for the DatabaseManipulator methods against a seeded database.
+from datetime import datetime
+from random import Random
+from time import perf_counter
+
+from app.database.DatabaseManipulator import DatabaseManipulator
+from app.database.PartSearch import part_search
+from app.database.ReferenceCache import reference_cache
+from benchmarks.common import QueryCounter, summarise
+
+
+# (name, call(dbm, rng, prepared), prepare(dbm, rng) run untimed before each call or None, rows per call or None)
+def cases(data: dict) -> list:
+    stores, types = data['store_names'], data['type_names']
+
+    def part_id(rng):
+        return rng.randint(1, data['parts'])
+
+    def job_values(dbm, rng):
+        store = rng.choice(stores)
+        return store, {row[0]: -1 for row in dbm.get_parts_by_store(store) if row[2]}
+
+    def cold(dbm, rng):
+        reference_cache.invalidate()
+
+    # What a user has typed so far of a part name or part number
+    def typed_name(rng):
+        return f'part{part_id(rng) - 1}'[:rng.randint(3, 8)]
+
+    def typed_number(rng):
+        return f'PN{part_id(rng) - 1:07d}'[:rng.randint(5, 9)]
+
+    return [
+        ('fetchall', lambda dbm, rng, _: dbm.fetchall(), None, data['parts']),
+        ('get_parts_page', lambda dbm, rng, _: dbm.get_parts_page()[0], None, None),
+        ('get_parts_page[store]', lambda dbm, rng, _: dbm.get_parts_page(part_store_name=rng.choice(stores))[0],
+         None, None),
+        ('get_parts_page[sort=name desc]', lambda dbm, rng, _: dbm.get_parts_page(sort='name', descending=True)[0],
+         None, None),
+        ('get_jobs_page', lambda dbm, rng, _: dbm.get_jobs_page()[0], None, None),
+        ('get_jobs_page[store+range]', lambda dbm, rng, _: dbm.get_jobs_page(
+            part_store_name=rng.choice(stores), since=datetime(2022, 2, 1), until=datetime(2022, 3, 1))[0], None, None),
+        ('get_jobs_page[user+range]', lambda dbm, rng, _: dbm.get_jobs_page(
+            username='bench', since=datetime(2022, 2, 1), until=datetime(2022, 3, 1))[0], None, None),
+        ('get_jobs', lambda dbm, rng, _: dbm.get_jobs(), None, data['jobs']),
+        ('get_part_type_names[cached]', lambda dbm, rng, _: dbm.get_part_type_names(), None, None),
+        ('get_part_type_names[cold]', lambda dbm, rng, _: dbm.get_part_type_names(), cold, None),
+        ('get_part_store_names[cold]', lambda dbm, rng, _: dbm.get_part_store_names(), cold, None),
+        ('get_selections[cached]', lambda dbm, rng, _: dbm.get_selections(), None, None),
+        ('get_part_types[cold]', lambda dbm, rng, _: dbm.get_part_types(), cold, None),
+        ('get_part_stores', lambda dbm, rng, _: dbm.get_part_stores(rng.choice(stores)), None, None),
+        ('get_parts_by_store', lambda dbm, rng, _: dbm.get_parts_by_store(rng.choice(stores)), None, None),
+        ('get_part_type_by_name', lambda dbm, rng, _: dbm.get_part_type_by_name(rng.choice(types)), None, None),
+        ('get_part_information', lambda dbm, rng, _: dbm.get_part_information(part_id(rng)), None, None),
+        ('get_total_parts_by_part_store', lambda dbm, rng, _: dbm.get_total_parts_by_part_store(rng.choice(stores)),
+         None, None),
+        ('get_low_parts', lambda dbm, rng, _: dbm.get_low_parts(), None, None),
+        ('get_low_part_counts', lambda dbm, rng, _: dbm.get_low_part_counts(), None, None),
+        ('get_dashboard_stats', lambda dbm, rng, _: dbm.get_dashboard_stats(days=366), None, None),
+        ('get_part_ledger_page', lambda dbm, rng, _: dbm.get_part_ledger_page(part_id(rng))[0], None, None),
+        ('get_part_consumption', lambda dbm, rng, _: dbm.get_part_consumption(
+            part_id(rng), since=datetime(2022, 2, 1), until=datetime(2022, 3, 1)), None, None),
+        ('audit_stock', lambda dbm, rng, _: dbm.audit_stock(), None, None),
+        ('search_parts[build]', lambda dbm, rng, _: part_search.refresh_all(),
+         lambda dbm, rng: part_search.invalidate(), data['parts']),
+        ('search_parts[refresh]', lambda dbm, rng, _: part_search.refresh_all(), None, data['parts']),
+        ('search_parts[name]', lambda dbm, rng, _: dbm.search_parts(typed_name(rng)), None, None),
+        ('search_parts[number]', lambda dbm, rng, _: dbm.search_parts(typed_number(rng)), None, None),
+        ('search_parts[name+store]', lambda dbm, rng, _: dbm.search_parts(f'{typed_name(rng)} {rng.choice(stores)}'),
+         None, None),
+        ('check_if_exists', lambda dbm, rng, _: dbm.check_if_exists(rng.choice(stores)), None, None),
+        ('check_if_type_exists', lambda dbm, rng, _: dbm.check_if_type_exists(rng.choice(types)), None, None),
+        ('check_admin', lambda dbm, rng, _: dbm.check_admin('bench'), None, None),
+        ('get_users', lambda dbm, rng, _: dbm.get_users('nobody'), None, None),
+        ('insert', lambda dbm, rng, _: dbm.insert('benchpart', '5', 'PNBENCH', rng.choice(stores), rng.choice(types)),
+         None, None),
+        ('update', lambda dbm, rng, _: dbm.update(str(part_id(rng)), 'benchpart', '7', 'PNBENCH',
+                                               rng.choice(stores), rng.choice(types)), None, None),
+        ('update_threshold', lambda dbm, rng, _: dbm.update_threshold(rng.randint(0, 20), part_id(rng)), None, None),
+        ('submit_job', lambda dbm, rng, args: dbm.submit_job('bench', datetime(2022, 1, 1), *args)[0],
+         job_values, None),
+        ('stream_parts', lambda dbm, rng, _: sum(1 for _ in dbm.stream_parts()), None, data['parts']),
+    ]
+
+
+# Time every case runs times, returning latency percentiles, queries per call and rows per second
+def run(engine, data: dict, runs: int = 50, only: list = None) -> dict:
+    dbm = DatabaseManipulator()
+    counter = QueryCounter(engine)
+    rng = Random(1)
+    results = {}
+
+    for name, call, prepare, rows in cases(data):
+        if only and not any(name.startswith(i) for i in only):
+            continue
+
+        # Full table reads get fewer runs so large seeds finish in reasonable time
+        count = max(3, runs // 10) if rows else runs
+        samples, queries = [], 0
+
+        for _ in range(count):
+            prepared = prepare(dbm, rng) if prepare else None
+            before = counter.count
+            start = perf_counter()
+            call(dbm, rng, prepared)
+            samples.append(perf_counter() - start)
+            queries += counter.count - before
+
+        results[name] = {**summarise(samples), 'queries_per_call': round(queries / count, 2)}
+        if rows:
+            results[name]['rows_per_second'] = round(rows / (sum(samples) / count))
+    return results
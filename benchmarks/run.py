@@ -0,0 +1,88 @@
+# Seed a throwaway database, run the micro-benchmarks and load scenarios and write the results as JSON.
+#
+# Usage: python -m benchmarks.run [--url URL] [--reset] [--parts N] [--stores N] [--types N] [--jobs N]
+#                                 [--runs N] [--requests N] [--concurrency N] [--only NAME ...] [--output FILE]
+#                                 [--async-database] [--latency-ms MS] [--replica-url URL ...]
+#
+# SQLite (the default) is recreated on every run. Any other database is only dropped and re-seeded
+# with --reset, so point --url at a database that holds nothing you want to keep. --async-database runs the
+# load scenarios a second time with the reads of each page gathered on the async database layer (SQLite needs
+# aiosqlite installed for it). --latency-ms delays every statement after seeding, so a local SQLite file
+# behaves like a database across the network. --replica-url routes the read only calls to a read replica,
+# SQLite replica files are overwritten with a copy of the seeded database.
+from argparse import ArgumentParser
+from json import dump
+from os import makedirs, path
+from platform import python_version
+from time import strftime
+
+from benchmarks import load, micro
+from benchmarks.common import (DEFAULT_URL, async_url, configure, configure_replicas, git_commit, seed,
+                               simulate_latency)
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the inventory manager against a seeded database.')
+    parser.add_argument('--url', default=DEFAULT_URL, help='SQLAlchemy database URL (default: a SQLite temp file)')
+    parser.add_argument('--reset', action='store_true', help='drop, recreate and seed a non SQLite database')
+    parser.add_argument('--parts', type=int, default=10000)
+    parser.add_argument('--stores', type=int, default=50)
+    parser.add_argument('--types', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=50, help='calls per micro-benchmark')
+    parser.add_argument('--requests', type=int, default=50, help='requests per load scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent clients per load scenario')
+    parser.add_argument('--only', nargs='*', help='only run benchmarks whose name starts with one of these')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--async-database', action='store_true',
+                        help='also run the load scenarios on the async database layer (async_database=true)')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='delay every statement by this many milliseconds (synchronous engine only)')
+    parser.add_argument('--replica-url', action='append', default=[],
+                        help='SQLAlchemy URL of a read replica, can be given more than once')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<commit>.json)')
+    args = parser.parse_args()
+
+    reset = args.reset or args.url.startswith('sqlite')
+    engine = configure(args.url, reset=reset)
+    data = seed(engine, args.parts, args.stores, args.types, args.jobs) if reset else None
+
+    if data is None:
+        parser.error('--reset is required to seed a non SQLite database')
+    if args.latency_ms and args.async_database:
+        parser.error('--latency-ms only delays the synchronous engine, it can\'t be combined with --async-database')
+    if args.replica_url:
+        configure_replicas(args.url, args.replica_url)
+    if args.latency_ms:
+        simulate_latency(engine, args.latency_ms)
+
+    results = {'commit': git_commit(), 'date': strftime('%Y-%m-%dT%H:%M:%S'), 'python': python_version(),
+               'database': engine.dialect.name,
+               'seed': {key: data[key] for key in ('parts', 'stores', 'types', 'jobs')}, 'latency_ms': args.latency_ms,
+               'replicas': len(args.replica_url)}
+
+    if not args.skip_micro:
+        results['micro'] = micro.run(engine, data, args.runs, args.only)
+    if not args.skip_load:
+        results['load'] = load.run(engine, data, args.requests, args.concurrency, args.only)
+    if not args.skip_load and args.async_database:
+        results['load_async'] = load.run_async(engine, data, async_url(args.url), args.requests, args.concurrency,
+                                               args.only)
+
+    output = args.output or path.join(path.dirname(__file__), 'results', f'{results["commit"]}.json')
+    makedirs(path.dirname(path.abspath(output)), exist_ok=True)
+
+    with open(output, 'w') as file:
+        dump(results, file, indent=2)
+
+    for section in ('micro', 'load', 'load_async'):
+        for name, result in results.get(section, {}).items():
+            queries = result.get('queries_per_call', result.get('queries_per_request'))
+            print(f'{section:10} {name:38} p50 {result["p50_ms"]:9.3f} ms  p95 {result["p95_ms"]:9.3f} ms  '
+                  f'p99 {result["p99_ms"]:9.3f} ms  {queries:6} queries')
+    print(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,49 +8,145 @@ create table part_type (
 create index part_type_type_name_index on part_type (type_name);
 create index part_type_type_unit_index on part_type (type_unit);
 
--- Table for the vans
-create table vans (
+-- Table for the part stores
+create table part_store (
     id int auto_increment primary key,
-    van_number varchar(255) null
+    part_store_name varchar(255) null,
+    icon varchar(255) null
 );
-create index van_number on vans (van_number);
+create index part_store_part_store_name_index on part_store (part_store_name);
 
 -- Table for accounts
 create table accounts (
     id int auto_increment primary key,
-    username text null,
+    username varchar(255) null,
     password text null,
     is_admin int default 0 null,
-    is_confirmed int default 0 null
+    is_confirmed int default 0 null,
+    phone_num varchar(20) null,
+    auth_version int default 0 null
 );
+-- Logins and session refreshes look accounts up by username
+create unique index accounts_username_uindex on accounts (username);
 -- Table for jobs
 create table jobs (
     job_id int auto_increment primary key,
     username varchar(255) null,
-    time varchar(255) null,
-    van_number varchar(255) null,
+    time datetime null,
+    part_store_id int null,
     parts_used int null,
-    constraint jobs_vans_van_number_fk foreign key (van_number) references vans (van_number) on update cascade on delete cascade
+    constraint jobs_part_store_id_fk foreign key (part_store_id) references part_store (id) on delete cascade
 );
 
-create index jobs_van_number_index on jobs (van_number);
+create index ix_jobs_time on jobs (time);
+-- Job history is read newest first per store or per user, optionally within a time range
+create index jobs_part_store_id_time_index on jobs (part_store_id, time);
+create index jobs_username_time_index on jobs (username, time);
+
+-- Jobs older than job_retention_days are moved here by flask archive-jobs, stored compressed
+create table jobs_archive (
+    job_id int not null primary key,
+    username varchar(255) null,
+    time datetime null,
+    part_store_id int null,
+    part_store_name varchar(255) null,
+    parts_used int null
+) row_format = compressed;
+create index ix_jobs_archive_time on jobs_archive (time);
 -- Used for the parts database
 create table parts (
     id int auto_increment primary key,
     name varchar(255) null,
     amount int default 0 not null,
     part_number varchar(255) default '0' null,
-    van_number varchar(255) null,
+    part_store_id int null,
+    part_type_id int null,
     low_thresh int null,
-    type varchar(255) null,
-    unit varchar(20) null,
---    foreign key (type, unit) references part_type (type_name, type_unit) on update cascade on delete cascade
-    constraint parts_part_type_type_name_fk foreign key (type) references part_type (type_name) on update cascade on delete cascade,
-    constraint parts_part_type_type_unit_fk foreign key (unit) references part_type (type_unit) on update cascade on delete cascade
-);
-create index parts_amount_index on parts (amount);
-create index parts_name_index on parts (name);
-create index parts_part_number_index on parts (part_number);
-create index parts_type_index on parts (type);
-create index parts_unit_index on parts (unit);
-create index van_number on parts (van_number);
\ No newline at end of file
+    is_low int as (low_thresh > amount) stored,
+    constraint parts_part_store_id_fk foreign key (part_store_id) references part_store (id) on delete cascade,
+    constraint parts_part_type_id_fk foreign key (part_type_id) references part_type (id) on delete cascade
+);
+create index ix_parts_amount on parts (amount);
+create index ix_parts_name on parts (name);
+create index ix_parts_part_number on parts (part_number);
+create index ix_parts_part_type_id on parts (part_type_id);
+-- Parts are filtered by store and type together, the index also serves lookups by store alone
+create index parts_part_store_id_part_type_id_index on parts (part_store_id, part_type_id);
+-- Low parts are listed and counted per store from this index
+create index parts_is_low_part_store_id_index on parts (is_low, part_store_id);
+
+-- Jobs and parts used per part store per day, kept up to date as jobs are recorded
+create table store_daily_usage (
+    part_store_id int not null,
+    day date not null,
+    jobs int default 0 not null,
+    parts_used int default 0 not null,
+    primary key (part_store_id, day),
+    constraint store_daily_usage_part_store_id_fk foreign key (part_store_id) references part_store (id) on delete cascade
+);
+create index ix_store_daily_usage_day on store_daily_usage (day);
+
+-- Units of each part and part type taken out of stock by jobs
+create table part_usage (
+    part_id int not null primary key,
+    units_used int default 0 not null,
+    constraint part_usage_part_id_fk foreign key (part_id) references parts (id) on delete cascade
+);
+create index ix_part_usage_units_used on part_usage (units_used);
+create table part_type_usage (
+    part_type_id int not null primary key,
+    units_used int default 0 not null,
+    constraint part_type_usage_part_type_id_fk foreign key (part_type_id) references part_type (id) on delete cascade
+);
+
+-- One line per part changed by a job: the signed change and the amount left afterwards.
+-- Lines are kept when their job is archived, a part's history is read by time from the composite index
+create table job_lines (
+    id int auto_increment primary key,
+    job_id int null,
+    part_id int not null,
+    delta int not null,
+    quantity int not null,
+    time datetime null,
+    constraint job_lines_part_id_fk foreign key (part_id) references parts (id) on delete cascade
+);
+create index ix_job_lines_job_id on job_lines (job_id);
+create index job_lines_part_id_time_index on job_lines (part_id, time);
+
+-- Change version of each table the pages are rendered from, bumped by every write that commits to it.
+-- Pages and API responses carry them in their ETags and answer 304 Not Modified while they are unchanged
+create table table_versions (
+    table_name varchar(64) not null primary key,
+    version int default 0 not null,
+    changed_at datetime null
+);
+insert into table_versions (table_name, version) values ('accounts', 0), ('jobs', 0), ('part_store', 0),
+                                                       ('part_type', 0), ('parts', 0);
+
+-- Rows changed by committed writes, streamed to open pages by the change feed. row_id is null when a whole
+-- table changed, events older than change_feed_retention minutes are pruned
+create table change_events (
+    id int auto_increment primary key,
+    table_name varchar(64) not null,
+    row_id int null,
+    action varchar(8) not null,
+    time datetime null
+);
+create index ix_change_events_time on change_events (time);
+
+-- Migrations applied by flask migrate, this schema already includes every one listed
+create table schema_version (
+    version int not null primary key,
+    name varchar(255) null,
+    applied_at datetime null
+);
+insert into schema_version (version, name, applied_at) values (1, 'integer foreign keys', now()),
+                                                         (2, 'usage rollups', now()),
+                                                         (3, 'job history indexes', now()),
+                                                         (4, 'job lines', now()),
+                                                         (5, 'table versions', now()),
+                                                         (6, 'change events', now()),
+                                                         (7, 'account auth version', now());
+
+-- Databases created before schema_version existed are upgraded with flask migrate, which converts
+-- the parts and jobs rows in batches
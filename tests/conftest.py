@@ -0,0 +1,57 @@
+# Shared fixtures: the app runs on a throwaway SQLite database that is created empty for every test
+from os import environ, path
+from tempfile import mkdtemp
+
+environ.update(database_url=f'sqlite:///{path.join(mkdtemp(), "inventory_test.db")}', SECRET_KEY='test',
+               api_token='test-token')
+
+from time import time
+
+import pytest
+from sqlalchemy import insert
+
+import app.decorators
+from app.database.DatabaseTables import metadata, Account, PartStore, PartType
+from app.database.PartSearch import part_search
+from app.database.ReferenceCache import reference_cache
+from app.database.TableVersions import table_versions
+from app.views import app as flask_app
+
+
+# An empty schema, with the caches of earlier tests dropped
+@pytest.fixture
+def database():
+    metadata.drop_all(app.decorators.engine)
+    metadata.create_all(app.decorators.engine)
+    reference_cache.invalidate()
+    part_search.invalidate()
+    table_versions.invalidate()
+    return app.decorators.engine
+
+
+# A part store '12' and a part type 'bolt' to add parts to
+@pytest.fixture
+def references(database):
+    with database.begin() as connection:
+        connection.execute(insert(PartStore).values(part_store_name='12', icon='van'))
+        connection.execute(insert(PartType).values(type_name='bolt', type_unit='ea'))
+    return database
+
+
+@pytest.fixture
+def client(database):
+    return flask_app.test_client()
+
+
+# A client logged in as the admin 'tech', without CSRF tokens
+@pytest.fixture
+def logged_in(client, monkeypatch):
+    monkeypatch.setitem(flask_app.config, 'WTF_CSRF_ENABLED', False)
+
+    with app.decorators.engine.begin() as connection:
+        connection.execute(insert(Account).values(username='tech', password='x', is_admin=1, is_confirmed=1))
+
+    with client.session_transaction() as session:
+        session.update(logged_in=True, username='tech', user_id=1, is_admin=True, is_confirmed=True, auth_version=0,
+                       accounts_version=table_versions.get()['accounts'][0], auth_checked=time())
+    return client
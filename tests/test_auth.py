@@ -0,0 +1,53 @@
+from bcrypt import gensalt, hashpw
+from sqlalchemy import insert, update
+
+import app.views
+from app.database.DatabaseTables import Account, TableVersion
+from app.database.TableVersions import table_versions
+
+
+def add_account(engine, is_admin: int) -> None:
+    password = hashpw(b'secret', gensalt(4)).decode()
+    with engine.begin() as connection:
+        connection.execute(insert(Account).values(username='tech', password=password, is_admin=is_admin,
+                                                  is_confirmed=1))
+
+
+# Another process makes the account an admin
+def promote(engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(update(Account).values(is_admin=1, auth_version=Account.auth_version + 1))
+        connection.execute(update(TableVersion).where(TableVersion.table_name == 'accounts')
+                           .values(version=TableVersion.version + 1))
+    table_versions.invalidate()
+
+
+def test_login_caches_the_flags(client, database, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'WTF_CSRF_ENABLED', False)
+    add_account(database, 1)
+
+    assert client.post('/login', data={'username': 'tech', 'password': 'secret'}).status_code == 302
+    with client.session_transaction() as session:
+        assert (session['is_admin'], session['accounts_version']) == (True, 0)
+
+
+# A change committed after the login read the account is seen on the next request, not stamped as seen
+def test_change_during_login_is_seen_next_request(client, database, monkeypatch):
+    monkeypatch.setitem(client.application.config, 'WTF_CSRF_ENABLED', False)
+    add_account(database, 0)
+    login = app.views.dbm.login
+
+    def login_then_promote(**kwargs):
+        account = login(**kwargs)
+        promote(database)
+        return account
+
+    monkeypatch.setattr(app.views.dbm, 'login', login_then_promote)
+    client.post('/login', data={'username': 'tech', 'password': 'secret'})
+
+    with client.session_transaction() as session:
+        assert (session['is_admin'], session['accounts_version']) == (False, 0)
+
+    client.get('/')
+    with client.session_transaction() as session:
+        assert (session['is_admin'], session['accounts_version']) == (True, 1)
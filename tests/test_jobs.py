@@ -0,0 +1,45 @@
+from sqlalchemy import func, insert, select, text
+
+from app.database.DatabaseTables import Job, Part
+
+
+def add_part(engine, amount: int) -> int:
+    with engine.begin() as connection:
+        return connection.execute(insert(Part).values(name='bolt', amount=amount, part_number='N1', part_store_id=1,
+                                                      part_type_id=1)).inserted_primary_key[0]
+
+
+def amount_and_jobs(engine) -> tuple:
+    with engine.connect() as connection:
+        return (connection.execute(select(Part.amount)).scalar(),
+                connection.execute(select(func.count()).select_from(Job)).scalar())
+
+
+def test_submit_job(logged_in, references):
+    part_id = add_part(references, 5)
+    response = logged_in.post('/jobs/12', json=[{'part_id': part_id, 'amount': 3, 'original': 5}])
+
+    assert response.status_code == 200
+    assert amount_and_jobs(references) == (3, 1)
+
+
+# The page showed 5 but another job left 1, taking 2 more would go below 0
+def test_conflict(logged_in, references):
+    part_id = add_part(references, 1)
+    response = logged_in.post('/jobs/12', json=[{'part_id': part_id, 'amount': 3, 'original': 5}])
+
+    assert response.status_code == 409
+    assert response.get_json()['conflicts'][0]['available'] == 1
+    assert amount_and_jobs(references) == (1, 0)
+
+
+def test_database_error(logged_in, references):
+    part_id = add_part(references, 5)
+    with references.begin() as connection:
+        connection.execute(text('DROP TABLE job_lines'))
+
+    response = logged_in.post('/jobs/12', json=[{'part_id': part_id, 'amount': 3, 'original': 5}])
+
+    assert response.status_code == 503
+    assert 'error' in response.get_json()
+    assert amount_and_jobs(references) == (5, 0)
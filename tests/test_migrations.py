@@ -0,0 +1,57 @@
+from sqlalchemy import inspect, text
+
+from app.database.DatabaseManipulator import DatabaseManipulator
+from app.database.DatabaseTables import metadata
+from app.database.migrations import migrate, migration_modules
+from app.views import app as flask_app
+
+dbm = DatabaseManipulator()
+
+
+# A database migrated up to the change log, with the accounts table of the oldest database.sql
+def old_accounts(engine) -> None:
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE accounts')
+        connection.exec_driver_sql('CREATE TABLE accounts (id integer primary key, username text, password text, '
+                                   'is_admin int default 0, is_confirmed int default 0)')
+        connection.exec_driver_sql("INSERT INTO accounts (username, password, is_admin, is_confirmed) "
+                                   "VALUES ('admin', 'hash', 1, 1)")
+        connection.exec_driver_sql('DELETE FROM schema_version WHERE version > 6')
+
+
+def test_account_auth_version(database):
+    migrate(database, log=lambda message: None)
+    old_accounts(database)
+
+    assert migrate(database, log=lambda message: None) == [len(migration_modules)]
+
+    inspector = inspect(database)
+    assert {'phone_num', 'auth_version'} <= {i['name'] for i in inspector.get_columns('accounts')}
+    assert [(i['name'], bool(i['unique'])) for i in inspector.get_indexes('accounts')] == \
+           [('accounts_username_uindex', True)]
+
+    account = dbm.get_credentials('admin')
+    assert (account.username, account.is_admin, account.auth_version) == ('admin', 1, 0)
+    assert migrate(database, log=lambda message: None) == []
+
+
+def test_status_does_not_change_the_database(database):
+    metadata.drop_all(database)
+
+    result = flask_app.test_cli_runner().invoke(args=['migrate', '--status'])
+
+    assert result.exit_code == 0
+    assert 'Current version: 0' in result.output
+    assert inspect(database).get_table_names() == []
+
+    result = flask_app.test_cli_runner().invoke(args=['migrate'])
+    assert result.exit_code == 0
+    assert f'now at version {len(migration_modules)}' in result.output
+
+
+def test_status_of_a_database_that_was_never_migrated(database):
+    result = flask_app.test_cli_runner().invoke(args=['migrate', '--status'])
+
+    assert f'Current version: {len(migration_modules)}' in result.output
+    with database.connect() as connection:
+        assert connection.execute(text('SELECT count(*) FROM schema_version')).scalar() == 0
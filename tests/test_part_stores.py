@@ -0,0 +1,36 @@
+from sqlalchemy import insert, select
+
+from app.database.DatabaseManipulator import DatabaseManipulator
+from app.database.DatabaseTables import Part, PartStore, TableVersion
+from app.database.PartSearch import part_search
+
+dbm = DatabaseManipulator()
+
+
+def store_version(engine) -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(TableVersion.version).where(TableVersion.table_name == 'part_store')).scalar()
+
+
+def test_rejected_rename_is_not_published(references):
+    with references.begin() as connection:
+        connection.execute(insert(PartStore).values(part_store_name='13', icon='van'))
+
+    dbm.update_part_store(1, '13', 'van')
+    assert store_version(references) == 0
+
+    dbm.update_part_store(1, '14', 'van')
+    assert store_version(references) == 1
+
+
+def test_renamed_store_is_searchable(references):
+    with references.begin() as connection:
+        connection.execute(insert(Part).values(name='hex bolt', amount=1, part_number='N1', part_store_id=1,
+                                               part_type_id=1))
+    part_search.refresh_all()
+    assert [row.part_store_name for row in dbm.search_parts('12')] == ['12']
+
+    dbm.update_part_store(1, '77', 'van')
+
+    assert [row.part_store_name for row in dbm.search_parts('77')] == ['77']
+    assert dbm.search_parts('12') == []
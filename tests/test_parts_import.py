@@ -0,0 +1,62 @@
+from io import BytesIO
+
+from sqlalchemy import func, select
+
+from app.database.DatabaseTables import Part
+
+TOKEN = {'Authorization': 'Bearer test-token'}
+HEADER = 'name,amount,part_number,part_store_name,type,low_thresh\n'
+
+
+def parts_csv(rows: int) -> bytes:
+    return (HEADER + ''.join(f'bolt {i},{i % 50},N{i:06d},12,bolt,5\n' for i in range(rows))).encode('utf-8-sig')
+
+
+def count_parts(engine) -> int:
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Part)).scalar()
+
+
+def test_multipart_upload(client, references):
+    response = client.post('/api/v1/parts/import', headers=TOKEN, content_type='multipart/form-data',
+                           data={'file': (BytesIO(parts_csv(3)), 'parts.csv')})
+
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 3
+    assert count_parts(references) == 3
+
+
+# Werkzeug spools uploads over 500 KB to a temporary file instead of keeping them in memory
+def test_large_multipart_upload(client, references):
+    body = parts_csv(20000)
+    assert len(body) > 500 * 1024
+
+    response = client.post('/api/v1/parts/import', headers=TOKEN, content_type='multipart/form-data',
+                           data={'file': (BytesIO(body), 'parts.csv')})
+
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 20000
+
+
+def test_csv_body(client, references):
+    response = client.post('/api/v1/parts/import', headers={**TOKEN, 'Content-Type': 'text/csv'}, data=parts_csv(2))
+
+    assert response.status_code == 200
+    assert count_parts(references) == 2
+
+
+def test_invalid_rows_are_reported(client, references):
+    body = (HEADER + 'bolt,x,N1,12,bolt,\nnut,3,N2,99,bolt,\n').encode()
+    response = client.post('/api/v1/parts/import', headers=TOKEN, content_type='multipart/form-data',
+                           data={'file': (BytesIO(body), 'parts.csv')})
+
+    assert response.status_code == 422
+    assert [error['line'] for error in response.get_json()['errors']] == [2, 3]
+
+
+def test_wrong_token(client, references):
+    response = client.post('/api/v1/parts/import', headers={'Authorization': 'Bearer nope'},
+                           content_type='multipart/form-data', data={'file': (BytesIO(parts_csv(1)), 'parts.csv')})
+
+    assert response.status_code == 401
+    assert count_parts(references) == 0
@@ -0,0 +1,26 @@
+import pytest
+from flask import g
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+
+from app import profiler
+from app.views import app as flask_app
+
+
+# A statement that fails is neither counted nor leaves its start time behind on the pooled connection
+def test_failed_statement(monkeypatch):
+    monkeypatch.setattr(profiler, 'enabled', True)
+    engine = create_engine('sqlite://')
+    event.listen(engine, 'before_cursor_execute', profiler.before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', profiler.after_cursor_execute)
+
+    with flask_app.test_request_context('/'), engine.connect() as connection:
+        profiler.start_profile()
+
+        with pytest.raises(OperationalError):
+            connection.exec_driver_sql('SELECT * FROM missing')
+        connection.exec_driver_sql('SELECT 1')
+
+        assert g.profile['queries'] == 1
+        assert len(g.profile['statements']) == 1
+        assert 'query_start' not in connection.info
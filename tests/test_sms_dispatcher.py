@@ -0,0 +1,101 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import loads
+from os import path
+from subprocess import run
+from sys import executable
+from threading import Thread
+
+import pytest
+
+from app.notifications.SmsDispatcher import SmsDispatcher
+
+
+# Local stand-in for the Till gateway: answers with the queued status codes, then 200, and keeps the
+# bodies of the requests it accepted
+class Gateway(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), GatewayHandler)
+        self.codes = []
+        self.received = []
+        self.requests = 0
+        self.url = f'http://127.0.0.1:{self.server_port}/'
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests += 1
+        code = self.server.codes.pop(0) if self.server.codes else 200
+
+        if code == 200:
+            self.server.received.append(body)
+        self.send_response(code)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gateway():
+    server = Gateway()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def dispatcher(url: str) -> SmsDispatcher:
+    return SmsDispatcher(url=url, batch_window=0.05, max_retries=3, backoff=0.01, timeout=2)
+
+
+# Repeated alerts with the same key are coalesced, recipients of the same text share one request
+def test_batching(gateway):
+    sms = dispatcher(gateway.url)
+    for i in range(5):
+        sms.enqueue('5551234567', f'low {i}', key='low_parts')
+    sms.enqueue('5551234567', 'other')
+    sms.enqueue('5559999999', 'other')
+    sms.stop(5)
+
+    assert sorted((body['text'], body['phone']) for body in gateway.received) == \
+           [('low 4\nother', ['15551234567']), ('other', ['15559999999'])]
+    assert (sms.counters['coalesced'], sms.counters['sent']) == (4, 2)
+
+
+@pytest.mark.parametrize('codes', [[429], [500, 503], [502, 429, 504]])
+def test_transient_failures_are_retried(gateway, codes):
+    gateway.codes = list(codes)
+    sms = dispatcher(gateway.url)
+
+    assert sms._send(['5551234567'], 'low')
+    assert (gateway.requests, sms.counters['retried'], sms.counters['sent']) == (len(codes) + 1, len(codes), 1)
+
+
+@pytest.mark.parametrize('code', [400, 401, 404, 422])
+def test_refused_batches_are_not_retried(gateway, code):
+    gateway.codes = [code]
+    sms = dispatcher(gateway.url)
+
+    assert not sms._send(['5551234567'], 'low')
+    assert (gateway.requests, sms.counters['retried'], sms.counters['failed']) == (1, 0, 1)
+
+
+def test_connection_errors_are_retried(gateway):
+    url = gateway.url
+    gateway.shutdown()
+    gateway.server_close()
+    sms = dispatcher(url)
+
+    assert not sms._send(['5551234567'], 'low')
+    assert (sms.counters['retried'], sms.counters['failed']) == (3, 1)
+
+
+# What is pending when the process exits is sent by the atexit hook, without calling stop()
+def test_pending_messages_are_sent_on_exit(gateway):
+    code = (f'from app.notifications.SmsDispatcher import SmsDispatcher\n'
+            f'sms = SmsDispatcher(url={gateway.url!r}, batch_window=60)\n'
+            f'sms.enqueue("5551234567", "at exit")\n')
+    run([executable, '-c', code], check=True, cwd=path.dirname(path.dirname(__file__)), timeout=30)
+
+    assert [body['text'] for body in gateway.received] == ['at exit']